@@ -0,0 +1,285 @@
+'''Admission of computed values into a cache: whether a value is worth
+storing, judged by the time it took to compute, its size and how often its
+arguments are looked up. Lookup frequencies are estimated TinyLFU-style by a
+count-min sketch that is halved periodically, so it forgets old accesses and
+takes constant memory however many keys there are. Caches save the sketch
+with their entries, so arguments looked up once per run count across runs.
+'''
+import hashlib
+import os
+import pickle
+import subprocess
+import sys
+import unittest
+
+
+class FrequencySketch(object):
+    ''' Count-min sketch of small counters (at most 15) in depth rows of
+    width counters each. After 10 * width increments all counters are
+    halved. Keys are hashed with blake2b rather than hash(), which is salted
+    per process, so a pickled sketch stays valid in later runs. changed
+    tells whether counts changed since it was last cleared. '''
+
+    MAX_COUNT = 15
+
+    def __init__(self, width=4096, depth=4):
+        self.width = 1 << max(width - 1, 1).bit_length() # Power of two
+        self.mask = self.width - 1
+        self.depth = depth
+        self.rows = [bytearray(self.width) for _ in range(depth)]
+        self.sample_size = 10 * self.width
+        self.additions = 0
+        self.changed = False
+
+    def indexes(self, key):
+        digest = hashlib.blake2b(repr(key).encode('utf-8', 'backslashreplace'),
+                                 digest_size=4 * self.depth).digest()
+        return [int.from_bytes(digest[4 * row:4 * row + 4], 'little') & self.mask
+                for row in range(self.depth)]
+
+    def increment(self, key):
+        indexes = self.indexes(key)
+        counts = [row[index] for row, index in zip(self.rows, indexes)]
+        least = min(counts)
+        if least == self.MAX_COUNT:
+            return
+        # Conservative update: only the smallest counters grow.
+        for row, index, count in zip(self.rows, indexes, counts):
+            if count == least:
+                row[index] = count + 1
+        self.additions += 1
+        self.changed = True
+        if self.additions >= self.sample_size:
+            self.age()
+
+    def estimate(self, key):
+        return min(row[index] for row, index in zip(self.rows, self.indexes(key)))
+
+    def age(self):
+        self.rows = [bytearray(count >> 1 for count in row) for row in self.rows]
+        self.additions //= 2
+
+
+class Admission(object):
+    ''' Decides whether a computed value is stored. Keys are (funcname,
+    args_key). Rules may be given for all functions and per function, see
+    from_config(). A value is stored if
+
+    - it took at least 'min_runningtime' seconds to compute (default 0),
+    - it took at least 'min_seconds_per_mb' seconds per MB of pickled value,
+      if set, so fast functions with large results are not stored,
+    - its arguments have been looked up at least 'min_frequency' times
+      (default 1, i.e. on the first miss), and
+    - storing it would not evict an entry whose arguments are looked up at
+      least as often, if the cache is full (TinyLFU).
+
+    A function whose last 'bypass_after' values (default None: never) were
+    all rejected is bypassed for its next 'bypass_calls' calls (default 1000):
+    it is called directly, neither looked up nor traced. Then it is traced
+    again, in case its values became worth storing.
+
+    Lookup frequencies carry over to later runs through dumps() and
+    restore(), which caches use on save and open. Without them, values
+    computed once per run would never reach a 'min_frequency' of 2 or more.
+    With several processes sharing a cache, the last one to save wins.
+    '''
+
+    defaults = {'min_runningtime': 0.0, 'min_seconds_per_mb': None,
+                'min_frequency': 1, 'bypass_after': None, 'bypass_calls': 1000}
+
+    def __init__(self, rules=None, function_rules=None, sketch_width=4096):
+        self.rules = dict(self.defaults, **(rules or {}))
+        self.function_rules = dict((funcname, dict(self.rules, **function_rules))
+                                   for funcname, function_rules
+                                   in (function_rules or {}).items())
+        self.sketch = FrequencySketch(sketch_width)
+        # Values rejected in a row and remaining bypassed calls per function.
+        self.rejections = dict()
+        self.bypasses = dict()
+
+    @classmethod
+    def from_config(cls, config):
+        ''' Admission for the 'admission' (rules for all functions, and
+        'sketch_width') and 'function_admission' (dict of funcname to rules)
+        keys of a cache config, None if it sets neither. '''
+        rules = config.get('admission')
+        function_rules = config.get('function_admission')
+        if rules is None and function_rules is None:
+            return None
+        rules = dict(rules or {})
+        sketch_width = rules.pop('sketch_width', 4096)
+        return cls(rules, function_rules, sketch_width)
+
+    def dumps(self):
+        ''' The lookup frequencies as bytes, for restore(). '''
+        return pickle.dumps(self.sketch, pickle.HIGHEST_PROTOCOL)
+
+    def restore(self, data):
+        ''' Continues from the lookup frequencies of dumps(), unless they
+        cannot be read or the sketch was of another size. '''
+        try:
+            sketch = pickle.loads(data)
+        except (pickle.UnpicklingError, EOFError, AttributeError, ValueError):
+            return
+        if (isinstance(sketch, FrequencySketch) and sketch.width == self.sketch.width
+                and sketch.depth == self.sketch.depth):
+            sketch.changed = False
+            self.sketch = sketch
+
+    def rules_of(self, funcname):
+        return self.function_rules.get(funcname, self.rules)
+
+    def record(self, key):
+        ''' Counts a lookup of key. '''
+        self.sketch.increment(key)
+
+    def admit(self, key, runningtime, size, victim=None):
+        ''' Counts the miss of key and returns whether its value, computed in
+        runningtime seconds, is stored. size() returns the size of the value
+        in bytes; it is only called if needed. victim is the key storing the
+        value would evict first, if any. '''
+        self.record(key)
+        funcname = key[0]
+        rules = self.rules_of(funcname)
+        admitted = self.worth_storing(key, rules, runningtime or 0.0, size, victim)
+        if admitted:
+            self.rejections.pop(funcname, None)
+        else:
+            rejections = self.rejections[funcname] = self.rejections.get(funcname, 0) + 1
+            if rules['bypass_after'] is not None and rejections >= rules['bypass_after']:
+                self.bypasses[funcname] = rules['bypass_calls']
+                del self.rejections[funcname]
+        return admitted
+
+    def worth_storing(self, key, rules, runningtime, size, victim):
+        if runningtime < rules['min_runningtime']:
+            return False
+        frequency = self.sketch.estimate(key)
+        if frequency < rules['min_frequency']:
+            return False
+        if rules['min_seconds_per_mb'] is not None:
+            if runningtime < rules['min_seconds_per_mb'] * size() / 1e6:
+                return False
+        if victim is not None and self.sketch.estimate(victim) >= frequency:
+            return False
+        return True
+
+    def bypassed(self, funcname):
+        ''' Whether a call of funcname is to be made without the cache. '''
+        if not self.bypasses:
+            return False
+        remaining = self.bypasses.get(funcname)
+        if remaining is None:
+            return False
+        if remaining <= 1:
+            del self.bypasses[funcname]
+        else:
+            self.bypasses[funcname] = remaining - 1
+        return True
+
+
+class FrequencySketchTest(unittest.TestCase):
+    def test_estimate(self):
+        sketch = FrequencySketch(256)
+        for i in range(5):
+            sketch.increment('a')
+        sketch.increment('b')
+        self.assertEqual(5, sketch.estimate('a'))
+        self.assertEqual(1, sketch.estimate('b'))
+        self.assertEqual(0, sketch.estimate('c'))
+
+    def test_saturates_and_ages(self):
+        sketch = FrequencySketch(16)
+        for i in range(20):
+            sketch.increment('a')
+        self.assertEqual(15, sketch.estimate('a'))
+        # Checked right after aging, as later increments may collide with 'a'.
+        for i in range(10 * sketch.sample_size):
+            additions = sketch.additions
+            sketch.increment(i)
+            if sketch.additions < additions:
+                break
+        self.assertLess(sketch.additions, additions)
+        self.assertLessEqual(sketch.estimate('a'), 7)
+
+    def test_stable_hash(self):
+        ''' Keys land on the same counters in every process. '''
+        script = ('from admission import FrequencySketch\n'
+                  'print(FrequencySketch(256).indexes(("f", "a")))')
+        outputs = set(subprocess.check_output([sys.executable, '-c', script],
+                                              cwd=os.path.dirname(os.path.abspath(__file__)))
+                      for i in range(2))
+        self.assertEqual(set([('%s\n' % FrequencySketch(256).indexes(('f', 'a'))).encode()]),
+                         outputs)
+
+
+class AdmissionTest(unittest.TestCase):
+    def test_min_runningtime(self):
+        admission = Admission({'min_runningtime': 0.1})
+        self.assertFalse(admission.admit(('f', 'a'), 0.01, None))
+        self.assertTrue(admission.admit(('f', 'b'), 0.2, None))
+
+    def test_size(self):
+        admission = Admission({'min_seconds_per_mb': 1.0})
+        sizes = []
+        size = lambda: sizes.append(1) or 10 ** 7
+        self.assertFalse(admission.admit(('f', 'a'), 1.0, size))
+        self.assertTrue(admission.admit(('f', 'b'), 20.0, size))
+        self.assertEqual(2, len(sizes))
+        # Not needed if rejected anyway.
+        admission = Admission({'min_runningtime': 1.0, 'min_seconds_per_mb': 1.0})
+        self.assertFalse(admission.admit(('f', 'a'), 0.5, size))
+        self.assertEqual(2, len(sizes))
+
+    def test_frequency(self):
+        admission = Admission({'min_frequency': 2})
+        self.assertFalse(admission.admit(('f', 'a'), 1.0, None))
+        self.assertTrue(admission.admit(('f', 'a'), 1.0, None))
+
+    def test_victim(self):
+        ''' A value is not stored in place of a more frequently used one. '''
+        admission = Admission()
+        for i in range(3):
+            admission.record(('f', 'hot'))
+        self.assertFalse(admission.admit(('f', 'new'), 1.0, None, ('f', 'hot')))
+        admission.record(('f', 'new'))
+        admission.record(('f', 'new'))
+        self.assertTrue(admission.admit(('f', 'new'), 1.0, None, ('f', 'hot')))
+
+    def test_function_rules_and_bypass(self):
+        admission = Admission({'bypass_after': 2, 'bypass_calls': 3},
+                              {'g': {'min_runningtime': 1.0}})
+        self.assertTrue(admission.admit(('f', 'a'), 0.1, None))
+        self.assertFalse(admission.admit(('g', 'a'), 0.1, None))
+        self.assertFalse(admission.bypassed('g'))
+        self.assertFalse(admission.admit(('g', 'b'), 0.1, None))
+        self.assertEqual([True] * 3 + [False],
+                         [admission.bypassed('g') for i in range(4)])
+        self.assertFalse(admission.bypassed('f'))
+
+    def test_restore(self):
+        admission = Admission({'min_frequency': 2})
+        self.assertFalse(admission.admit(('f', 'a'), 1.0, None))
+        data = admission.dumps()
+        # The next run.
+        admission = Admission({'min_frequency': 2})
+        admission.restore(data)
+        self.assertFalse(admission.sketch.changed)
+        self.assertTrue(admission.admit(('f', 'a'), 1.0, None))
+        self.assertTrue(admission.sketch.changed)
+        # Ignored if the width changed, or unreadable.
+        admission = Admission({'min_frequency': 2}, sketch_width=64)
+        admission.restore(data)
+        admission.restore(b'garbage')
+        self.assertFalse(admission.admit(('f', 'a'), 1.0, None))
+
+    def test_from_config(self):
+        self.assertIsNone(Admission.from_config({'file': 'x'}))
+        admission = Admission.from_config({'admission': {'min_frequency': 3,
+                                                         'sketch_width': 100}})
+        self.assertEqual(3, admission.rules_of('f')['min_frequency'])
+        self.assertEqual(128, admission.sketch.width)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,419 @@
+'''Static analysis of the functions a function depends on, from its bytecode
+rather than by tracing a call, see Callgraph's static option.
+
+The functions and classes a function refers to through its globals and
+closure, including attributes of modules (np.linalg.solve) and classes
+(Model.fit), and those they refer to in turn, make up its callgraph. Nested
+code objects (inner functions, comprehensions) count as part of the
+function, as they do for its fingerprint. As with tracing, functions of the
+standard library, of installed packages and of pycache itself are left out.
+
+The analysis is incomplete where a call cannot be followed statically: calls
+of local variables and arguments, methods called on other objects, unless
+the object is a literal, built by calling a builtin type, or a class the
+function refers to has a method of that name, and uses of getattr(), eval()
+and the like. Functions it reaches that are not bound under their name,
+such as closures, are reported as well, as unchanged() could not check
+them, as are functools.partial objects, whose functions are not followed.
+Calls made implicitly, e.g. by operators or properties of objects passed
+in, are not seen at all.
+'''
+import builtins
+import dis
+import functools
+import os
+import sys
+import sysconfig
+import types
+import unittest
+import weakref
+
+from fingerprint import function_fingerprint
+from registry import registry
+from tracer import TraceProcessor
+
+# Scan per code object, see scan().
+code_scans = weakref.WeakKeyDictionary()
+
+# The bytecode patterns of calls recognized here are those of CPython 3.11
+# and later.
+SUPPORTED = sys.version_info >= (3, 11)
+
+# Builtin types whose methods are called on literals and on the objects
+# calling them returns.
+BUILTIN_TYPES = dict((kind.__name__, kind) for kind in (
+    object, type, list, dict, set, frozenset, tuple, str, bytes, bytearray,
+    memoryview, int, float, complex, range, slice))
+
+# Types of the objects instructions other than LOAD_CONST and calls leave on
+# top of the stack.
+BUILT_TYPES = {'BUILD_LIST': list, 'BUILD_TUPLE': tuple, 'BUILD_SET': set,
+               'BUILD_MAP': dict, 'BUILD_CONST_KEY_MAP': dict, 'BUILD_STRING': str,
+               'BUILD_SLICE': slice, 'LIST_EXTEND': list, 'LIST_TO_TUPLE': tuple,
+               'SET_UPDATE': set, 'DICT_UPDATE': dict, 'DICT_MERGE': dict,
+               'FORMAT_VALUE': str, 'FORMAT_SIMPLE': str, 'FORMAT_WITH_SPEC': str}
+
+# Builtins calling or looking up code by name.
+DYNAMIC_BUILTINS = frozenset(['getattr', 'eval', 'exec', 'compile', '__import__',
+                              'globals', 'locals', 'vars'])
+
+# Standard library and installed packages, as TraceProcessor.init_libpath().
+lib_path = sysconfig.get_paths()['purelib']
+if os.path.split(lib_path)[1] == 'site-packages':
+    lib_path = os.path.split(lib_path)[0]
+lib_path = lib_path.lower()
+
+MISSING = object()
+
+
+class Scan(object):
+    ''' What a code object refers to.
+
+    chains: (kind, names) per reference, where names are a global ('global')
+    or free variable ('free', 'called' if it is called) followed by the
+    attributes loaded from it.
+    methods: names of methods called on objects of unknown type.
+    dynamic: why calls cannot be followed, None if they can.
+    '''
+    def __init__(self):
+        self.chains = set()
+        self.methods = set()
+        self.dynamic = None
+
+
+def scan(code):
+    ''' Scan of code and the code nested in it. Memoized per code object. '''
+    try:
+        return code_scans[code]
+    except KeyError:
+        pass
+    result = Scan()
+    chain = None
+    previous = None
+    # Local variables called, and those bound to functions defined here.
+    called = set()
+    local_functions = set()
+    # Stack depth, relative to the start or the last jump target, the
+    # builtin types loaded at a depth to be called, and the builtin type of
+    # the object on top of the stack, if known.
+    depth = 0
+    types_called = dict()
+    top = None
+    for instruction in dis.get_instructions(code):
+        name = instruction.opname
+        if name in ('NOP', 'CACHE', 'EXTENDED_ARG'):
+            continue
+        if instruction.is_jump_target:
+            types_called.clear()
+        loaded = top
+        top = None
+        if name == 'LOAD_GLOBAL' and instruction.argval in BUILTIN_TYPES:
+            types_called[depth] = BUILTIN_TYPES[instruction.argval]
+        depth += dis.stack_effect(instruction.opcode, instruction.arg, jump=False)
+        for key in [key for key in types_called if key >= depth]:
+            del types_called[key]
+        if name.startswith('CALL'):
+            top = types_called.pop(depth - 1, None)
+        elif name == 'LOAD_CONST' and type(instruction.argval) in BUILTIN_TYPES.values():
+            top = type(instruction.argval)
+        elif name in BUILT_TYPES:
+            top = BUILT_TYPES[name]
+        if chain is not None and name in ('LOAD_ATTR', 'LOAD_METHOD'):
+            chain[1].append(instruction.argval)
+            previous = name
+            continue
+        if chain is not None:
+            result.chains.add((chain[0], tuple(chain[1])))
+            chain = None
+        if name in ('LOAD_GLOBAL', 'LOAD_NAME'):
+            chain = ['global', [instruction.argval]]
+        elif name in ('LOAD_DEREF', 'LOAD_CLASSDEREF'):
+            # A callee is loaded right after PUSH_NULL, or from 3.13 on
+            # right before it.
+            chain = ['called' if previous == 'PUSH_NULL' else 'free', [instruction.argval]]
+        elif name == 'LOAD_METHOD' or (name == 'LOAD_ATTR' and is_method(instruction)):
+            if loaded is None or not hasattr(loaded, instruction.argval):
+                result.methods.add(instruction.argval)
+        elif name == 'LOAD_SUPER_ATTR':
+            result.methods.add(instruction.argval)
+        elif name == 'PUSH_NULL' and previous in ('LOAD_DEREF', 'LOAD_CLASSDEREF'):
+            result.chains.discard(('free', (last,)))
+            result.chains.add(('called', (last,)))
+        elif name.startswith('LOAD_FAST') and previous == 'PUSH_NULL':
+            called.add(instruction.argval)
+        elif name == 'PUSH_NULL' and previous and previous.startswith('LOAD_FAST'):
+            called.add(last)
+        elif name == 'STORE_FAST' and previous == 'MAKE_FUNCTION':
+            local_functions.add(instruction.argval)
+        elif name == 'SET_FUNCTION_ATTRIBUTE':
+            # Sets the defaults or closure of the function just made, from
+            # Python 3.13 on.
+            continue
+        previous = name
+        last = instruction.argval
+    if chain is not None:
+        result.chains.add((chain[0], tuple(chain[1])))
+    if called - local_functions:
+        result.dynamic = 'calls local variable %s' % ', '.join(sorted(called - local_functions))
+    for const in code.co_consts:
+        if isinstance(const, types.CodeType):
+            nested = scan(const)
+            result.chains.update(nested.chains)
+            result.methods.update(nested.methods)
+            result.dynamic = result.dynamic or nested.dynamic
+    code_scans[code] = result
+    return result
+
+
+def is_method(instruction):
+    ''' Whether a LOAD_ATTR loads a method to call it, which Python 3.12
+    and later flag in its argument. '''
+    return sys.version_info >= (3, 12) and instruction.arg & 1
+
+
+def unwrap(func):
+    ''' The function behind decorators using functools.wraps, methods,
+    staticmethods and classmethods. '''
+    while True:
+        inner = getattr(func, '__wrapped__', None)
+        if inner is None:
+            inner = getattr(func, '__func__', None)
+        if inner is None:
+            return func
+        func = inner
+
+
+def excluded(obj):
+    ''' Whether obj belongs to the standard library, an installed package or
+    pycache, which a Callgraph leaves out. '''
+    module_name = getattr(obj, '__module__', None)
+    if module_name == 'builtins':
+        return True
+    module = sys.modules.get(module_name)
+    if isinstance(obj, type):
+        code = next((value.__code__ for value in vars(obj).values()
+                     if isinstance(value, types.FunctionType)), None)
+    else:
+        code = getattr(obj, '__code__', None)
+    if TraceProcessor.is_internal(module, code):
+        return True
+    path = getattr(module, '__file__', None)
+    return bool(path) and path.lower().startswith(lib_path)
+
+
+def function_name(func):
+    ''' Name of func as the tracer builds it: module-qualified except in
+    __main__, by its qualified name. '''
+    if func.__module__ in (None, '__main__'):
+        return func.__qualname__
+    return '%s.%s' % (func.__module__, func.__qualname__)
+
+
+def class_functions(cls):
+    ''' Functions defined by cls and its base classes. '''
+    functions = []
+    for base in cls.__mro__:
+        if base is object or excluded(base):
+            continue
+        for value in vars(base).values():
+            if isinstance(value, property):
+                functions.extend(f for f in (value.fget, value.fset, value.fdel) if f)
+            else:
+                value = unwrap(value)
+                if isinstance(value, types.FunctionType):
+                    functions.append(value)
+    return functions
+
+
+def dependencies(function):
+    ''' Returns (graph, reason). graph maps the names of function and of
+    the functions it refers to, transitively, to their fingerprints, like
+    Callgraph.graph. reason says why graph may be incomplete, or is None. '''
+    from callgraph import Callgraph
+    if not SUPPORTED:
+        return {}, 'Python %d.%d is not supported' % sys.version_info[:2]
+    function = unwrap(function)
+    graph = {Callgraph.name(function): registry.function_hash(function)}
+    reasons = []
+    methods = set()
+    classes = set()
+    pending = [function]
+    seen = set()
+    while pending:
+        func = pending.pop()
+        if func in seen:
+            continue
+        seen.add(func)
+        code = getattr(func, '__code__', None)
+        if code is None or excluded(func):
+            continue
+        if func is not function:
+            name = function_name(func)
+            fingerprint = registry.current_hash(name)
+            binding = registry.bindings.get(name)
+            if binding is None or unwrap(binding[2]) is not func:
+                reasons.append('%s is not bound under its name' % name)
+                continue
+            graph[name] = fingerprint
+        result = scan(code)
+        if result.dynamic:
+            reasons.append('%s %s' % (function_name(func), result.dynamic))
+        methods.update(result.methods)
+        closure = dict(zip(code.co_freevars, [cell.cell_contents for cell in
+                                              func.__closure__ or ()]))
+        for kind, names in result.chains:
+            if kind == 'global':
+                value = func.__globals__.get(names[0], MISSING)
+                if value is MISSING:
+                    value = getattr(builtins, names[0], MISSING)
+                    if names[0] in DYNAMIC_BUILTINS:
+                        reasons.append('%s calls %s()' % (function_name(func), names[0]))
+            else:
+                value = closure.get(names[0], MISSING)
+                if value is MISSING:
+                    # A variable of the enclosing function, or undefined.
+                    if kind == 'called' or len(names) > 1:
+                        reasons.append('%s calls %s, which is not in its closure' %
+                                       (function_name(func), names[0]))
+                    continue
+            for attribute in names[1:]:
+                if not isinstance(value, (types.ModuleType, type)):
+                    break
+                value = getattr(value, attribute, MISSING)
+            if value is MISSING:
+                reasons.append('%s refers to %s, which is not defined' %
+                               (function_name(func), '.'.join(names)))
+                continue
+            value = unwrap(value)
+            if isinstance(value, (functools.partial, functools.partialmethod)):
+                reasons.append('%s refers to %s, a partial object' %
+                               (function_name(func), '.'.join(names)))
+            elif isinstance(value, types.FunctionType):
+                pending.append(value)
+            elif not isinstance(value, (types.ModuleType, types.BuiltinFunctionType)):
+                cls = value if isinstance(value, type) else type(value)
+                if not excluded(cls):
+                    classes.add(cls)
+                    pending.extend(class_functions(cls))
+    known = set()
+    for cls in classes:
+        for base in cls.__mro__:
+            known.update(vars(base))
+    unknown = sorted(methods - known)
+    if unknown:
+        reasons.append('calls methods %s of objects of unknown class' % ', '.join(unknown))
+    return graph, '; '.join(reasons) or None
+
+
+class AnalysisTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        # Defined here rather than at module level, where they would count
+        # as pycache's own code, see TraceProcessor.is_internal().
+        global analysed_leaf, analysed_caller, AnalysedModel, analysed_model
+        global analysed_callback, analysed_method, analysed_update
+        global analysed_literals, analysed_closure, analysed_defaults
+        global analysed_partial, analysed_bound
+        def analysed_leaf(x):
+            return x + 1
+
+        def analysed_caller(x):
+            return [analysed_leaf(x), os.path.join('a', str(x)), len(str(x).split())]
+
+        class AnalysedModel(object):
+            def __init__(self, x):
+                self.x = analysed_leaf(x)
+            def value(self):
+                return self.x
+
+        def analysed_model(x):
+            return AnalysedModel(x).value()
+
+        def analysed_callback(f, x):
+            return f(x)
+
+        def analysed_method(fitter, x):
+            return fitter.fit(x)
+
+        def analysed_update(model, x):
+            return model.update(x)
+
+        def analysed_literals(x):
+            return ', '.join([str(x).strip(), '%s' % [x].count(x), f'{x}'.upper()])
+
+        def analysed_closure(x):
+            def inner():
+                return analysed_leaf(x)
+            return inner()
+
+        def analysed_defaults(x):
+            def inner(y=1):
+                return analysed_leaf(x) + y
+            return inner()
+
+        analysed_bound = functools.partial(analysed_leaf, 1)
+
+        def analysed_partial():
+            return analysed_bound()
+
+    def setUp(self):
+        if not SUPPORTED:
+            self.skipTest('Python < 3.11')
+
+    def names(self, function):
+        graph, reason = dependencies(function)
+        self.assertIsNone(reason)
+        return set(graph)
+
+    def prefix(self, name):
+        return name if __name__ == '__main__' else '%s.%s' % (__name__, name)
+
+    def test_transitive(self):
+        ''' Functions of the standard library are left out. '''
+        self.assertEqual(set(map(self.prefix, ['analysed_caller', 'analysed_leaf'])),
+                         self.names(analysed_caller))
+        graph, _ = dependencies(analysed_caller)
+        self.assertEqual(function_fingerprint(analysed_leaf),
+                         graph[self.prefix('analysed_leaf')])
+
+    def test_class(self):
+        self.assertEqual(set(map(self.prefix, [
+            'analysed_model', 'analysed_leaf', 'AnalysedModel.__init__',
+            'AnalysedModel.value'])), self.names(analysed_model))
+
+    def test_nested_code(self):
+        self.assertEqual(set(map(self.prefix, ['analysed_closure', 'analysed_leaf'])),
+                         self.names(analysed_closure))
+        self.assertEqual(set(map(self.prefix, ['analysed_defaults', 'analysed_leaf'])),
+                         self.names(analysed_defaults))
+
+    def test_dynamic(self):
+        self.assertIn('local variable f', dependencies(analysed_callback)[1])
+        self.assertIn('fit', dependencies(analysed_method)[1])
+
+    def test_builtin_methods(self):
+        ''' Methods named like those of builtin types are followed only on
+        literals and objects of builtin types. '''
+        self.assertIn('update', dependencies(analysed_update)[1])
+        self.assertEqual({self.prefix('analysed_literals')}, self.names(analysed_literals))
+
+    def test_partial(self):
+        ''' Not taken for the standard library's. '''
+        graph, reason = dependencies(analysed_partial)
+        self.assertIn('analysed_bound, a partial object', reason)
+        self.assertEqual({self.prefix('analysed_partial')}, set(graph))
+
+    def test_closure_not_bound(self):
+        def leaf(x):
+            return x
+        def caller(x):
+            return leaf(x)
+        self.assertIn('not bound', dependencies(caller)[1])
+
+    def test_memoized(self):
+        dependencies(analysed_caller)
+        self.assertIs(code_scans[analysed_caller.__code__], scan(analysed_caller.__code__))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,302 @@
+'''Performance measurements of the tracers, the caches and Callgraph.
+
+    python benchmark_cli.py --output results.json
+    python benchmark_cli.py --baseline results.json --tolerance 0.25
+
+Results are written as JSON: {'meta': {...}, 'results': {name: {'value':
+..., 'unit': ..., 'statistic': ...}}}, all values lower is better. Every
+value is the minimum ('min') or median ('median') of several repeats of
+its measurement, so that one slow run does not make a regression. With
+--baseline, every result also present in the baseline with the same
+statistic is compared with it, and the exit status is 1 if any is slower
+by more than the tolerance.
+
+Like the other modules, python benchmark.py runs the tests of this one.
+'''
+import argparse
+import json
+import os
+import platform
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+import types
+import unittest
+
+from cache import PickleCache, SqliteCache, TieredCache
+from callgraph import Callgraph
+from registry import registry
+from tracer import Tracer, HAS_MONITORING
+
+
+def leaf(x):
+    return x
+
+def shallow(n):
+    for i in range(n):
+        leaf(i)
+    return n
+
+def deep(depth):
+    if depth == 0:
+        return leaf(0)
+    return deep(depth - 1)
+
+def fib(n):
+    if n < 2:
+        return n
+    return fib(n - 1) + fib(n - 2)
+
+def fib_calls(n):
+    if n < 2:
+        return 1
+    return 1 + fib_calls(n - 1) + fib_calls(n - 2)
+
+
+def best_of(repeat, function, *args):
+    ''' Shortest of repeat timings of function(*args). '''
+    best = None
+    for i in range(repeat):
+        start = time.perf_counter()
+        function(*args)
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def percentiles(timings, points=(50, 90, 99)):
+    timings = sorted(timings)
+    return dict((point, timings[min(len(timings) - 1, len(timings) * point // 100)])
+                for point in points)
+
+
+class Suite(object):
+    ''' Runs the benchmarks, collecting results by name. quick shrinks all
+    sizes, e.g. for a smoke test. Each measurement is repeated repeat
+    times. '''
+
+    def __init__(self, quick=False, directory=None, repeat=5):
+        self.quick = quick
+        self.directory = directory or tempfile.mkdtemp(prefix='pycache-benchmark')
+        self.repeat = repeat
+        self.results = dict()
+
+    def record(self, name, value, unit='s', statistic='min'):
+        self.results[name] = {'value': value, 'unit': unit, 'statistic': statistic}
+
+    def run(self):
+        try:
+            self.tracer_overhead()
+            self.pickle_open_save()
+            self.cache_latency()
+            self.unchanged()
+        finally:
+            shutil.rmtree(self.directory, ignore_errors=True)
+        return self.results
+
+    def tracers(self):
+        tracers = [('sync', False, False), ('async', True, False)]
+        if HAS_MONITORING:
+            tracers.append(('monitoring', False, True))
+        return tracers
+
+    def tracer_overhead(self):
+        ''' Per call overhead of each tracer over the untraced run. '''
+        scale = 10 if self.quick else 1
+        workloads = [('shallow', shallow, 20000 // scale, 20000 // scale + 1),
+                     ('deep', deep, 500 // scale, 500 // scale + 2),
+                     ('recursive', fib, 18 - scale // 5, fib_calls(18 - scale // 5))]
+        limit = sys.getrecursionlimit()
+        sys.setrecursionlimit(max(limit, 2000))
+        try:
+            for workload, function, argument, calls in workloads:
+                baseline = best_of(self.repeat, function, argument)
+                for name, threaded, monitoring in self.tracers():
+                    def traced():
+                        with Tracer(None, threaded, monitoring):
+                            function(argument)
+                    elapsed = best_of(self.repeat, traced)
+                    self.record('tracer.%s.%s.per_call' % (name, workload),
+                                max(elapsed - baseline, 0.0) / calls)
+        finally:
+            sys.setrecursionlimit(limit)
+
+    def pickle_open_save(self):
+        ''' PickleCache save and open time by number of entries and payload,
+        the best of repeat caches. '''
+        callgraph = Callgraph()
+        callgraph.execute(leaf, 0)
+        code_hash = callgraph.graph[Callgraph.name(leaf)]
+        counts = [10, 100] if self.quick else [100, 1000, 10000]
+        payloads = [100, 10000] if self.quick else [100, 10000, 1000000]
+        for count in counts:
+            for payload in payloads:
+                if count * payload > 200 * 1000 * 1000:
+                    continue
+                value = b'x' * payload
+                saves, opens = [], []
+                for run in range(self.repeat):
+                    path = os.path.join(self.directory,
+                                        'open-%d-%d-%d.pickle' % (count, payload, run))
+                    cache = PickleCache({'file': path})
+                    for i in range(count):
+                        cache.add('leaf', code_hash, callgraph, (i,), {}, value)
+                    start = time.perf_counter()
+                    cache.save()
+                    saves.append(time.perf_counter() - start)
+                    del cache
+                    start = time.perf_counter()
+                    cache = PickleCache({'file': path})
+                    opens.append(time.perf_counter() - start)
+                    cache.save()
+                    del cache
+                self.record('pickle.save.%d_entries.%d_bytes' % (count, payload), min(saves))
+                self.record('pickle.open.%d_entries.%d_bytes' % (count, payload), min(opens))
+
+    def caches(self):
+        path = os.path.join(self.directory, 'latency')
+        return [('pickle', PickleCache({'file': path + '.pickle'})),
+                ('sqlite', SqliteCache({'file': path + '.sqlite'})),
+                ('tiered', TieredCache({'backend': PickleCache({'file': path + '-l2.pickle'}),
+                                        'l1_entries': 100000}))]
+
+    def cache_latency(self):
+        ''' Latency percentiles of add and get, the median of those of
+        repeat passes over count keys. '''
+        callgraph = Callgraph()
+        callgraph.execute(leaf, 0)
+        code_hash = callgraph.graph[Callgraph.name(leaf)]
+        count = 200 if self.quick else 5000
+        value = list(range(100))
+        for name, cache in self.caches():
+            adds, gets = [], []
+            for run in range(self.repeat):
+                keys = range(run * count, (run + 1) * count)
+                timings = []
+                for i in keys:
+                    start = time.perf_counter()
+                    cache.add('leaf', code_hash, callgraph, (i,), {}, value)
+                    timings.append(time.perf_counter() - start)
+                cache.save()
+                adds.append(percentiles(timings))
+                timings = []
+                for i in keys:
+                    start = time.perf_counter()
+                    cache.get('leaf', code_hash, (i,), {})
+                    timings.append(time.perf_counter() - start)
+                gets.append(percentiles(timings))
+                cache.save()
+            for operation, runs in (('add', adds), ('get', gets)):
+                for point in runs[0]:
+                    self.record('cache.%s.%s.p%d' % (name, operation, point),
+                                statistics.median([run[point] for run in runs]),
+                                statistic='median')
+
+    def unchanged(self):
+        ''' Callgraph.unchanged() by number of functions in the graph. '''
+        sizes = [1, 10, 100] if self.quick else [1, 10, 100, 1000]
+        module = types.ModuleType('benchmark_functions')
+        sys.modules[module.__name__] = module
+        try:
+            for size in sizes:
+                callgraph = Callgraph()
+                callgraph.graph = dict()
+                for i in range(size):
+                    name = 'function_%d' % i
+                    exec('def %s(x):\n    return x + %d\n' % (name, i), module.__dict__)
+                    qualified = '%s.%s' % (module.__name__, name)
+                    callgraph.graph[qualified] = registry.current_hash(qualified)
+                assert callgraph.unchanged()
+                repeat = max(10, 100000 // size) // (10 if self.quick else 1)
+                elapsed = best_of(self.repeat,
+                                  lambda: [callgraph.unchanged() for i in range(repeat)])
+                self.record('callgraph.unchanged.%d_functions' % size, elapsed / repeat)
+        finally:
+            del sys.modules[module.__name__]
+
+
+def metadata():
+    return {'python': platform.python_version(),
+            'implementation': platform.python_implementation(),
+            'platform': platform.platform(),
+            'monitoring': HAS_MONITORING,
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S')}
+
+
+def compare(results, baseline, tolerance):
+    ''' Returns (name, baseline value, value, ratio) of each result slower
+    than in baseline by more than tolerance (0.25 means 25%). Results whose
+    statistic differs from the baseline's are not compared. '''
+    regressions = []
+    for name, result in sorted(results.items()):
+        if name not in baseline:
+            continue
+        if baseline[name].get('statistic') != result.get('statistic'):
+            continue
+        before = baseline[name]['value']
+        value = result['value']
+        if before <= 0:
+            continue
+        ratio = value / before
+        if ratio > 1 + tolerance:
+            regressions.append((name, before, value, ratio))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--output', help='write results to this JSON file')
+    parser.add_argument('--baseline', help='compare with results in this JSON file')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help='allowed slowdown relative to the baseline (default 0.25)')
+    parser.add_argument('--quick', action='store_true', help='small sizes only')
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='repeats of each measurement (default 5)')
+    options = parser.parse_args(argv)
+
+    results = Suite(options.quick, repeat=options.repeat).run()
+    document = {'meta': metadata(), 'results': results}
+    for name, result in sorted(results.items()):
+        print('%-50s %12.3g %s' % (name, result['value'], result['unit']))
+    if options.output:
+        with open(options.output, 'w') as f:
+            json.dump(document, f, indent=2, sort_keys=True)
+    if options.baseline:
+        with open(options.baseline) as f:
+            baseline = json.load(f)['results']
+        regressions = compare(results, baseline, options.tolerance)
+        for name, before, value, ratio in regressions:
+            print('REGRESSION %s: %.3g -> %.3g (%.2fx)' % (name, before, value, ratio))
+        if regressions:
+            return 1
+    return 0
+
+
+class BenchmarkTest(unittest.TestCase):
+    def test_compare(self):
+        baseline = {'a': {'value': 1.0}, 'b': {'value': 2.0}, 'c': {'value': 0.0}}
+        results = {'a': {'value': 1.2}, 'b': {'value': 3.0}, 'c': {'value': 1.0},
+                   'd': {'value': 5.0}}
+        self.assertEqual([('b', 2.0, 3.0, 1.5)], compare(results, baseline, 0.25))
+        # Only the same statistic is compared.
+        baseline = {'a': {'value': 1.0, 'statistic': 'min'}}
+        results = {'a': {'value': 2.0, 'statistic': 'median'}}
+        self.assertEqual([], compare(results, baseline, 0.25))
+        results = {'a': {'value': 2.0, 'statistic': 'min'}}
+        self.assertEqual([('a', 1.0, 2.0, 2.0)], compare(results, baseline, 0.25))
+
+    def test_quick_suite(self):
+        results = Suite(quick=True).run()
+        self.assertIn('tracer.sync.recursive.per_call', results)
+        self.assertIn('cache.sqlite.get.p99', results)
+        self.assertIn('callgraph.unchanged.100_functions', results)
+        self.assertEqual('median', results['cache.sqlite.get.p99']['statistic'])
+        self.assertEqual('min', results['pickle.open.10_entries.100_bytes']['statistic'])
+        self.assertEqual([], compare(results, results, 0.0))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,12 @@
+'''Command line of the benchmarks in benchmark.py, see main() there.
+
+    python benchmark_cli.py --output results.json
+    python benchmark_cli.py --baseline results.json --tolerance 0.25
+'''
+import sys
+
+from benchmark import main
+
+
+if __name__ == '__main__':
+    sys.exit(main())
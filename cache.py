@@ -1,15 +1,222 @@
 import sqlite3 
+import atexit
 import datetime
+import hashlib
+import mmap
 import os
+import shutil
+import threading
+import time
 try:
     import cPickle as pickle
 except ImportError:
     import pickle
 import unittest
+import weakref
+from collections import OrderedDict
+
+from callgraph import Callgraph, exclude_files
+
+from admission import Admission
+from codec import get_codec
+from eviction import Evictor
+from fingerprint import default_fingerprinter
+from locking import FileLock
+from registry import registry
+from stats import Stats
+
+class Invalidated(KeyError):
+    ''' Raised by lookups that removed entries because code changed. '''
+    reason = None
+
+class CodeChanged(Invalidated):
+    ''' The function itself changed; all its entries were removed. '''
+    reason = 'code'
+
+class CallgraphChanged(Invalidated):
+    ''' A function in the callgraph of the entry changed. '''
+    reason = 'callgraph'
+
+
+def dependencies(callgraph):
+    ''' The functions in callgraph, as a dict of name to fingerprint. '''
+    graph = getattr(callgraph, 'graph', None)
+    return graph if isinstance(graph, dict) else {}
+
+def base_key(args_key):
+    ''' The args_key of the arguments of a versioned key, see versions. '''
+    return args_key.split('@', 1)[0]
+
 
 class Cache:
     def __init__(self, config):
-        pass
+        ''' config may set
+        'fingerprinter': an ArgumentFingerprinter used to key (args, kwargs).
+        'directory': where files of entries are kept, default config['file']
+            with '.d' appended.
+        'mmap_threshold': store pickle buffers (e.g. of NumPy arrays) of at
+            least this many bytes in files of their own and return them
+            memory-mapped read-only. None (default) keeps them in the pickle.
+        'codec': name of the codec (see codec.py) compressing pickled return
+            values. None (default) stores them uncompressed.
+        'function_codecs': dict of funcname to codec name, overriding 'codec'.
+        'codec_threshold': values smaller than this many bytes (default 4096)
+            are stored uncompressed.
+        'max_bytes', 'max_entries': capacity of the cache. Entries are
+            evicted according to 'eviction' ('lru' (default), 'lfu' or 'gds'
+            for GreedyDual-Size, using the recorded running time as cost).
+            The last use and hit count of each entry are saved with it, so
+            the order carries over to later sessions.
+        'function_limits': dict of funcname to a dict with 'max_bytes' and/or
+            'max_entries' for that function. See eviction.Evictor.
+        'lock_directory': where the lock files of key_lock() are kept,
+            default config['file'] with '.locks' appended.
+        'versions': number of code versions kept per function and
+            arguments, default 1. With more, entries are stored under
+            args_key@version, where the version identifies the code hash and
+            the callgraph, and lookups return the newest version valid for
+            the current code. Entries of other versions are not removed when
+            code changes, so switching back to earlier code hits them again;
+            adding a version beyond the limit removes the oldest.
+        'admission', 'function_admission': rules deciding whether computed
+            values are worth storing, for all functions and per funcname,
+            see admission.Admission and admit(). The lookup frequencies are
+            saved in the directory of entries, see save_admission().
+
+        Caches are not thread-safe themselves; threads sharing one hold
+        self.mutex while calling it, as decorator.cached does.
+
+        Lookups, invalidations and bytes read and written are counted per
+        function in self.stats, see stats.Stats.
+        '''
+        self.fingerprinter = config.get('fingerprinter', default_fingerprinter)
+        self.directory = config.get('directory', config['file'] + '.d')
+        self.mmap_threshold = config.get('mmap_threshold')
+        self.codec = config.get('codec')
+        self.function_codecs = config.get('function_codecs', {})
+        self.codec_threshold = config.get('codec_threshold', 4096)
+        get_codec(self.codec) # Fail early if not available
+        self.evictor = Evictor.from_config(config)
+        self.admission = Admission.from_config(config)
+        if self.admission is not None:
+            try:
+                with open(self.admission_path(), 'rb') as f:
+                    self.admission.restore(f.read())
+            except (IOError, OSError):
+                pass
+        self.lock_directory = config.get('lock_directory', config['file'] + '.locks')
+        self.versions = config.get('versions', 1)
+        # Reading entries is no dependency of the calls being recorded.
+        exclude_files([config['file'] + suffix
+                       for suffix in ('', '.lock', '.tmp', '-wal', '-shm', '-journal')],
+                      [self.directory, self.lock_directory])
+        self.mutex = threading.RLock()
+        self.stats = Stats()
+        # TieredCaches in front of this one, told of the entries evicted.
+        self.tiers = weakref.WeakSet()
+    def args_key(self, args, kwargs):
+        ''' Key of (args, kwargs), stable across interpreter runs. '''
+        return self.fingerprinter.fingerprint(args, kwargs)
+    def entry_name(self, funcname, args_key):
+        ''' Path of the files of an entry, relative to self.directory. '''
+        name = hashlib.blake2b(('%s\0%s' % (funcname, args_key)).encode(),
+                               digest_size=16).hexdigest()
+        return os.path.join(name[:2], name)
+    def key_lock(self, funcname, args_key):
+        ''' FileLock held by the process or thread computing the value of
+        funcname for args_key, so others wait for it instead of computing the
+        same value. Its file is removed on release. '''
+        return FileLock(os.path.join(self.lock_directory,
+                                     self.entry_name(funcname, args_key) + '.lock'),
+                        remove=True)
+    def value_path(self, name, suffix):
+        return os.path.join(self.directory, name + suffix)
+    def admission_path(self):
+        return os.path.join(self.directory, 'admission.pickle')
+    def save_admission(self):
+        ''' Writes the lookup frequencies of self.admission if they changed,
+        for later sessions. Part of save(). '''
+        if self.admission is not None and self.admission.sketch.changed:
+            self.replace_file(self.admission_path(),
+                              lambda f: f.write(self.admission.dumps()))
+            self.admission.sketch.changed = False
+    def replace_file(self, path, write):
+        ''' Calls write(f) on a temporary file which then atomically replaces
+        path. Readers that still map the old file keep seeing its contents. '''
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        with open(path + '.tmp', 'wb') as f:
+            write(f)
+        os.replace(path + '.tmp', path)
+    def dumps_value(self, value):
+        ''' Pickles value. Returns the pickle and the list of buffers which
+        were left out of it, see mmap_threshold. '''
+        if self.mmap_threshold is None:
+            return pickle.dumps(value, pickle.HIGHEST_PROTOCOL), []
+        buffers = []
+        def out_of_band(buf):
+            try:
+                raw = buf.raw()
+            except BufferError: # Not contiguous
+                return True
+            if raw.nbytes < self.mmap_threshold:
+                return True
+            buffers.append(raw)
+            return False
+        return pickle.dumps(value, 5, buffer_callback=out_of_band), buffers
+    def loads_value(self, data, name, count):
+        return pickle.loads(data, buffers=self.read_buffers(name, count))
+    def stored(self, funcname, args_key, size, runningtime, hits=0):
+        ''' Accounts for an entry of size bytes written to storage and evicts
+        entries if the capacity is exceeded. Entries found in storage are
+        accounted for in the order they were last used, see
+        Evictor.insert(). '''
+        if self.evictor is not None:
+            for victim in self.evictor.insert((funcname, args_key), size, runningtime, hits):
+                self.remove_entry(*victim)
+                for tier in list(self.tiers):
+                    tier.evicted(*victim)
+    def accessed(self, funcname, args_key):
+        if self.evictor is not None:
+            self.evictor.access((funcname, args_key))
+        if self.admission is not None:
+            self.admission.record((funcname, base_key(args_key)))
+    def removed(self, funcname, args_key):
+        if self.evictor is not None:
+            self.evictor.remove((funcname, args_key))
+    def compress(self, funcname, data):
+        ''' Compresses data with the codec configured for funcname. Returns
+        the name of the codec used, None if data was left as it is. '''
+        name = self.function_codecs.get(funcname, self.codec)
+        if name is None or len(data) < self.codec_threshold:
+            return None, data
+        compressed = get_codec(name).compress(data)
+        if len(compressed) >= len(data):
+            return None, data
+        return name, compressed
+    def decompress(self, name, data):
+        return get_codec(name).decompress(data)
+    def write_buffers(self, name, buffers):
+        for i, raw in enumerate(buffers):
+            self.replace_file(self.value_path(name, '.buf%d' % i),
+                              lambda f: f.write(raw))
+    def read_buffers(self, name, count):
+        views = []
+        for i in range(count):
+            with open(self.value_path(name, '.buf%d' % i), 'rb') as f:
+                if os.fstat(f.fileno()).st_size == 0:
+                    views.append(b'')
+                else:
+                    views.append(memoryview(mmap.mmap(f.fileno(), 0,
+                                                      access=mmap.ACCESS_READ)))
+        return views
+    def remove_buffers(self, name, count):
+        for i in range(count):
+            try:
+                os.remove(self.value_path(name, '.buf%d' % i))
+            except OSError:
+                pass
     def keys(self):
         ''' Generator yielding all keys present'''
         raise NotImplementedError
@@ -20,10 +227,39 @@ class Cache:
         and resulting return_values as well as the time it was called.
         (fname+args+kwargs) are used as primary key. 
         A change in code_hash indicates that the old value stored has to be invalidated.
+        The memory the call allocated (see Callgraph.memory) is stored as well.
         
         A previous entry with the same funcname but different code_hash or a change in '''
         raise NotImplementedError
-    def delete(self):
+    def admit(self, funcname, args, kwargs, return_values, runningtime):
+        ''' Whether return_values of funcname for (args, kwargs), computed in
+        runningtime seconds after a miss, are worth add()ing, as decided by
+        self.admission. Values that are not would only displace others, e.g.
+        of fast functions or arguments that are not looked up again.
+        Rejections are counted in self.stats. '''
+        if self.admission is None:
+            return True
+        args_key = self.args_key(args, kwargs)
+        sizes = []
+        def size():
+            if not sizes:
+                data, buffers = self.dumps_value(return_values)
+                sizes.append(len(data) + sum(buffer.nbytes for buffer in buffers))
+            return sizes[0]
+        victim = None
+        if self.evictor is not None:
+            victim = self.evictor.victim((funcname, args_key), size)
+            if victim is not None:
+                victim = (victim[0], base_key(victim[1]))
+        if self.admission.admit((funcname, args_key), runningtime, size, victim):
+            return True
+        self.stats.rejected(funcname)
+        return False
+    def delete(self, funcname):
+        ''' Remove all entries of function 'funcname'. '''
+        raise NotImplementedError
+    def remove_entry(self, funcname, args_key):
+        ''' Remove the entry of function 'funcname' for args_key. '''
         raise NotImplementedError
     def get(self, funcname, code_hash, args, kwargs):
         ''' Check for presence of cached value for given parameters.
@@ -33,98 +269,1238 @@ class Cache:
         self.callgraph and self.code_hash being checked for changes.
         :return: return_values if function has already been cached. Raises KeyError if no key could be found.
         '''
-        raise KeyError
+        return self.lookup(funcname, code_hash, args, kwargs)[1]
+    def lookup(self, funcname, code_hash, args, kwargs):
+        ''' Like get(), but returns (callgraph, return_values). Raises an
+        Invalidated KeyError if entries were removed because code changed. '''
+        return self.lookup_entry(funcname, code_hash, args, kwargs)[:2]
+    def lookup_entry(self, funcname, code_hash, args, kwargs):
+        ''' Like lookup(), but returns (callgraph, return_values,
+        runningtime). '''
+        start = time.perf_counter()
+        try:
+            entry = self.find(funcname, code_hash, args, kwargs)
+        except KeyError as error:
+            self.stats.miss(funcname, time.perf_counter() - start,
+                            getattr(error, 'reason', None))
+            raise
+        self.stats.hit(funcname, time.perf_counter() - start, entry[2])
+        return entry
+    def find(self, funcname, code_hash, args, kwargs):
+        ''' lookup_entry() without counting it in self.stats. '''
+        raise KeyError((funcname, args, kwargs))
+    def peek(self, funcname, code_hash, args, kwargs):
+        ''' Like lookup(), but only finds entries held in memory, so it never
+        does I/O. Misses are not counted, as a lookup() follows them. '''
+        raise KeyError((funcname, args, kwargs))
+    def lookup_many(self, funcname, code_hash, calls):
+        ''' lookup_entry() of each (args, kwargs) in calls. Returns a list
+        holding (callgraph, return_values, runningtime), or None if there is
+        no valid entry, per call. '''
+        results = []
+        for args, kwargs in calls:
+            try:
+                results.append(self.lookup_entry(funcname, code_hash, args, kwargs))
+            except KeyError:
+                results.append(None)
+        return results
+    def add_many(self, funcname, code_hash, entries):
+        ''' add() of each (callgraph, args, kwargs, return_values, runtime,
+        runningtime) in entries, then save(). '''
+        for callgraph, args, kwargs, return_values, runtime, runningtime in entries:
+            self.add(funcname, code_hash, callgraph, args, kwargs, return_values,
+                     runtime, runningtime)
+        self.save()
+    def save(self):
+        ''' Write pending changes to storage. '''
+        raise NotImplementedError
     def invalidate(self):
         ''' Invalidate the complete cache. '''
         raise NotImplementedError
+    def versioned_key(self, funcname, args_key, code_hash, callgraph):
+        ''' Key to add an entry under, see config['versions']. Removes the
+        oldest versions beyond the limit. '''
+        key = self.version_key(args_key, code_hash, callgraph)
+        if key == args_key:
+            return key
+        older = [other for other in self.version_keys(funcname, args_key) if other != key]
+        for other in older[:max(len(older) - self.versions + 1, 0)]:
+            self.remove_entry(funcname, other)
+        return key
+    def version_key(self, args_key, code_hash, callgraph):
+        ''' Key of the version of an entry for code_hash and callgraph. '''
+        if self.versions == 1:
+            return args_key
+        graph = getattr(callgraph, 'graph', None)
+        if isinstance(graph, dict):
+            graph = sorted(graph.items())
+        version = hashlib.blake2b(repr((code_hash, graph)).encode(),
+                                  digest_size=8).hexdigest()
+        return '%s@%s' % (args_key, version)
+    def version_keys(self, funcname, args_key):
+        ''' Keys of the stored versions of an entry, oldest first. '''
+        raise NotImplementedError
+    def newest_key(self, funcname, args_key):
+        ''' args_key, or the key of its newest version, see versions. '''
+        if self.versions > 1:
+            keys = self.version_keys(funcname, args_key)
+            if keys:
+                return keys[-1]
+        return args_key
+    def load_entry(self, funcname, args_key):
+        ''' (code_hash, callgraph, return_values, runningtime) of the entry
+        for args_key, of its newest version with versions. Unlike lookups,
+        it neither validates the entry nor counts as a use of it; for
+        prefetching. Raises KeyError if there is none. '''
+        raise NotImplementedError
+    def dependents(self, name):
+        ''' (funcname, args_key) of the entries whose callgraph includes the
+        function name, whichever its version. '''
+        keys = set()
+        for _, fingerprint in self.dependency_hashes([name]):
+            keys.update(self.hash_dependents(name, fingerprint))
+        return sorted(keys)
+    def sweep(self, names=None, versions=False):
+        ''' Removes the entries which depend on a function that has changed
+        since they were added, in all cached functions. Only the functions in
+        names are checked if given, e.g. those of an edited file. Returns the
+        (funcname, args_key) removed.
+
+        Unlike lookups, which only remove the entries they hit, this reclaims
+        the storage of every stale entry at the cost of checking each function
+        any entry depends on once. Entries kept for other code versions (see
+        config['versions']) stay unless versions is true.
+        '''
+        current_hash = registry.current_hash
+        stale = dict()
+        for name, fingerprint in self.dependency_hashes(names):
+            if fingerprint != str(current_hash(name)):
+                for key in self.hash_dependents(name, fingerprint):
+                    if not versions and key[1] != base_key(key[1]):
+                        continue
+                    if key[0] == name:
+                        stale[key] = 'code'
+                    else:
+                        stale.setdefault(key, 'callgraph')
+        removed = sorted(stale)
+        for funcname, args_key in removed:
+            self.remove_entry(funcname, args_key)
+            self.stats.invalidated(funcname, stale[funcname, args_key])
+        self.save()
+        return removed
+    def dependency_hashes(self, names):
+        ''' Yields (name, fingerprint) of each version of the functions in
+        names (all if None) that some entry depends on. Fingerprints are
+        strings. '''
+        raise NotImplementedError
+    def hash_dependents(self, name, fingerprint):
+        ''' (funcname, args_key) of the entries depending on the version
+        fingerprint of the function name. '''
+        raise NotImplementedError
 
 class SqliteCache(Cache):
+    ''' Cache stored in an SQLite database (config['file']).
+
+    Entries are looked up one at a time through the (funcname, args_key)
+    index, so opening the cache does not read any entries. The database runs
+    in WAL mode. Each write is committed when it is done, add_many() once for
+    all its entries, so no transaction stays open between writes. All
+    statements are constant strings, so the connection's statement cache
+    keeps them prepared.
+
+    Several processes may use the same database. A write waits up to
+    config['timeout'] seconds (default 60) for the write lock held by another
+    process's transaction.
+
+    Entries are keyed by the fingerprint of their arguments; the args and
+    kwargs columns are left empty.
+
+    The dependencies table indexes entries by the functions in their
+    callgraphs, for dependents() and sweep(). Databases written by earlier
+    versions are upgraded when opened, see migrate().
+    '''
+    CREATE = ('''CREATE TABLE IF NOT EXISTS cache (
+                  funcname TEXT NOT NULL,
+                  args_key TEXT NOT NULL,
+                  code_hash TEXT,
+                  callgraph BLOB,
+                  args BLOB,
+                  kwargs BLOB,
+                  return_values BLOB,
+                  runtime TEXT,
+                  runningtime REAL,
+                  buffers INTEGER DEFAULT 0,
+                  codec TEXT,
+                  size INTEGER,
+                  memory_peak INTEGER,
+                  memory_net INTEGER,
+                  hits INTEGER DEFAULT 0,
+                  used REAL)''',
+              '''CREATE UNIQUE INDEX IF NOT EXISTS cache_key
+                  ON cache (funcname, args_key)''',
+              '''CREATE TABLE IF NOT EXISTS dependencies (
+                  name TEXT NOT NULL,
+                  hash TEXT NOT NULL,
+                  funcname TEXT NOT NULL,
+                  args_key TEXT NOT NULL)''',
+              '''CREATE INDEX IF NOT EXISTS dependencies_name
+                  ON dependencies (name, hash)''',
+              '''CREATE INDEX IF NOT EXISTS dependencies_entry
+                  ON dependencies (funcname, args_key)''')
+    SCHEMA_VERSION = 3
+    SELECT = '''SELECT code_hash, callgraph, return_values, buffers, codec, runningtime
+                FROM cache WHERE funcname = ? AND args_key = ?'''
+    # Versioned keys of args_key lie between args_key@ and args_keyA.
+    SELECT_VERSIONS = '''SELECT args_key, code_hash, callgraph, return_values, buffers, codec,
+                         runningtime FROM cache WHERE funcname = ? AND args_key > ?
+                         AND args_key < ? ORDER BY rowid DESC'''
+    SELECT_VERSION_KEYS = '''SELECT args_key FROM cache WHERE funcname = ? AND args_key > ?
+                             AND args_key < ? ORDER BY rowid'''
+    SELECT_MANY_KEYS = 64
+    SELECT_MANY = ('''SELECT args_key, code_hash, callgraph, return_values, buffers, codec,
+                     runningtime FROM cache WHERE funcname = ? AND args_key IN (%s)''' %
+                   ', '.join(['?'] * SELECT_MANY_KEYS))
+    SELECT_BUFFERS = 'SELECT args_key, buffers FROM cache WHERE funcname = ?'
+    SELECT_ENTRY_BUFFERS = 'SELECT buffers FROM cache WHERE funcname = ? AND args_key = ?'
+    SELECT_SIZES = '''SELECT funcname, args_key, size, runningtime, hits FROM cache
+                      ORDER BY used, rowid'''
+    INSERT = '''INSERT OR REPLACE INTO cache
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, 0, ?)'''
+    UPDATE_USE = '''UPDATE cache SET hits = COALESCE(hits, 0) + ?, used = ?
+                    WHERE funcname = ? AND args_key = ?'''
+    UPDATE_CALLGRAPH = 'UPDATE cache SET callgraph = ? WHERE funcname = ? AND args_key = ?'
+    DELETE_ENTRY = 'DELETE FROM cache WHERE funcname = ? AND args_key = ?'
+    DELETE_FUNCTION = 'DELETE FROM cache WHERE funcname = ?'
+    KEYS = 'SELECT funcname, args_key FROM cache'
+    SELECT_CALLGRAPHS = 'SELECT funcname, args_key, callgraph FROM cache'
+    INSERT_DEPENDENCY = 'INSERT INTO dependencies VALUES (?, ?, ?, ?)'
+    DELETE_DEPENDENCIES = 'DELETE FROM dependencies WHERE funcname = ? AND args_key = ?'
+    DELETE_FUNCTION_DEPENDENCIES = 'DELETE FROM dependencies WHERE funcname = ?'
+    SELECT_DEPENDENCY_HASHES = 'SELECT DISTINCT name, hash FROM dependencies'
+    SELECT_NAME_HASHES = 'SELECT DISTINCT name, hash FROM dependencies WHERE name = ?'
+    SELECT_DEPENDENTS = '''SELECT DISTINCT funcname, args_key FROM dependencies
+                           WHERE name = ? AND hash = ?'''
+
     def __init__(self, config):
-        self.connection = sqlite3.connect(config.file)
-        c = self.connection.cursor()
-        
-        c.execute()
+        self.connection = None # Needed in case connecting fails.
+        Cache.__init__(self, config)
+        self.path = config['file']
+        # (funcname, args_key) -> [hits, last used] since the last save(),
+        # kept for the eviction order of later sessions.
+        self.uses = dict()
+        self.connection = sqlite3.connect(self.path, timeout=config.get('timeout', 60),
+                                          check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        for statement in self.CREATE:
+            self.connection.execute(statement)
+        version = self.connection.execute('PRAGMA user_version').fetchone()[0]
+        if version < self.SCHEMA_VERSION:
+            self.migrate(version)
+        self.connection.commit()
+        if self.evictor is not None:
+            for funcname, args_key, size, runningtime, hits in self.connection.execute(
+                    self.SELECT_SIZES).fetchall():
+                self.stored(funcname, args_key, size or 0, runningtime, hits or 0)
+
+    def migrate(self, version):
+        ''' Upgrades a database written by an earlier version. '''
+        columns = [row[1] for row in self.connection.execute('PRAGMA table_info(cache)')]
+        for column, kind in (('memory_peak', 'INTEGER'), ('memory_net', 'INTEGER'),
+                             ('hits', 'INTEGER DEFAULT 0'), ('used', 'REAL')):
+            if column not in columns:
+                self.connection.execute('ALTER TABLE cache ADD COLUMN %s %s' % (column, kind))
+        if version < 1:
+            self.index_dependencies()
+        self.connection.execute('PRAGMA user_version = %d' % self.SCHEMA_VERSION)
+
+    def index_dependencies(self):
+        self.connection.execute('DELETE FROM dependencies')
+        for funcname, args_key, callgraph in self.connection.execute(
+                self.SELECT_CALLGRAPHS).fetchall():
+            self.insert_dependencies(funcname, args_key, pickle.loads(callgraph))
+
+    def insert_dependencies(self, funcname, args_key, callgraph):
+        self.connection.executemany(self.INSERT_DEPENDENCY,
+                                    [(name, str(fingerprint), funcname, args_key)
+                                     for name, fingerprint in dependencies(callgraph).items()])
+
+    def keys(self):
+        for key in self.connection.execute(self.KEYS):
+            yield key
+
+    def add(self, funcname, code_hash, callgraph,
+            args, kwargs, return_values,
+            runtime=datetime.datetime.now(), runningtime = None):
+        self.insert(funcname, code_hash, callgraph, args, kwargs, return_values,
+                    runtime, runningtime)
+        self.save()
+
+    def add_many(self, funcname, code_hash, entries):
+        # One transaction for all of them.
+        for callgraph, args, kwargs, return_values, runtime, runningtime in entries:
+            self.insert(funcname, code_hash, callgraph, args, kwargs, return_values,
+                        runtime, runningtime)
+        self.save()
+
+    def insert(self, funcname, code_hash, callgraph,
+               args, kwargs, return_values, runtime, runningtime):
+        dump = pickle.dumps
+        protocol = pickle.HIGHEST_PROTOCOL
+        args_key = self.versioned_key(funcname, self.args_key(args, kwargs),
+                                      code_hash, callgraph)
+        data, buffers = self.dumps_value(return_values)
+        codec, data = self.compress(funcname, data)
+        if buffers:
+            self.write_buffers(self.entry_name(funcname, args_key), buffers)
+        row = (funcname, args_key, str(code_hash),
+               dump(callgraph, protocol), None, None, data,
+               runtime.isoformat(), runningtime, len(buffers), codec)
+        size = len(data) + sum(raw.nbytes for raw in buffers)
+        memory = getattr(callgraph, 'memory', None) or (None, None)
+        self.connection.execute(self.INSERT, row + (size,) + tuple(memory) + (time.time(),))
+        self.uses.pop((funcname, args_key), None)
+        self.connection.execute(self.DELETE_DEPENDENCIES, (funcname, args_key))
+        self.insert_dependencies(funcname, args_key, callgraph)
+        self.stats.written(funcname, size)
+        self.stored(funcname, args_key, size, runningtime)
+
+    def find(self, funcname, code_hash, args, kwargs):
+        args_key = self.args_key(args, kwargs)
+        if self.versions > 1:
+            return self.find_version(funcname, code_hash, args_key)
+        row = self.connection.execute(self.SELECT, (funcname, args_key)).fetchone()
+        if row is None:
+            raise KeyError((funcname, args, kwargs))
+        return self.check(funcname, code_hash, args, kwargs, args_key, row)
+
+    def find_version(self, funcname, code_hash, args_key):
+        ''' Newest stored version valid for the current code. Others are
+        kept. '''
+        for row in self.connection.execute(self.SELECT_VERSIONS,
+                                           (funcname, args_key + '@', args_key + 'A')).fetchall():
+            key, row = row[0], row[1:]
+            if row[0] != str(code_hash):
+                continue
+            callgraph = pickle.loads(row[1])
+            if callgraph.unchanged():
+                if callgraph.refreshed:
+                    self.store_callgraph(funcname, key, callgraph)
+                return self.load_row(funcname, key, callgraph, row)
+        raise KeyError((funcname, args_key))
+
+    def load_entry(self, funcname, args_key):
+        args_key = self.newest_key(funcname, args_key)
+        row = self.connection.execute(self.SELECT, (funcname, args_key)).fetchone()
+        if row is None:
+            raise KeyError((funcname, args_key))
+        code_hash, callgraph, return_values, buffers, codec, runningtime = row
+        self.stats.read(funcname, len(return_values))
+        return (code_hash, pickle.loads(callgraph),
+                self.loads_value(self.decompress(codec, return_values),
+                                 self.entry_name(funcname, args_key), buffers),
+                runningtime)
+
+    def version_keys(self, funcname, args_key):
+        return [row[0] for row in self.connection.execute(
+            self.SELECT_VERSION_KEYS, (funcname, args_key + '@', args_key + 'A'))]
+
+    def dependency_hashes(self, names):
+        if names is None:
+            return self.connection.execute(self.SELECT_DEPENDENCY_HASHES).fetchall()
+        return [row for name in names
+                for row in self.connection.execute(self.SELECT_NAME_HASHES, (name,))]
+
+    def hash_dependents(self, name, fingerprint):
+        return self.connection.execute(self.SELECT_DEPENDENTS, (name, fingerprint)).fetchall()
+
+    def lookup_many(self, funcname, code_hash, calls):
+        if self.versions > 1:
+            return Cache.lookup_many(self, funcname, code_hash, calls)
+        # Selects the rows of SELECT_MANY_KEYS keys at once. Shorter batches
+        # repeat the last key, so the statement stays the same.
+        started = time.perf_counter()
+        keys = [self.args_key(args, kwargs) for args, kwargs in calls]
+        rows = dict()
+        batch = self.SELECT_MANY_KEYS
+        for start in range(0, len(keys), batch):
+            chunk = keys[start:start + batch]
+            chunk += chunk[-1:] * (batch - len(chunk))
+            for row in self.connection.execute(self.SELECT_MANY, [funcname] + chunk):
+                rows[row[0]] = row[1:]
+        # The latency of each lookup is taken to be its share of the query.
+        latency = (time.perf_counter() - started) / max(len(calls), 1)
+        results = []
+        for (args, kwargs), args_key in zip(calls, keys):
+            row = rows.get(args_key)
+            if row is None:
+                self.stats.miss(funcname, latency)
+                results.append(None)
+                continue
+            try:
+                entry = self.check(funcname, code_hash, args, kwargs, args_key, row)
+            except Invalidated as error:
+                self.stats.miss(funcname, latency, error.reason)
+                results.append(None)
+                if isinstance(error, CodeChanged):
+                    # All entries of funcname are gone.
+                    rows.clear()
+                continue
+            self.stats.hit(funcname, latency, entry[2])
+            results.append(entry)
+        return results
+
+    def check(self, funcname, code_hash, args, kwargs, args_key, row):
+        ''' Validates a selected row, see lookup(). '''
+        stored_hash, callgraph, return_values, buffers, codec, runningtime = row
+        if stored_hash != str(code_hash):
+            self.delete(funcname) # Invalidate everything
+            raise CodeChanged('Function %s has changed. Cache invalidated.' %(funcname))
+        callgraph = pickle.loads(callgraph)
+        if not callgraph.unchanged():
+            self.remove_entry(funcname, args_key)
+            raise CallgraphChanged('Function %s has changed for arguments %s/%s. Cache invalidated for these inputs.' %(funcname, args, kwargs))
+        if callgraph.refreshed:
+            self.store_callgraph(funcname, args_key, callgraph)
+        return self.load_row(funcname, args_key, callgraph, row)
+
+    def store_callgraph(self, funcname, args_key, callgraph):
+        ''' Stores callgraph again, with the file states unchanged() refreshed,
+        so later lookups need not hash the files' contents. '''
+        callgraph.refreshed = False
+        self.connection.execute(self.UPDATE_CALLGRAPH, (
+            pickle.dumps(callgraph, pickle.HIGHEST_PROTOCOL), funcname, args_key))
+        self.save()
+
+    def load_row(self, funcname, args_key, callgraph, row):
+        _, _, return_values, buffers, codec, runningtime = row
+        self.accessed(funcname, args_key)
+        self.stats.read(funcname, len(return_values))
+        return (callgraph, self.loads_value(self.decompress(codec, return_values),
+                                            self.entry_name(funcname, args_key), buffers),
+                runningtime)
+
+    def delete(self, funcname):
+        for args_key, buffers in self.connection.execute(self.SELECT_BUFFERS, (funcname,)).fetchall():
+            self.remove_buffers(self.entry_name(funcname, args_key), buffers)
+            self.removed(funcname, args_key)
+        self.connection.execute(self.DELETE_FUNCTION, (funcname,))
+        self.connection.execute(self.DELETE_FUNCTION_DEPENDENCIES, (funcname,))
+        self.save()
+
+    def remove_entry(self, funcname, args_key):
+        row = self.connection.execute(self.SELECT_ENTRY_BUFFERS, (funcname, args_key)).fetchone()
+        if row is not None:
+            self.remove_buffers(self.entry_name(funcname, args_key), row[0])
+        self.connection.execute(self.DELETE_ENTRY, (funcname, args_key))
+        self.connection.execute(self.DELETE_DEPENDENCIES, (funcname, args_key))
+        self.removed(funcname, args_key)
+        self.save()
+
+    def invalidate(self):
+        self.connection.execute('DELETE FROM cache')
+        self.connection.execute('DELETE FROM dependencies')
+        shutil.rmtree(self.directory, ignore_errors=True)
+        if self.evictor is not None:
+            self.evictor.clear()
+        self.save()
+
+    def accessed(self, funcname, args_key):
+        Cache.accessed(self, funcname, args_key)
+        if self.evictor is not None:
+            use = self.uses.setdefault((funcname, args_key), [0, None])
+            use[0] += 1
+            use[1] = time.time()
+
+    def save(self):
+        if self.uses:
+            self.connection.executemany(self.UPDATE_USE, [
+                (hits, used, funcname, args_key)
+                for (funcname, args_key), (hits, used) in self.uses.items()])
+            self.uses.clear()
+        self.connection.commit()
+        self.save_admission()
+
+    def __del__(self):
+        if self.connection is not None:
+            try:
+                self.save()
+                self.connection.close()
+            except sqlite3.Error:
+                print("Could not save cache!")
 
 
 class PickleCache(Cache):
+    ''' Cache stored as a small index file (config['file']) plus one pickle
+    per return value in a directory sharded by entry (config['directory'],
+    default: the index file name with '.d' appended).
+
+    The index holds code hashes, callgraphs and timings only, so opening the
+    cache does not read any return values; get() reads them when needed.
+    save() writes the values of entries added since the last save and
+    appends the index entries changed since to the index file, so a save
+    costs the same however many entries the cache holds. The file is
+    rewritten whole once the appended changes outnumber its entries. A
+    cache written as one pickle by earlier versions is read as well and
+    converted on save().
+
+    Several processes may share the cache. save() holds a lock on the index
+    file while it merges the index other processes saved meanwhile with the
+    entries added and removed here, see merge(). A lookup that misses first
+    takes in entries other processes have saved since, reading only the
+    changes they appended.
+
+    The indexes of entries by dependency, for dependents() and sweep(), and
+    by version are built from the index when first needed.
+    '''
+    INDEX_FORMAT = ('pycache-index', 1)
+    # Changes appended before the index file is rewritten, at least.
+    JOURNAL_LENGTH = 100
+
     def __init__(self, config):
         self.picklepath = None # Needed in case config['file'] fails.
+        Cache.__init__(self, config)
         self.picklepath = config['file']
-        if os.path.exists(self.picklepath):
-            try:
-                f = open(self.picklepath, 'rb')
-                self.data = pickle.load(f)
-            except EOFError as e:
-                self.data = dict()
-            finally:
-                 f.close()
-        else:
-            self.data = dict()
+        self.index_lock = FileLock(self.picklepath + '.lock')
+        # (funcname, args_key) of entries whose values are held in memory.
+        self.unsaved = set()
+        self.dirty = False
+        # Changes since the index was last written, applied by merge() and
+        # appended to the index file by write_index().
+        self.updated_keys = set()
+        self.removed_keys = set()
+        self.deleted_functions = set()
+        self.cleared = False
+        # Identifies the version of the index file read or written last,
+        # where the changes read from it end (None if it can't be appended
+        # to) and how many changes it holds.
+        self.stamp = None
+        self.position = None
+        self.journal_length = 0
+        self.data = self.load_index()
+        # name -> fingerprint -> set of (funcname, args_key), and
+        # (funcname, args_key) -> versioned keys, see index_entries().
+        self.dependency_index = None
+        self.version_index = None
+        if self.evictor is not None:
+            self.load_sizes()
+        open_caches.add(self)
+
+    def load_sizes(self):
+        ''' Accounts for saved entries, least recently used first. '''
+        entries = [(last_used(entry), funcname, args_key, entry)
+                   for funcname, function_entries in self.data.items()
+                   for args_key, entry in function_entries.items() if 'size' in entry]
+        entries.sort(key=lambda item: item[0])
+        for _, funcname, args_key, entry in entries:
+            if args_key in self.data.get(funcname, {}):
+                self.stored(funcname, args_key, entry['size'], entry['howlong'],
+                            entry.get('hits', 0))
+
+    def accessed(self, funcname, args_key):
+        Cache.accessed(self, funcname, args_key)
+        if self.evictor is not None:
+            # Kept for the eviction order of later sessions, see load_sizes().
+            entry = self.data.get(funcname, {}).get(args_key)
+            if entry is not None:
+                entry['hits'] = entry.get('hits', 0) + 1
+                entry['used'] = time.time()
+                self.updated_keys.add((funcname, args_key))
+                self.dirty = True
+
+    def index_stamp(self):
+        try:
+            stat = os.stat(self.picklepath)
+        except OSError:
+            return None
+        return (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+
+    def read_index(self, position=0):
+        ''' Reads the index file from position on. Returns the index (None
+        unless read from the start), the changes appended to it, where they
+        end and the file's stamp. '''
+        try:
+            f = open(self.picklepath, 'rb')
+        except (IOError, OSError):
+            return None, [], None, None
+        with f:
+            stat = os.fstat(f.fileno())
+            stamp = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+            f.seek(position)
+            index = None
+            if position == 0:
+                try:
+                    index = pickle.load(f)
+                except EOFError:
+                    return None, [], None, stamp
+                position = f.tell()
+            changes = []
+            while True:
+                try:
+                    changes.append(pickle.load(f))
+                except Exception:
+                    # End of file, or a change still being appended.
+                    break
+                position = f.tell()
+            return index, changes, position, stamp
+
+    @staticmethod
+    def apply(data, change):
+        ''' Applies a change appended to the index file to data. '''
+        if change[0] == 'add':
+            data.setdefault(change[1], {})[change[2]] = change[3]
+        elif change[0] == 'remove':
+            data.get(change[1], {}).pop(change[2], None)
+        elif change[0] == 'delete':
+            data.pop(change[1], None)
+        elif change[0] == 'clear':
+            data.clear()
+
+    def load_index(self):
+        index, changes, position, self.stamp = self.read_index()
+        if index is None:
+            return dict()
+        if isinstance(index, tuple) and index[:2] == self.INDEX_FORMAT:
+            for change in changes:
+                self.apply(index[2], change)
+            self.position = position
+            self.journal_length = len(changes)
+            return index[2]
+        # Single pickle with the return values inline, converted on save().
+        for funcname, entries in index.items():
+            for args_key in entries:
+                self.unsaved.add((funcname, args_key))
+        self.dirty = True
+        return index
+
     def add(self, funcname, code_hash, callgraph,
             args, kwargs, return_values,
             runtime=datetime.datetime.now(), runningtime = None):
-        args_hash = hash((args, kwargs))
+        args_hash = self.versioned_key(funcname, self.args_key(args, kwargs),
+                                       code_hash, callgraph)
         if funcname not in self.data:
             self.data[funcname] = {}
-        self.data[funcname][args_hash] = {'hash': code_hash, 'callgraph': callgraph,
-                               'args': args, 'kwargs': kwargs, 'return_values': return_values,
-                               'when': runtime, 'howlong': runningtime}
-    def get(self, funcname, code_hash, args, kwargs):
+        elif args_hash in self.data[funcname]:
+            entry = self.data[funcname][args_hash]
+            self.remove_files(entry)
+            self.unindex_entry(funcname, args_hash, entry)
+            self.removed(funcname, args_hash)
+        entry = self.data[funcname][args_hash] = {
+            'hash': code_hash, 'callgraph': callgraph, 'return_values': return_values,
+            'when': runtime, 'howlong': runningtime, 'used': time.time(),
+            'memory': getattr(callgraph, 'memory', None)}
+        self.index_entry(funcname, args_hash, entry)
+        self.unsaved.add((funcname, args_hash))
+        self.updated_keys.add((funcname, args_hash))
+        self.dirty = True
+    def find(self, funcname, code_hash, args, kwargs):
         # TODO: Much of this should be in parent class, as it is generic. A class split into CacheInterface and CacheStorage would do.
-        args_hash = hash((args, kwargs))
-        cache = self.data[funcname][args_hash] # Raises KeyError if absent
+        args_hash = self.args_key(args, kwargs)
+        if self.versions > 1:
+            return self.find_version(funcname, code_hash, args_hash)
+        try:
+            cache = self.data[funcname][args_hash]
+        except KeyError:
+            if not self.refresh():
+                raise
+            cache = self.data[funcname][args_hash] # Raises KeyError if absent
         # Check function for changes and invalidate if necessary
         if cache['hash'] == code_hash and cache['callgraph'].unchanged():
-            return cache['return_values']
+            if cache['callgraph'].refreshed:
+                self.store_callgraph(funcname, args_hash, cache['callgraph'])
+            self.accessed(funcname, args_hash)
+            return (cache['callgraph'], self.load_value(funcname, args_hash, cache),
+                    cache['howlong'])
         elif cache['hash'] != code_hash:
-            del self.data[funcname] # Invalidate everything
-            raise KeyError('Function %s has changed. Cache invalidated.' %(funcname))
+            self.delete(funcname) # Invalidate everything
+            raise CodeChanged('Function %s has changed. Cache invalidated.' %(funcname))
         else: # Only invalidate for (args,kwargs) because callgraph is argument specific.
-            del self.data[funcname][args_hash]
-            raise KeyError('Function %s has changed for arguments %s/%s. Cache invalidated for these inputs.' %(funcname, args, kwargs))
+            self.remove_entry(funcname, args_hash)
+            raise CallgraphChanged('Function %s has changed for arguments %s/%s. Cache invalidated for these inputs.' %(funcname, args, kwargs))
+
+    def find_version(self, funcname, code_hash, args_key):
+        ''' Newest stored version valid for the current code. Others are
+        kept. '''
+        for refreshed in (False, True):
+            if refreshed and not self.refresh():
+                break
+            for key in reversed(self.version_keys(funcname, args_key)):
+                entry = self.data[funcname][key]
+                if entry['hash'] == code_hash and entry['callgraph'].unchanged():
+                    if entry['callgraph'].refreshed:
+                        self.store_callgraph(funcname, key, entry['callgraph'])
+                    self.accessed(funcname, key)
+                    return (entry['callgraph'], self.load_value(funcname, key, entry),
+                            entry['howlong'])
+        raise KeyError((funcname, args_key))
+
+    def store_callgraph(self, funcname, args_key, callgraph):
+        ''' Marks the entry for the index to be written, with the file states
+        callgraph.unchanged() refreshed. '''
+        callgraph.refreshed = False
+        self.updated_keys.add((funcname, args_key))
+        self.dirty = True
+
+    def index_entries(self):
+        self.dependency_index = dict()
+        self.version_index = dict()
+        for funcname, entries in self.data.items():
+            for args_key, entry in entries.items():
+                self.index_entry(funcname, args_key, entry)
+
+    def index_entry(self, funcname, args_key, entry):
+        if self.dependency_index is None:
+            return
+        for name, fingerprint in dependencies(entry['callgraph']).items():
+            self.dependency_index.setdefault(name, {}).setdefault(
+                str(fingerprint), set()).add((funcname, args_key))
+        if '@' in args_key:
+            self.version_index.setdefault((funcname, base_key(args_key)), []).append(args_key)
+
+    def unindex_entry(self, funcname, args_key, entry):
+        if self.dependency_index is None:
+            return
+        for name, fingerprint in dependencies(entry['callgraph']).items():
+            self.dependency_index[name][str(fingerprint)].discard((funcname, args_key))
+        if '@' in args_key:
+            self.version_index[funcname, base_key(args_key)].remove(args_key)
+
+    def load_entry(self, funcname, args_key):
+        args_key = self.newest_key(funcname, args_key)
+        entry = self.data[funcname][args_key]
+        return (entry['hash'], entry['callgraph'],
+                self.load_value(funcname, args_key, entry), entry['howlong'])
+
+    def version_keys(self, funcname, args_key):
+        if self.version_index is None:
+            self.index_entries()
+        return self.version_index.get((funcname, args_key), [])
+
+    def dependency_hashes(self, names):
+        if self.dependency_index is None:
+            self.index_entries()
+        if names is None:
+            names = list(self.dependency_index)
+        return [(name, fingerprint) for name in names
+                for fingerprint, keys in self.dependency_index.get(name, {}).items() if keys]
+
+    def hash_dependents(self, name, fingerprint):
+        return list(self.dependency_index.get(name, {}).get(fingerprint, ()))
+
+    def load_value(self, funcname, args_key, entry):
+        if 'return_values' in entry:
+            return entry['return_values']
+        try:
+            with open(self.value_path(entry['value'], '.pickle'), 'rb') as f:
+                data = f.read()
+            self.stats.read(funcname, len(data))
+            data = self.decompress(entry.get('codec'), data)
+            return self.loads_value(data, entry['value'], entry.get('buffers', 0))
+        except (IOError, EOFError):
+            self.remove_entry(funcname, args_key)
+            raise KeyError('Value of %s for key %s is missing.' % (funcname, args_key))
+
+    def keys(self):
+        for funcname, entries in self.data.items():
+            for args_key in entries:
+                yield funcname, args_key
+
+    def delete(self, funcname):
+        for args_key, entry in self.data.pop(funcname, {}).items():
+            self.remove_files(entry)
+            self.unindex_entry(funcname, args_key, entry)
+            self.removed(funcname, args_key)
+            self.unsaved.discard((funcname, args_key))
+            self.updated_keys.discard((funcname, args_key))
+        self.deleted_functions.add(funcname)
+        self.dirty = True
+
+    def remove_entry(self, funcname, args_key):
+        entry = self.data[funcname].pop(args_key)
+        self.remove_files(entry)
+        self.unindex_entry(funcname, args_key, entry)
+        self.removed(funcname, args_key)
+        self.unsaved.discard((funcname, args_key))
+        self.updated_keys.discard((funcname, args_key))
+        self.removed_keys.add((funcname, args_key))
+        self.dirty = True
+
+    def invalidate(self):
+        self.data = dict()
+        self.dependency_index = self.version_index = None
+        self.unsaved.clear()
+        self.updated_keys.clear()
+        shutil.rmtree(self.directory, ignore_errors=True)
+        if self.evictor is not None:
+            self.evictor.clear()
+        self.cleared = True
+        self.dirty = True
+
+    def refresh(self):
+        ''' Takes in the entries other processes have saved since the index
+        was last read or written. Returns False if there were none. '''
+        current = self.index_stamp()
+        if current == self.stamp:
+            return False
+        if (self.position is not None and current is not None
+                and current[0] == self.stamp[0]):
+            # Same file, others appended changes to it.
+            _, changes, position, stamp = self.read_index(self.position)
+            if stamp is not None and stamp[0] == self.stamp[0]:
+                for change in changes:
+                    self.take_in(change)
+                self.position = position
+                self.journal_length += len(changes)
+                self.stamp = stamp
+                return bool(changes)
+        index, changes, position, stamp = self.read_index()
+        if not (isinstance(index, tuple) and index[:2] == self.INDEX_FORMAT):
+            return False
+        for change in changes:
+            self.apply(index[2], change)
+        self.merge(index[2])
+        self.stamp = stamp
+        self.position = position
+        self.journal_length = len(changes)
+        return True
+
+    def take_in(self, change):
+        ''' Applies a change another process appended to the index file like
+        merge() does its index. '''
+        if change[0] == 'clear':
+            keys = list(self.keys())
+        elif change[0] == 'delete':
+            keys = [(change[1], args_key) for args_key in self.data.get(change[1], {})]
+        else:
+            keys = [tuple(change[1:3])]
+        for key in keys:
+            if key in self.updated_keys or key in self.unsaved:
+                continue
+            funcname, args_key = key
+            entry = self.data.get(funcname, {}).pop(args_key, None)
+            if entry is not None:
+                self.unindex_entry(funcname, args_key, entry)
+                self.removed(funcname, args_key)
+        if change[0] == 'add':
+            funcname, args_key, entry = change[1:]
+            if (self.cleared or funcname in self.deleted_functions
+                    or (funcname, args_key) in self.removed_keys
+                    or (funcname, args_key) in self.updated_keys
+                    or (funcname, args_key) in self.unsaved):
+                return
+            self.data.setdefault(funcname, {})[args_key] = entry
+            self.index_entry(funcname, args_key, entry)
+            if 'size' in entry:
+                self.stored(funcname, args_key, entry['size'], entry['howlong'],
+                            entry.get('hits', 0))
+
+    def merge(self, index):
+        ''' Replaces the entries by those of index, an index saved by another
+        process, except that entries added here since the last save are kept
+        and entries removed here stay removed. '''
+        if self.cleared:
+            index = dict()
+        for funcname in self.deleted_functions:
+            index.pop(funcname, None)
+        for funcname, args_key in self.removed_keys:
+            index.get(funcname, {}).pop(args_key, None)
+        for funcname, args_key in self.unsaved | self.updated_keys:
+            entry = self.data[funcname][args_key]
+            index.setdefault(funcname, {})[args_key] = entry
+        self.data = index
+        self.dependency_index = self.version_index = None
+        if self.evictor is not None:
+            self.evictor.clear()
+            self.load_sizes()
+
+    def remove_files(self, entry):
+        if 'value' in entry:
+            # .args files were written by earlier versions.
+            for suffix in ('.pickle', '.args'):
+                try:
+                    os.remove(self.value_path(entry['value'], suffix))
+                except OSError:
+                    pass
+            self.remove_buffers(entry['value'], entry.get('buffers', 0))
+
+    def write_file(self, path, obj):
+        ''' Pickles obj to path, replacing it atomically. '''
+        self.replace_file(path, lambda f: pickle.dump(obj, f, pickle.HIGHEST_PROTOCOL))
 
     def save(self):
-        with open(self.picklepath, 'wb') as f:
-            pickle.dump(self.data, f, pickle.HIGHEST_PROTOCOL)
+        self.save_admission()
+        if not (self.dirty or self.unsaved):
+            return
+        with self.index_lock:
+            self.refresh()
+            self.save_entries()
+
+    def save_entries(self):
+        for funcname, args_key in list(self.unsaved):
+            entry = self.data.get(funcname, {}).get(args_key)
+            if entry is None or 'return_values' not in entry:
+                continue
+            name = self.entry_name(funcname, args_key)
+            data, buffers = self.dumps_value(entry['return_values'])
+            codec, data = self.compress(funcname, data)
+            self.write_buffers(name, buffers)
+            self.replace_file(self.value_path(name, '.pickle'),
+                              lambda f: f.write(data))
+            del entry['return_values']
+            # Held by entries of caches written by earlier versions.
+            entry.pop('args', None)
+            entry.pop('kwargs', None)
+            entry['value'] = name
+            entry['buffers'] = len(buffers)
+            entry['codec'] = codec
+            entry['size'] = len(data) + sum(raw.nbytes for raw in buffers)
+            self.stats.written(funcname, entry['size'])
+            self.stored(funcname, args_key, entry['size'], entry['howlong'])
+        self.unsaved.clear()
+        if self.dirty:
+            self.write_index()
+            self.dirty = False
+            self.updated_keys.clear()
+            self.removed_keys.clear()
+            self.deleted_functions.clear()
+            self.cleared = False
+
+    def write_index(self):
+        ''' Appends the changes made since the index file was last written to
+        it. Rewrites it if it can't be appended to or would hold more
+        changes than entries. Called with index_lock held. '''
+        changes = []
+        if self.cleared:
+            changes.append(('clear',))
+        changes.extend(('delete', funcname) for funcname in self.deleted_functions)
+        changes.extend(('remove', funcname, args_key)
+                       for funcname, args_key in self.removed_keys)
+        for funcname, args_key in self.updated_keys:
+            entry = self.data.get(funcname, {}).get(args_key)
+            if entry is not None:
+                changes.append(('add', funcname, args_key, entry))
+        entries = sum(len(entries) for entries in self.data.values())
+        if (self.position is None or self.index_stamp() != self.stamp or
+                self.journal_length + len(changes) > max(self.JOURNAL_LENGTH, entries)):
+            self.write_file(self.picklepath, self.INDEX_FORMAT + (self.data,))
+            self.stamp = self.index_stamp()
+            self.position = self.stamp[2]
+            self.journal_length = 0
+            return
+        data = b''.join(pickle.dumps(change, pickle.HIGHEST_PROTOCOL) for change in changes)
+        with open(self.picklepath, 'r+b') as f:
+            # Drops what a process that failed while appending left behind.
+            f.seek(self.position)
+            f.write(data)
+            f.truncate()
+        self.position += len(data)
+        self.journal_length += len(changes)
+        self.stamp = self.index_stamp()
 
     def __del__(self):
         # TODO: __del__ parent
+        if self.picklepath is None:
+            return
         try:
             self.save()
         except IOError:
             print("Could not save cache!")
 
+# PickleCaches still in use. They are saved at exit, as __del__ may only run
+# when the modules save() needs have been torn down.
+open_caches = weakref.WeakSet()
+
+def last_used(entry):
+    ''' When a PickleCache entry was last used or else added, in seconds
+    since the epoch. '''
+    if 'used' in entry:
+        return entry['used']
+    when = entry.get('when')
+    return when.timestamp() if when is not None else 0.0
+
+
+def save_open_caches():
+    for cache in list(open_caches):
+        try:
+            cache.save()
+        except IOError:
+            print("Could not save cache!")
+
+atexit.register(save_open_caches)
+
+
+class TieredCache(Cache):
+    ''' In-memory tier (L1) in front of another cache (L2, config['backend']).
+
+    L1 keeps the live return values of up to config['l1_entries'] (default
+    128) recently used entries, so an L1 hit skips reading and unpickling.
+    Code hash and callgraph are still checked on every hit. L2 hits are
+    promoted into L1 and writes go through to L2. Hits and misses of both
+    tiers are counted in self.counters. self.stats counts lookups of both
+    tiers together, the backend's stats those that reached L2.
+
+    Values returned from L1 are the same objects on every hit; callers must
+    not modify them. Other attributes, e.g. evictor, are the backend's. L1
+    hits count as accesses for it, and entries it evicts leave L1.
+
+    With config['warmup'], the path of a file, the keys looked up are
+    recorded in order, up to config['warmup_entries'] (default l1_entries)
+    of them, and written to that file on save(). When the cache is opened
+    again, a background thread (self.prefetcher) loads the entries recorded
+    by the previous session from L2 into L1 in the same order, until L1 is
+    full, so a rerun making the same calls finds them in memory. Prefetched
+    entries are validated when hit, like any other; the number loaded is
+    counted in self.counters['prefetched'].
+    '''
+    def __init__(self, config):
+        self.backend = config['backend']
+        self.backend.tiers.add(self)
+        self.admission = self.backend.admission
+        self.l1_entries = config.get('l1_entries', 128)
+        self.l1 = OrderedDict()
+        self.counters = {'l1_hits': 0, 'l1_misses': 0, 'l2_hits': 0, 'l2_misses': 0,
+                         'prefetched': 0}
+        self.stats = Stats()
+        self.warmup = config.get('warmup')
+        self.warmup_entries = config.get('warmup_entries', self.l1_entries)
+        # Keys looked up this session, in order, and how many were written.
+        self.sequence = OrderedDict()
+        self.sequence_saved = 0
+        self.prefetcher = None
+        if self.warmup is not None:
+            keys = self.read_sequence()
+            if keys:
+                self.prefetcher = threading.Thread(target=self.prefetch, args=(keys,),
+                                                   name='pycache-prefetch', daemon=True)
+                self.prefetcher.start()
+            open_caches.add(self)
+
+    def __getattr__(self, name):
+        if name == 'backend': # Not set yet
+            raise AttributeError(name)
+        return getattr(self.backend, name)
+
+    def args_key(self, args, kwargs):
+        return self.backend.fingerprinter.fingerprint(args, kwargs)
+
+    def keys(self):
+        return self.backend.keys()
+
+    def add(self, funcname, code_hash, callgraph,
+            args, kwargs, return_values,
+            runtime=datetime.datetime.now(), runningtime = None):
+        self.backend.add(funcname, code_hash, callgraph, args, kwargs,
+                         return_values, runtime, runningtime)
+        self.promote((funcname, self.args_key(args, kwargs)),
+                     (code_hash, callgraph, return_values, runningtime))
+
+    def peek_entry(self, funcname, code_hash, args, kwargs):
+        ''' Returns (callgraph, return_values, runningtime) from L1. '''
+        key = (funcname, self.args_key(args, kwargs))
+        if (self.warmup is not None and key not in self.sequence and
+                len(self.sequence) < self.warmup_entries):
+            self.sequence[key] = None
+        entry = self.l1.get(key)
+        if entry is None:
+            raise KeyError(key)
+        if entry[0] == code_hash and entry[1].unchanged() and not entry[1].refreshed:
+            self.l1.move_to_end(key)
+            self.counters['l1_hits'] += 1
+            # Counts for L2's eviction and admission like an L2 hit.
+            backend = self.backend
+            if backend.evictor is not None or backend.admission is not None:
+                backend.accessed(funcname, backend.version_key(key[1], code_hash, entry[1]))
+            return entry[1:]
+        # Let L2 invalidate the entry, or store its refreshed callgraph.
+        del self.l1[key]
+        raise KeyError(key)
+
+    def peek(self, funcname, code_hash, args, kwargs):
+        start = time.perf_counter()
+        entry = self.peek_entry(funcname, code_hash, args, kwargs)
+        self.stats.hit(funcname, time.perf_counter() - start, entry[2])
+        return entry[:2]
+
+    def find(self, funcname, code_hash, args, kwargs):
+        try:
+            return self.peek_entry(funcname, code_hash, args, kwargs)
+        except KeyError:
+            pass
+        key = (funcname, self.args_key(args, kwargs))
+        self.counters['l1_misses'] += 1
+        try:
+            entry = self.backend.lookup_entry(funcname, code_hash, args, kwargs)
+        except KeyError:
+            self.counters['l2_misses'] += 1
+            raise
+        self.counters['l2_hits'] += 1
+        self.promote(key, (code_hash,) + tuple(entry))
+        return entry
+
+    def lookup_many(self, funcname, code_hash, calls):
+        results = []
+        missing = []
+        for i, (args, kwargs) in enumerate(calls):
+            start = time.perf_counter()
+            try:
+                entry = self.peek_entry(funcname, code_hash, args, kwargs)
+            except KeyError:
+                results.append(None)
+                missing.append(i)
+                continue
+            self.stats.hit(funcname, time.perf_counter() - start, entry[2])
+            results.append(entry)
+        self.counters['l1_misses'] += len(missing)
+        start = time.perf_counter()
+        found = self.backend.lookup_many(funcname, code_hash,
+                                         [calls[i] for i in missing])
+        latency = (time.perf_counter() - start) / max(len(missing), 1)
+        for i, entry in zip(missing, found):
+            if entry is None:
+                self.counters['l2_misses'] += 1
+                self.stats.miss(funcname, latency)
+                continue
+            self.counters['l2_hits'] += 1
+            self.stats.hit(funcname, latency, entry[2])
+            args, kwargs = calls[i]
+            self.promote((funcname, self.args_key(args, kwargs)),
+                         (code_hash,) + tuple(entry))
+            results[i] = entry
+        return results
+
+    def add_many(self, funcname, code_hash, entries):
+        self.backend.add_many(funcname, code_hash, entries)
+        for callgraph, args, kwargs, return_values, runtime, runningtime in entries:
+            self.promote((funcname, self.args_key(args, kwargs)),
+                         (code_hash, callgraph, return_values, runningtime))
+
+    def promote(self, key, entry):
+        self.l1[key] = entry
+        self.l1.move_to_end(key)
+        while len(self.l1) > self.l1_entries:
+            self.l1.popitem(last=False)
+
+    def evicted(self, funcname, args_key):
+        ''' Drops the L1 copy of an entry L2 evicted. '''
+        self.l1.pop((funcname, base_key(args_key)), None)
+
+    def delete(self, funcname):
+        for key in [key for key in self.l1 if key[0] == funcname]:
+            del self.l1[key]
+        self.backend.delete(funcname)
+
+    def remove_entry(self, funcname, args_key):
+        # L1 holds versioned entries under the key of their arguments.
+        self.l1.pop((funcname, base_key(args_key)), None)
+        self.backend.remove_entry(funcname, args_key)
+
+    def load_entry(self, funcname, args_key):
+        return self.backend.load_entry(funcname, args_key)
+
+    def dependents(self, name):
+        return self.backend.dependents(name)
+
+    def sweep(self, names=None, versions=False):
+        removed = self.backend.sweep(names, versions)
+        for funcname, args_key in removed:
+            self.l1.pop((funcname, base_key(args_key)), None)
+        return removed
+
+    def invalidate(self):
+        self.l1.clear()
+        self.backend.invalidate()
+
+    def save(self):
+        self.backend.save()
+        if self.warmup is not None and len(self.sequence) != self.sequence_saved:
+            keys = list(self.sequence)
+            self.replace_file(self.warmup, lambda f: pickle.dump(keys, f, pickle.HIGHEST_PROTOCOL))
+            self.sequence_saved = len(keys)
+
+    def read_sequence(self):
+        ''' Keys recorded in the warmup file by the previous session. '''
+        try:
+            with open(self.warmup, 'rb') as f:
+                return pickle.load(f)
+        except (IOError, OSError, EOFError, pickle.UnpicklingError):
+            return []
+
+    def prefetch(self, keys):
+        ''' Loads the entries of keys into L1, holding self.mutex for one
+        entry at a time so lookups are not held up for long. '''
+        for key in keys:
+            with self.mutex:
+                if len(self.l1) >= self.l1_entries:
+                    break
+                if key in self.l1:
+                    continue
+                try:
+                    entry = self.backend.load_entry(*key)
+                except KeyError:
+                    continue
+                # Behind the entries in use, the ones needed first evicted last.
+                self.l1[key] = entry
+                self.l1.move_to_end(key, last=False)
+                self.counters['prefetched'] += 1
+
+
 class MockCallgraph:
+        refreshed = False
         def __init__(self, graph):
             self.graph = graph
             self.change_flag = False
+            self.touched = False
         def __eq__(self, other):
             return self.graph == other.graph
         def __ne__(self, other):
             return not self == other
         def __getstate__(self):
-            return (self.graph, self.change_flag)
+            return (self.graph, self.change_flag, self.touched)
         def __setstate__(self,state):
             self.graph = state[0]
             self.change_flag = state[1]
+            self.touched = state[2]
         def unchanged(self):
+            if self.touched:
+                # As Callgraph.files_unchanged() after a file was touched.
+                self.touched = False
+                self.refreshed = True
             return not self.change_flag
 
+class Blob:
+    ''' Pickles its data as an out-of-band buffer (protocol 5). '''
+    def __init__(self, data):
+        self.data = data
+    def __reduce_ex__(self, protocol):
+        return (Blob, (pickle.PickleBuffer(self.data),))
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 def funcA(x):
     return x
 
 def funcB(x):
     return 2*x
 
+def function_graph(*functions):
+    ''' MockCallgraph of functions with their current fingerprints. '''
+    names = [Callgraph.name(func) for func in functions]
+    return MockCallgraph(dict((name, registry.current_hash(name)) for name in names))
+
 class TestPickleCache(unittest.TestCase):
     def setUp(self):
         fname = 'cache.pickle'
         if os.path.exists(fname):
             os.remove(fname)
+        shutil.rmtree(fname + '.d', ignore_errors=True)
         config = {'file': fname}
         self.return_values = 5
         self.callgraph = MockCallgraph('original')
-        self.uut = PickleCache(config)
+        self.config = config
+        self.uut = self.make_cache(config)
         self.args = None
         self.kwargs = None
         self.uut.add(funcname='myfunc', code_hash=123, callgraph=self.callgraph, 
@@ -133,6 +1509,8 @@ class TestPickleCache(unittest.TestCase):
     def tearDown(self):
         #del self.uut
         pass
+    def make_cache(self, config):
+        return PickleCache(config)
     def test_compare_code_hash(self):
         self.assertEqual(self.return_values, self.uut.get(funcname='myfunc',
                                              code_hash=123, args=self.args,
@@ -157,18 +1535,572 @@ class TestPickleCache(unittest.TestCase):
     def test_args(self):
         with self.assertRaises(KeyError):
             self.uut.get('myfunc', 123, 'args', self.kwargs)
+    def test_load_entry(self):
+        self.uut.save()
+        args_key = self.uut.args_key(self.args, self.kwargs)
+        code_hash, callgraph, value, runningtime = self.uut.load_entry('myfunc', args_key)
+        self.assertEqual(('123', 5), (str(code_hash), value))
+        with self.assertRaises(KeyError):
+            self.uut.load_entry('notmyfunc', args_key)
     def test_kwargs(self):
         with self.assertRaises(KeyError):
             self.uut.get('myfunc', 123, self.args, 'kwargs')
+    def test_unhashable_args(self):
+        args = ([1, 2], {'a': bytearray(b'xyz')})
+        self.uut.add('myfunc', 123, self.callgraph, args, {}, 7)
+        self.assertEqual(7, self.uut.get('myfunc', 123, ([1, 2], {'a': bytearray(b'xyz')}), {}))
+        with self.assertRaises(KeyError):
+            self.uut.get('myfunc', 123, ([1, 2], {'a': bytearray(b'xyy')}), {})
+    def test_refreshed_callgraph_stored(self):
+        ''' A callgraph whose file states a hit refreshed is stored again. '''
+        callgraph = MockCallgraph('touched')
+        callgraph.touched = True
+        self.uut.add('f', 1, callgraph, (1,), {}, 'one')
+        self.uut.save()
+        self.assertEqual('one', self.uut.get('f', 1, (1,), {}))
+        self.uut.save()
+        stored = self.make_cache(self.config).load_entry('f', self.uut.args_key((1,), {}))
+        self.assertFalse(stored[1].touched)
+        self.assertFalse(stored[1].refreshed)
     def test_load_from_disk(self):
         config = {'file': self.uut.picklepath}
         del self.uut
         new_cache = PickleCache(config)
         self.assertEqual(self.return_values, new_cache.get('myfunc', 123, self.args, self.kwargs))
         self.uut = new_cache
+    def test_keys(self):
+        self.uut.add('otherfunc', 1, self.callgraph, (1,), {}, 2)
+        self.assertEqual(set(['myfunc', 'otherfunc']),
+                         set(funcname for funcname, _ in self.uut.keys()))
+    def test_delete(self):
+        self.uut.add('otherfunc', 1, self.callgraph, (1,), {}, 2)
+        self.uut.delete('myfunc')
+        with self.assertRaises(KeyError):
+            self.uut.get('myfunc', 123, self.args, self.kwargs)
+        self.assertEqual(2, self.uut.get('otherfunc', 1, (1,), {}))
+    def test_invalidate(self):
+        self.uut.invalidate()
+        self.assertEqual([], list(self.uut.keys()))
+    def test_out_of_band_buffers(self):
+        config = dict(self.config, file='oob_' + self.config['file'], mmap_threshold=64)
+        shutil.rmtree(config['file'] + '.d', ignore_errors=True)
+        cache = self.make_cache(config)
+        cache.invalidate()
+        value = {'big': Blob(bytearray(range(256)) * 4), 'small': Blob(bytearray(8))}
+        cache.add('f', 1, self.callgraph, (1,), {}, value)
+        cache.save()
+        loaded = cache.get('f', 1, (1,), {})
+        self.assertIsInstance(loaded['big'].data, memoryview)
+        self.assertTrue(loaded['big'].data.readonly)
+        self.assertEqual(bytes(value['big'].data), bytes(loaded['big'].data))
+        self.assertEqual(bytes(8), bytes(loaded['small'].data))
+        # Only the big buffer was stored out-of-band.
+        name = cache.entry_name('f', cache.args_key((1,), {}))
+        self.assertTrue(os.path.exists(cache.value_path(name, '.buf0')))
+        self.assertFalse(os.path.exists(cache.value_path(name, '.buf1')))
+        del loaded
+        cache.delete('f')
+        self.assertEqual([], [name for _, _, names in os.walk(cache.directory)
+                              for name in names if '.buf' in name])
+        del cache
+    def test_codecs(self):
+        '''Entries written with different codecs are read back by the codec
+        recorded with each of them.'''
+        big = list(range(1000)) * 10
+        config = dict(self.config, file='codec_' + self.config['file'],
+                      codec='zlib', function_codecs={'g': 'lzma', 'h': None})
+        cache = self.make_cache(config)
+        cache.invalidate()
+        for funcname in ('f', 'g', 'h'):
+            cache.add(funcname, 1, self.callgraph, (1,), {}, big)
+        cache.add('f', 1, self.callgraph, (2,), {}, 'small')
+        cache.save()
+        del cache
+        cache = self.make_cache(dict(config, codec=None, function_codecs={}))
+        for funcname in ('f', 'g', 'h'):
+            self.assertEqual(big, cache.get(funcname, 1, (1,), {}))
+        self.assertEqual('small', cache.get('f', 1, (2,), {}))
+        self.assertEqual((None, b'x' * 10), cache.compress('f', b'x' * 10))
+        with self.assertRaises(ValueError):
+            self.make_cache(dict(config, codec='no-such-codec'))
+        cache.invalidate()
+        del cache
+    def test_eviction(self):
+        config = dict(self.config, file='evict_' + self.config['file'], max_entries=2)
+        cache = self.make_cache(config)
+        cache.invalidate()
+        cache.add('f', 1, self.callgraph, ('a',), {}, 'a')
+        cache.add('f', 1, self.callgraph, ('b',), {}, 'b')
+        cache.save()
+        self.assertEqual('a', cache.get('f', 1, ('a',), {}))
+        cache.add('f', 1, self.callgraph, ('c',), {}, 'c')
+        cache.save()
+        self.assertEqual(2, cache.evictor.usage('f').entries)
+        with self.assertRaises(KeyError):
+            cache.get('f', 1, ('b',), {})
+        del cache
+        # The capacity also applies to the entries found when opening.
+        cache = self.make_cache(dict(config, max_entries=1))
+        self.assertEqual(1, len(list(cache.keys())))
+        self.assertEqual(cache.evictor.usage().bytes, cache.evictor.usage('f').bytes)
+        cache.invalidate()
+        self.assertEqual(0, cache.evictor.usage().entries)
+        del cache
+    def test_eviction_reopened(self):
+        for policy in ('lru', 'lfu'):
+            config = dict(self.config, file='evict_' + self.config['file'],
+                          max_entries=2, eviction=policy)
+            cache = self.make_cache(config)
+            cache.invalidate()
+            cache.add('f', 1, self.callgraph, ('b',), {}, 'b')
+            cache.add('f', 1, self.callgraph, ('a',), {}, 'a')
+            cache.get('f', 1, ('b',), {})
+            cache.get('f', 1, ('b',), {})
+            cache.save()
+            del cache
+            # b was used last and most often in the previous session.
+            cache = self.make_cache(config)
+            cache.add('f', 1, self.callgraph, ('c',), {}, 'c')
+            cache.save()
+            with self.assertRaises(KeyError, msg=policy):
+                cache.get('f', 1, ('a',), {})
+            self.assertEqual('b', cache.get('f', 1, ('b',), {}))
+            cache.invalidate()
+            del cache
+    def test_admission_reopened(self):
+        ''' Arguments looked up once per session count across sessions. '''
+        config = dict(self.config, file='admission_' + self.config['file'],
+                      admission={'min_frequency': 2})
+        for session in range(2):
+            cache = self.make_cache(config)
+            if session == 0:
+                cache.invalidate()
+            admitted = cache.admit('f', (1,), {}, 'value', 1.0)
+            cache.save()
+            if session == 0:
+                self.assertFalse(admitted)
+                del cache
+        self.assertTrue(admitted)
+        cache.invalidate()
+        del cache
+    def test_lookup_many(self):
+        calls = [((i,), {}) for i in range(100)]
+        self.uut.add_many('f', 1, [(self.callgraph, args, kwargs, i, datetime.datetime.now(), 1.0)
+                                   for i, (args, kwargs) in enumerate(calls) if i % 3])
+        self.uut.add('g', 1, self.callgraph, (0,), {}, 'other')
+        results = self.uut.lookup_many('f', 1, calls)
+        self.assertEqual([None if i % 3 == 0 else i for i in range(100)],
+                         [result and result[1] for result in results])
+        self.assertEqual(self.callgraph, results[1][0])
+        self.assertEqual([None, None], self.uut.lookup_many('f', 2, calls[1:3]))
+        self.assertEqual([None], self.uut.lookup_many('f', 1, calls[1:2]))
+        self.assertEqual('other', self.uut.get('g', 1, (0,), {}))
+    def storage_stats(self):
+        return self.uut.stats
+    def test_stats(self):
+        self.uut.add('f', 1, self.callgraph, (1,), {}, 1, runningtime=2.0)
+        changed = MockCallgraph('changed')
+        changed.change_flag = True
+        self.uut.add('f', 1, changed, (2,), {}, 2)
+        events = []
+        self.uut.stats.add_hook(lambda event, funcname, value: event != 'read' and events.append(event))
+        self.assertEqual(1, self.uut.get('f', 1, (1,), {}))
+        for args in [(2,), (3,)]:
+            with self.assertRaises(KeyError):
+                self.uut.get('f', 1, args, {})
+        with self.assertRaises(KeyError):
+            self.uut.get('f', 2, (1,), {})
+        stats = self.uut.stats.snapshot()
+        f = stats['f']
+        self.assertEqual((1, 3, 1, 1), (f['hits'], f['misses'], f['code_invalidations'],
+                                        f['callgraph_invalidations']))
+        self.assertEqual(2.0, f['time_saved'])
+        self.assertEqual(4, sum(f['latency_buckets']))
+        self.assertEqual(0.25, stats[None]['hit_ratio'])
+        self.assertEqual(['hit', 'saved', 'miss', 'invalidated', 'miss', 'miss', 'invalidated'],
+                         events)
+    def test_stats_bytes(self):
+        self.uut.add('f', 1, self.callgraph, (1,), {}, b'x' * 1000)
+        self.uut.save()
+        self.assertLessEqual(1000, self.storage_stats().function('f').bytes_written)
+        cache = self.make_cache(self.config)
+        self.assertEqual(b'x' * 1000, cache.get('f', 1, (1,), {}))
+        storage = getattr(cache, 'backend', cache)
+        self.assertLessEqual(1000, storage.stats.function('f').bytes_read)
+        self.assertEqual(0, storage.stats.function('myfunc').bytes_read)
+        if hasattr(storage, 'connection'):
+            storage.connection.close()
+            storage.connection = None
+    def add_dependents(self):
+        ''' Adds entries of funcA and funcB, returning their names. '''
+        a, b = Callgraph.name(funcA), Callgraph.name(funcB)
+        self.uut.add(a, 1, function_graph(funcA), (1,), {}, 1)
+        self.uut.add(b, 1, function_graph(funcB, funcA), (1,), {}, 2)
+        self.uut.add(b, 1, function_graph(funcB), (2,), {}, 3)
+        return a, b
+    def test_dependents(self):
+        a, b = self.add_dependents()
+        key = lambda *args: self.uut.args_key(args, {})
+        self.assertEqual(sorted([(a, key(1)), (b, key(1))]), self.uut.dependents(a))
+        self.assertEqual([], self.uut.dependents('unknown'))
+    def test_sweep(self):
+        global funcA
+        a, b = self.add_dependents()
+        self.assertEqual([], self.uut.sweep())
+        original = funcA
+        def funcA(x):
+            return x + 1
+        try:
+            key = lambda *args: self.uut.args_key(args, {})
+            self.assertEqual([], self.uut.sweep([b]))
+            self.assertEqual(sorted([(a, key(1)), (b, key(1))]), self.uut.sweep())
+        finally:
+            funcA = original
+        self.assertEqual(set([('myfunc', self.uut.args_key(self.args, self.kwargs)), (b, key(2))]),
+                         set(self.uut.keys()))
+        self.assertEqual(3, self.uut.get(b, 1, (2,), {}))
+        self.assertEqual([], self.uut.dependents(a))
+        self.assertEqual(1, self.storage_stats().function(a).code_invalidations)
+        self.assertEqual(1, self.storage_stats().function(b).callgraph_invalidations)
+    def test_sweep_versions(self):
+        global funcA
+        cache = self.make_cache(dict(self.config, file='versions_' + self.config['file'],
+                                     versions=2))
+        cache.invalidate()
+        a = Callgraph.name(funcA)
+        cache.add(a, 1, function_graph(funcA), (1,), {}, 1)
+        original = funcA
+        def funcA(x):
+            return x + 1
+        try:
+            # Kept for switching back to the original code.
+            self.assertEqual([], cache.sweep())
+            self.assertEqual(1, len(list(cache.keys())))
+            removed = cache.sweep(versions=True)
+        finally:
+            funcA = original
+        self.assertEqual([a], [funcname for funcname, args_key in removed])
+        self.assertEqual([], list(cache.keys()))
+        cache.invalidate()
+        del cache
+    def test_versions(self):
+        cache = self.make_cache(dict(self.config, file='versions_' + self.config['file'],
+                                     versions=2))
+        callgraph = MockCallgraph('b')
+        cache.add('f', 1, self.callgraph, (1,), {}, 'one')
+        cache.add('f', 2, callgraph, (1,), {}, 'two')
+        self.assertEqual('one', cache.get('f', 1, (1,), {}))
+        self.assertEqual('two', cache.get('f', 2, (1,), {}))
+        self.assertEqual('one', cache.get('f', 1, (1,), {}))
+        with self.assertRaises(KeyError):
+            cache.get('f', 3, (1,), {})
+        self.assertEqual(2, len([key for key in cache.keys() if key[0] == 'f']))
+        cache.add('f', 3, self.callgraph, (1,), {}, 'three')
+        with self.assertRaises(KeyError):
+            cache.get('f', 1, (1,), {})
+        self.assertEqual('two', cache.get('f', 2, (1,), {}))
+        self.assertEqual('three', cache.get('f', 3, (1,), {}))
+        cache.add('f', 3, self.callgraph, (1,), {}, 'three again')
+        self.assertEqual('two', cache.get('f', 2, (1,), {}))
+        self.assertEqual('three again', cache.get('f', 3, (1,), {}))
+        cache.invalidate()
+        del cache
+    @unittest.skipIf(numpy is None, 'numpy is not installed')
+    def test_numpy_memory_mapped(self):
+        config = dict(self.config, file='oob_' + self.config['file'], mmap_threshold=1024)
+        cache = self.make_cache(config)
+        cache.invalidate()
+        array = numpy.arange(10000, dtype=numpy.float64).reshape(100, 100)
+        cache.add('f', 1, self.callgraph, (1,), {}, array)
+        cache.save()
+        loaded = cache.get('f', 1, (1,), {})
+        self.assertTrue(numpy.array_equal(array, loaded))
+        self.assertFalse(loaded.flags.writeable)
+        del loaded
+        cache.invalidate()
+        del cache
     
     
-    
+class TestPickleCacheLayout(unittest.TestCase):
+    def setUp(self):
+        self.config = {'file': 'layout.pickle'}
+        if os.path.exists('layout.pickle'):
+            os.remove('layout.pickle')
+        shutil.rmtree('layout.pickle.d', ignore_errors=True)
+        self.callgraph = MockCallgraph('original')
+    def test_values_read_lazily(self):
+        uut = PickleCache(self.config)
+        uut.add('f', 1, self.callgraph, (1,), {}, 'one')
+        uut.save()
+        del uut
+        uut = PickleCache(self.config)
+        entry = uut.data['f'][uut.args_key((1,), {})]
+        self.assertNotIn('return_values', entry)
+        self.assertEqual('one', uut.get('f', 1, (1,), {}))
+    def test_save_writes_new_entries_only(self):
+        uut = PickleCache(self.config)
+        uut.add('f', 1, self.callgraph, (1,), {}, 'one')
+        uut.save()
+        name = uut.data['f'][uut.args_key((1,), {})]['value']
+        path = uut.value_path(name, '.pickle')
+        os.utime(path, (0, 0))
+        uut.add('f', 1, self.callgraph, (2,), {}, 'two')
+        uut.save()
+        self.assertEqual(0, os.stat(path).st_mtime)
+        self.assertEqual('two', PickleCache(self.config).get('f', 1, (2,), {}))
+    def test_args_not_stored(self):
+        ''' Entries are keyed by the fingerprint of their arguments only.'''
+        uut = PickleCache(self.config)
+        uut.add('f', 1, self.callgraph, ('x' * 1000,), {}, 'one')
+        uut.save()
+        entry = uut.data['f'][uut.args_key(('x' * 1000,), {})]
+        self.assertFalse(os.path.exists(uut.value_path(entry['value'], '.args')))
+        self.assertEqual(os.path.getsize(uut.value_path(entry['value'], '.pickle')),
+                         entry['size'])
+    def test_invalidated_files_removed(self):
+        uut = PickleCache(self.config)
+        uut.add('f', 1, self.callgraph, (1,), {}, 'one')
+        uut.save()
+        path = uut.value_path(uut.data['f'][uut.args_key((1,), {})]['value'], '.pickle')
+        self.assertTrue(os.path.exists(path))
+        with self.assertRaises(KeyError):
+            uut.get('f', 2, (1,), {})
+        self.assertFalse(os.path.exists(path))
+    def test_single_pickle_format(self):
+        uut = PickleCache(self.config)
+        key = uut.args_key((1,), {})
+        with open(self.config['file'], 'wb') as f:
+            pickle.dump({'f': {key: {'hash': 1, 'callgraph': self.callgraph,
+                                     'args': (1,), 'kwargs': {}, 'return_values': 'one',
+                                     'when': None, 'howlong': None}}}, f)
+        uut = PickleCache(self.config)
+        self.assertEqual('one', uut.get('f', 1, (1,), {}))
+        uut.save()
+        self.assertNotIn('return_values', uut.data['f'][key])
+        self.assertEqual('one', PickleCache(self.config).get('f', 1, (1,), {}))
+        # Converted, the values are not written again.
+        with open(self.config['file'], 'rb') as f:
+            self.assertEqual(PickleCache.INDEX_FORMAT, pickle.load(f)[:2])
+        path = uut.value_path(uut.data['f'][key]['value'], '.pickle')
+        os.utime(path, (0, 0))
+        converted = PickleCache(self.config)
+        self.assertFalse(converted.unsaved)
+        converted.save()
+        self.assertEqual(0, os.stat(path).st_mtime)
+    def test_concurrent_saves_merged(self):
+        first = PickleCache(self.config)
+        second = PickleCache(self.config)
+        first.add('f', 1, self.callgraph, (1,), {}, 'one')
+        second.add('f', 1, self.callgraph, (2,), {}, 'two')
+        first.save()
+        second.save()
+        third = PickleCache(self.config)
+        self.assertEqual('one', third.get('f', 1, (1,), {}))
+        self.assertEqual('two', third.get('f', 1, (2,), {}))
+        # Entries saved by others are found on a miss.
+        self.assertEqual('two', first.get('f', 1, (2,), {}))
+    def test_removals_merged(self):
+        first = PickleCache(self.config)
+        first.add('f', 1, self.callgraph, (1,), {}, 'one')
+        first.add('g', 1, self.callgraph, (1,), {}, 'one')
+        first.save()
+        second = PickleCache(self.config)
+        first.remove_entry('f', first.args_key((1,), {}))
+        first.save()
+        second.delete('g')
+        second.add('f', 1, self.callgraph, (2,), {}, 'two')
+        second.save()
+        self.assertEqual([('f', second.args_key((2,), {}))],
+                         list(PickleCache(self.config).keys()))
+    def test_index_appended(self):
+        uut = PickleCache(self.config)
+        writes = []
+        write_file = uut.write_file
+        def counting(path, obj):
+            if path == uut.picklepath:
+                writes.append(path)
+            write_file(path, obj)
+        uut.write_file = counting
+        other = PickleCache(self.config)
+        for i in range(300):
+            uut.add('f', 1, self.callgraph, (i,), {}, i)
+            uut.save()
+        # Rewritten once the appended changes outnumber the entries only.
+        self.assertLessEqual(len(writes), 3)
+        self.assertEqual(300, len(list(PickleCache(self.config).keys())))
+        self.assertEqual(299, other.get('f', 1, (299,), {}))
+        self.assertEqual(300, len(list(other.keys())))
+
+
+class TestTieredCache(TestPickleCache):
+    ''' Runs the PickleCache tests against a TieredCache over a PickleCache. '''
+    l1_entries = 2
+    def make_cache(self, config):
+        return TieredCache({'backend': PickleCache(config), 'l1_entries': self.l1_entries})
+    def setUp(self):
+        TestPickleCache.setUp(self)
+        self.backend = self.uut.backend
+    def test_out_of_band_buffers(self):
+        '''L1 would return the original objects instead of memory maps.'''
+        self.l1_entries = 0
+        TestPickleCache.test_out_of_band_buffers(self)
+    def test_l1_hits_count_for_eviction(self):
+        '''L1 hits count as accesses of L2's entries, and entries L2 evicts
+        leave L1.'''
+        config = {'file': 'evict_tiered.pickle', 'max_entries': 2}
+        cache = TieredCache({'backend': PickleCache(config), 'l1_entries': 4})
+        cache.invalidate()
+        cache.add('f', 1, self.callgraph, ('a',), {}, 'a')
+        cache.add('f', 1, self.callgraph, ('b',), {}, 'b')
+        cache.save()
+        self.assertEqual('a', cache.get('f', 1, ('a',), {}))
+        self.assertEqual(1, cache.counters['l1_hits'])
+        cache.add('f', 1, self.callgraph, ('c',), {}, 'c')
+        cache.save()
+        self.assertEqual(sorted([('f', cache.args_key((key,), {})) for key in 'ac']),
+                         sorted(cache.keys()))
+        with self.assertRaises(KeyError):
+            cache.get('f', 1, ('b',), {})
+        cache.invalidate()
+        del cache
+    def test_numpy_memory_mapped(self):
+        '''L1 would return the original array instead of a memory map.'''
+        self.l1_entries = 0
+        TestPickleCache.test_numpy_memory_mapped(self)
+    def storage_stats(self):
+        return self.backend.stats
+    def test_load_from_disk(self):
+        config = {'file': self.backend.picklepath}
+        del self.uut, self.backend
+        new_cache = TieredCache({'backend': PickleCache(config)})
+        self.assertEqual(self.return_values, new_cache.get('myfunc', 123, self.args, self.kwargs))
+        self.uut = new_cache
+    def test_l1_skips_backend(self):
+        self.backend.save()
+        self.uut.l1.clear()
+        self.assertEqual(5, self.uut.get('myfunc', 123, self.args, self.kwargs))
+        self.assertEqual(1, self.uut.counters['l2_hits'])
+        loads = []
+        self.backend.loads_value = lambda *args: loads.append(args)
+        value = self.uut.get('myfunc', 123, self.args, self.kwargs)
+        self.assertEqual(5, value)
+        self.assertEqual([], loads)
+        self.assertEqual(1, self.uut.counters['l1_hits'])
+        self.assertEqual(1, self.uut.counters['l1_misses'])
+    def test_l1_bounded(self):
+        for i in range(5):
+            self.uut.add('f', 1, self.callgraph, (i,), {}, i)
+        self.assertEqual(2, len(self.uut.l1))
+        self.assertEqual(0, self.uut.get('f', 1, (0,), {}))
+        self.assertEqual(1, self.uut.counters['l2_hits'])
+    def test_warmup(self):
+        config = {'file': self.backend.picklepath}
+        warmup = config['file'] + '.warmup'
+        self.addCleanup(lambda: os.path.exists(warmup) and os.remove(warmup))
+        del self.uut, self.backend
+        session = TieredCache({'backend': PickleCache(config), 'warmup': warmup})
+        self.assertIsNone(session.prefetcher)
+        for i in range(4):
+            session.add('f', 1, self.callgraph, (i,), {}, i)
+        for i in (2, 0, 3):
+            self.assertEqual(i, session.get('f', 1, (i,), {}))
+        session.save()
+        del session
+        # The rerun prefetches the first entries used, as many as fit.
+        session = TieredCache({'backend': PickleCache(config), 'warmup': warmup,
+                               'l1_entries': 2})
+        # Saved at exit, it would write the warmup file again after cleanup.
+        self.addCleanup(open_caches.discard, session)
+        session.prefetcher.join()
+        self.assertEqual(2, session.counters['prefetched'])
+        self.assertEqual([2, 0], [session.get('f', 1, (i,), {}) for i in (2, 0)])
+        self.assertEqual((2, 0), (session.counters['l1_hits'], session.counters['l2_hits']))
+        self.assertEqual(3, session.get('f', 1, (3,), {}))
+        self.assertEqual(1, session.counters['l2_hits'])
+        self.uut = session
+    def test_l1_checks_code_hash(self):
+        self.assertEqual(5, self.uut.get('myfunc', 123, self.args, self.kwargs))
+        with self.assertRaises(KeyError):
+            self.uut.get('myfunc', 124, self.args, self.kwargs)
+        with self.assertRaises(KeyError):
+            self.uut.get('myfunc', 123, self.args, self.kwargs)
+        self.assertEqual(2, self.uut.counters['l2_misses'])
+
+
+class TestSqliteCache(TestPickleCache):
+    ''' Runs the PickleCache tests against SqliteCache. '''
+    def setUp(self):
+        fname = 'cache.sqlite'
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(fname + suffix):
+                os.remove(fname + suffix)
+        self.config = {'file': fname}
+        self.return_values = 5
+        self.callgraph = MockCallgraph('original')
+        self.uut = self.make_cache(self.config)
+        self.args = None
+        self.kwargs = None
+        self.uut.add(funcname='myfunc', code_hash=123, callgraph=self.callgraph,
+                args=self.args, kwargs=self.kwargs, return_values = self.return_values)
+    def make_cache(self, config):
+        return SqliteCache(config)
+    def tearDown(self):
+        self.uut.connection.close()
+        self.uut.connection = None
+    def test_callgraph_changed(self):
+        '''The callgraph is stored pickled, so it is changed before adding.'''
+        self.callgraph.change_flag = True
+        self.uut.add('changed', 123, self.callgraph, self.args, self.kwargs, 1)
+        with self.assertRaises(KeyError):
+            self.uut.get('changed', 123, self.args, self.kwargs)
+        self.assertEqual([], [k for k in self.uut.keys() if k[0] == 'changed'])
+    def test_load_from_disk(self):
+        self.uut.save()
+        new_cache = SqliteCache(self.config)
+        self.assertEqual(self.return_values, new_cache.get('myfunc', 123, self.args, self.kwargs))
+        new_cache.connection.close()
+        new_cache.connection = None
+    def test_dependencies_indexed_on_open(self):
+        '''Databases written before the dependencies table are indexed.'''
+        a, b = self.add_dependents()
+        self.uut.connection.execute('DELETE FROM dependencies')
+        self.uut.connection.execute('PRAGMA user_version = 0')
+        self.uut.save()
+        self.assertEqual([], self.uut.dependents(a))
+        reopened = SqliteCache(self.config)
+        self.assertEqual(2, len(reopened.dependents(a)))
+        reopened.connection.close()
+        reopened.connection = None
+    def test_memory_stored(self):
+        self.callgraph.memory = (1000, 10)
+        self.uut.add('f', 1, self.callgraph, (1,), {}, 1)
+        self.assertEqual((1000, 10), self.uut.connection.execute(
+            'SELECT memory_peak, memory_net FROM cache WHERE funcname = ?', ('f',)).fetchone())
+    def test_commits(self):
+        '''Writes are committed when done, so other processes can write.'''
+        other = sqlite3.connect(self.config['file'], timeout=0)
+        count = lambda: other.execute('SELECT COUNT(*) FROM cache').fetchone()[0]
+        self.assertEqual(1, count())
+        self.uut.add('f', 1, self.callgraph, (1,), {}, 1)
+        self.assertEqual(2, count())
+        self.uut.add_many('f', 1, [(self.callgraph, (i,), {}, i, datetime.datetime.now(), None)
+                                   for i in (2, 3)])
+        self.assertEqual(4, count())
+        self.uut.remove_entry('f', self.uut.args_key((1,), {}))
+        other.execute('DELETE FROM cache WHERE funcname = ?', ('f',))
+        other.commit()
+        self.assertEqual(1, count())
+        other.close()
+
+    def test_args_not_stored(self):
+        '''Entries are keyed by the fingerprint of their arguments only.'''
+        self.uut.add('f', 1, self.callgraph, ('x' * 1000,), {}, 1)
+        self.assertEqual((None, None, len(pickle.dumps(1, pickle.HIGHEST_PROTOCOL))),
+                         self.uut.connection.execute(
+                             'SELECT args, kwargs, size FROM cache WHERE funcname = ?',
+                             ('f',)).fetchone())
+
+
 if __name__=='__main__':
     unittest.main()
     
\ No newline at end of file
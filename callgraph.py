@@ -1,5 +1,18 @@
+import asyncio
+import contextlib
+import hashlib
+import importlib.util
+import os
+import sys
+import tempfile
+import tracemalloc
 import unittest
-from tracer import Tracer
+import weakref
+from contextvars import ContextVar
+from tracer import Tracer, TraceProcessor, HAS_MONITORING, QUALNAMES, open_memory, close_memory
+from registry import registry
+import analysis
+import workers
 
 def func_inner(x):
     return 2*x
@@ -12,33 +25,317 @@ def func_outer(x):
     return 3*func_inner(x) + 7*func_inner(x)
 
 
+# Paths of the files opened for reading by the call being recorded with
+# files=True in the current thread or task; None outside of one.
+opened_files = ContextVar('opened_files', default=None)
+# Files that are never recorded: those of caches, see exclude_files(), and
+# source and bytecode of imported modules, which are fingerprinted anyway.
+excluded_files = set()
+excluded_directories = ()
+CODE_SUFFIXES = ('.py', '.pyc')
+WRITE_FLAGS = os.O_WRONLY | os.O_RDWR
+audit_hook_installed = False
+
+def audit_open(event, args):
+    if event != 'open':
+        return
+    paths = opened_files.get()
+    if paths is None or args[2] & WRITE_FLAGS or isinstance(args[0], int):
+        return
+    path = os.path.abspath(os.fsdecode(args[0]))
+    if not (path in excluded_files or path.startswith(excluded_directories) or
+            path.endswith(CODE_SUFFIXES)):
+        paths.add(path)
+
+TraceProcessor.internal_code.add(audit_open.__code__)
+
+def exclude_files(paths, directories=()):
+    ''' Never record the files paths, nor any file in directories. '''
+    global excluded_directories
+    excluded_files.update(os.path.abspath(path) for path in paths)
+    for directory in directories:
+        directory = os.path.join(os.path.abspath(directory), '')
+        if directory not in excluded_directories:
+            excluded_directories += (directory,)
+
+def record_file(path):
+    ''' Records path as read by the call being recorded, for files opened by
+    C libraries (e.g. HDF5) which Python's audit hooks do not see. '''
+    paths = opened_files.get()
+    if paths is not None:
+        paths.add(os.path.abspath(path))
+
+def file_state(path):
+    stat = os.stat(path)
+    return (stat.st_size, stat.st_mtime_ns, stat.st_ino)
+
+def file_digest(path):
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
 class Callgraph:
-    def __init__(self, threaded = False):
+    # Path -> ((size, mtime_ns, inode), content digest) of the files read,
+    # None unless recorded. Also the default for callgraphs pickled before.
+    files = None
+    # Whether unchanged() updated the state of a file whose contents are
+    # the same, for caches to store the callgraph again and reset this.
+    refreshed = False
+    # (peak, net) bytes allocated by the call, None unless recorded.
+    memory = None
+    # With static, why the analysis was incomplete, None if it was not.
+    unresolved = None
+    # With static='verify', the traced functions the analysis did not find.
+    missed = None
+
+    def __init__(self, threaded = False, monitoring = None, files = False,
+                 memory = False, static = False, workers = False):
+        '''monitoring selects the sys.monitoring backend. None uses it whenever
+        the interpreter supports it and threaded tracing is not requested.
+
+        With files, the files opened for reading during the call (through
+        open(), os.open() etc., see record_file() for others) are recorded,
+        and unchanged() also checks that they are unchanged: by their size,
+        modification time and inode, and only if those changed by a digest of
+        their contents. Files opened by other threads are not recorded.
+
+        With memory, the memory allocated by the call is recorded with
+        tracemalloc, which is started for the call if it is not tracing: the
+        peak and the net allocation, in bytes, see self.memory. The tracer
+        accounts for each function called in the same way. Allocations made
+        by other threads meanwhile are counted, too.
+
+        With static, the callgraph is built from the bytecode of the function
+        and of those it refers to (see analysis.py), and the call runs without
+        a tracer, at full speed. Where the analysis is incomplete, e.g.
+        because the function calls methods of objects passed to it, the call
+        is traced as usual; self.unresolved says why. With static='verify',
+        the call is traced anyway, the callgraph holds the functions found
+        either way and self.missed lists those only the tracer found.
+
+        With workers, the functions called by threads and child processes
+        the call hands work to count towards its callgraph as well, e.g.
+        those of a ThreadPoolExecutor or a multiprocessing.Pool it creates.
+        Threads started during the call are traced, and forked children
+        report to the caller; see workers.py for which are followed. A call
+        analysed with static is not traced, nor are its workers.
+        '''
         self.threaded = threaded
-    
+        if monitoring is None:
+            monitoring = HAS_MONITORING and not threaded
+        self.monitoring = monitoring
+        self.record_files = files
+        self.record_memory = memory
+        self.static = static
+        self.workers = workers
+
+    def tracer(self):
+        return Tracer(None, self.threaded, self.monitoring, self.record_memory)
+
     def execute(self, function, *args, **kwargs):
-        output = None
-        tracer = Tracer(output, self.threaded)
-        with tracer:
-            ret = function(*args, **kwargs)
-            
+        graph = self.analyze(function)
+        if graph is not None:
+            with self.untraced(graph):
+                return function(*args, **kwargs)
+        tracer = self.tracer()
+        paths, token = self.start_files()
+        measurement = self.start_memory()
+        followed = self.start_workers()
+        try:
+            with tracer:
+                ret = function(*args, **kwargs)
+        finally:
+            self.stop_workers(followed)
+            self.stop_memory(measurement)
+            self.stop_files(paths, token)
+        self.record(function, tracer, followed)
+        return ret
+
+    def analyze(self, function):
+        ''' The callgraph of function found by static analysis if the call
+        need not be traced, else None. '''
+        if self.static is not True:
+            return None
+        graph, self.unresolved = analysis.dependencies(function)
+        return graph if self.unresolved is None else None
+
+    @contextlib.contextmanager
+    def untraced(self, graph):
+        ''' Runs the block like execute() runs a call, but without a tracer,
+        and records graph as the callgraph. '''
+        paths, token = self.start_files()
+        measurement = self.start_memory()
+        try:
+            yield
+        finally:
+            self.stop_memory(measurement)
+            self.stop_files(paths, token)
+        self.graph = graph
+
+    def start_workers(self):
+        ''' Starts following the workers of the call, see workers.py.
+        Returns the Workers, or None. '''
+        if not self.workers:
+            return None
+        followed = workers.Workers()
+        followed.start()
+        return followed
+
+    def stop_workers(self, followed):
+        if followed is not None:
+            followed.stop()
+
+    def start_memory(self):
+        ''' Starts tracemalloc if needed and measures the memory allocated
+        until stop_memory(), see tracer.open_memory(). Returns whether it
+        started tracemalloc and the measurement's token, or None. '''
+        if not self.record_memory:
+            return None
+        started = not tracemalloc.is_tracing()
+        if started:
+            tracemalloc.start()
+        return started, open_memory()
+
+    def stop_memory(self, measurement):
+        if measurement is None:
+            return
+        started, token = measurement
+        self.memory = close_memory(token)
+        if started:
+            tracemalloc.stop()
+
+    def start_files(self):
+        global audit_hook_installed
+        if not self.record_files:
+            return None, None
+        if not audit_hook_installed:
+            sys.addaudithook(audit_open)
+            audit_hook_installed = True
+        paths = set()
+        return paths, opened_files.set(paths)
+
+    def stop_files(self, paths, token):
+        if token is None:
+            return
+        opened_files.reset(token)
+        outer = opened_files.get()
+        if outer is not None:
+            outer.update(paths)
+        self.files = dict()
+        for path in paths:
+            try:
+                self.files[path] = (file_state(path), file_digest(path))
+            except OSError: # Removed meanwhile, or not a file
+                pass
+
+    async def execute_async(self, function, *args, **kwargs):
+        '''Like execute() for a coroutine function, whose coroutine is awaited.
+        The tracer only runs while the coroutine itself does, not while other
+        tasks run in between.
+        '''
+        graph = self.analyze(function)
+        if graph is not None:
+            with self.untraced(graph):
+                return await function(*args, **kwargs)
+        tracer = self.tracer()
+        paths, token = self.start_files()
+        measurement = self.start_memory()
+        followed = self.start_workers()
+        tracer.enter()
+        tracer.start()
+        tracer.pause()
+        tracer.leave()
+        try:
+            ret = await TracedCoroutine(function(*args, **kwargs), tracer)
+        finally:
+            tracer.enter()
+            tracer.stop()
+            tracer.done()
+            tracer.leave()
+            self.stop_workers(followed)
+            self.stop_memory(measurement)
+            self.stop_files(paths, token)
+        if self.record_memory:
+            # Only the steps of the coroutine, not the tasks run in between.
+            processor = tracer.processor
+            self.memory = (processor.outer_memory_peak, processor.outer_memory_net)
+        self.record(function, tracer, followed)
+        return ret
+
+    def record(self, function, tracer, followed=None):
         self.graph = dict()
-        self.graph[function.__name__] = hash(function.__code__.co_code)
+        self.graph[self.name(function)] = registry.function_hash(function)
         for node in tracer.nodes():
             if node.name != '__main__' and not node.name.startswith('tracer'):
-                self.graph[node.name] = node.hash
-        return ret
+                # The bound function's fingerprint also covers its defaults.
+                fingerprint = registry.current_hash(node.name)
+                self.graph[node.name] = fingerprint or node.hash
+        if followed is not None:
+            for name, fingerprint in followed.functions.items():
+                if name != '__main__':
+                    self.graph[name] = registry.current_hash(name) or fingerprint
+            for other in followed.callgraphs:
+                self.include(other)
+        if self.static == 'verify':
+            graph, self.unresolved = analysis.dependencies(function)
+            self.missed = sorted(set(self.graph) - set(graph))
+            graph.update(self.graph)
+            self.graph = graph
 
     def unchanged(self):
         '''Checks each function in the callgraph whether it has changed.
         Returns True if all the function have their original code-hash. False otherwise.
+        Functions that cannot be resolved by name are compared with the code
+        last traced under their name, if any.
         '''
-        for func, codehash in self.graph.iteritems():
-            f = eval(func)
-            if hash(f.__code__.co_code) != codehash:
+        current_hash = registry.current_hash
+        captured = registry.captured
+        for func, codehash in self.graph.items():
+            current = current_hash(func)
+            if current is None:
+                current = captured.get(func, codehash)
+            if current != codehash:
                 return False
+        if self.files:
+            return self.files_unchanged()
         return True
 
+    def files_unchanged(self):
+        for path, (state, digest) in self.files.items():
+            try:
+                current = file_state(path)
+                if current == state:
+                    continue
+                if file_digest(path) != digest:
+                    return False
+            except OSError:
+                return False
+            # Touched or copied, but the same contents.
+            self.files[path] = (current, digest)
+            self.refreshed = True
+        return True
+
+    def include(self, other):
+        ''' Adds the functions and files of other, the callgraph of a call
+        made during this one. '''
+        self.graph.update(other.graph)
+        if other.files:
+            if self.files is None:
+                self.files = dict()
+            self.files.update(other.files)
+
+    @staticmethod
+    def name(function):
+        ''' Name of function as the tracer builds it: module-qualified except
+        for functions in __main__, see tracer.QUALNAMES.'''
+        name = function.__qualname__ if QUALNAMES else function.__name__
+        if function.__module__ in (None, '__main__'):
+            return name
+        return '%s.%s' % (function.__module__, name)
+
     def __eq__(self, other):
         return self.graph == other.graph
     def __ne__(self, other):
@@ -47,6 +344,34 @@ class Callgraph:
         ''' Returns `set` of called functions '''
         return set([key for key in self.graph])
 
+class TracedCoroutine(object):
+    ''' Awaitable running coroutine step by step, with tracer running
+    during each step only. '''
+    def __init__(self, coroutine, tracer):
+        self.coroutine = coroutine
+        self.tracer = tracer
+
+    def __await__(self):
+        value, error = None, None
+        while True:
+            self.tracer.enter()
+            self.tracer.resume()
+            try:
+                if error is None:
+                    yielded = self.coroutine.send(value)
+                else:
+                    yielded = self.coroutine.throw(error)
+            except StopIteration as stop:
+                return stop.value
+            finally:
+                self.tracer.pause()
+                self.tracer.leave()
+            try:
+                value, error = (yield yielded), None
+            except BaseException as e:
+                value, error = None, e
+
+
 class CallgraphTest(unittest.TestCase):
     def testSimple(self):
         global __func_inner, __func_outer
@@ -58,7 +383,7 @@ class CallgraphTest(unittest.TestCase):
         cg = Callgraph()
         y = cg.execute(__func_outer, 3)
         self.assertEqual(8, y)
-        self.assertEqual(set([__func_inner.__name__, __func_outer.__name__]), cg.call_set())
+        self.assertEqual(set([Callgraph.name(__func_inner), Callgraph.name(__func_outer)]), cg.call_set())
     
     def testChanges(self):
         global func_inner, func_outer
@@ -88,13 +413,62 @@ class CallgraphTest(unittest.TestCase):
                 return stupid_sum(n - 1) + 1
         cg = Callgraph()
         self.assertEqual(4, cg.execute(stupid_sum, 4))
-        self.assertEqual(set([stupid_sum.__name__]), cg.call_set())
+        self.assertEqual(set([Callgraph.name(stupid_sum)]), cg.call_set())
+        # Name and hash are resolved once for all recursive calls.
+        info = TraceProcessor.code_info[stupid_sum.__code__]
+        self.assertEqual(cg.graph[info[0]], info[1])
+    def test_code_not_kept(self):
+        ''' Code objects traced are not kept alive once discarded.'''
+        namespace = {}
+        exec(compile('def discarded(x):\n    return [x for x in range(x)]',
+                     '<test>', 'exec'), namespace)
+        cg = Callgraph()
+        cg.execute(namespace['discarded'], 2)
+        code = namespace.pop('discarded').__code__
+        self.assertIn(code, TraceProcessor.code_info)
+        del cg
+        code = weakref.ref(code)
+        self.assertIsNone(code())
     def testImportedModule(self):
         '''If a non-standard-library module is imported, those functions should
            also be in the call graph.
            I don't know what the behaviour should be in this case.
         '''
         pass
+    def test_other_module(self):
+        ''' Functions of other modules are resolved through their module.'''
+        import hashcomparison
+        cg = Callgraph()
+        self.assertEqual(3, cg.execute(hashcomparison.func_a, 1, 2))
+        self.assertEqual(set(['hashcomparison.func_a']), cg.call_set())
+        self.assertTrue(cg.unchanged())
+    def test_module_named_like_internal(self):
+        ''' Only pycache's own files are left out, not modules of the same
+        name elsewhere.'''
+        global user_caller
+        directory = tempfile.mkdtemp()
+        path = os.path.join(directory, 'stats.py')
+        with open(path, 'w') as f:
+            f.write('def summary(x):\n    return x\n')
+        spec = importlib.util.spec_from_file_location('stats', path)
+        module = importlib.util.module_from_spec(spec)
+        saved = sys.modules.get('stats')
+        sys.modules['stats'] = module
+        try:
+            spec.loader.exec_module(module)
+            def user_caller(x):
+                return module.summary(x)
+            cg = Callgraph()
+            cg.execute(user_caller, 1)
+        finally:
+            if saved is None:
+                del sys.modules['stats']
+            else:
+                sys.modules['stats'] = saved
+            os.remove(path)
+            os.rmdir(directory)
+        self.assertIn('stats.summary', cg.call_set())
+
     def testCfunctions(self):
         '''Library functions in C-should also be handled somehow.
         Not sure how they should be handled.
@@ -109,7 +483,7 @@ class CallgraphTest(unittest.TestCase):
         cg = Callgraph()
         res = cg.execute(func_gen, 3)
         self.assertEqual([1, 2, 3], list(res))
-        self.assertEqual(set(['func_gen']), cg.call_set())
+        self.assertEqual(set([Callgraph.name(func_gen)]), cg.call_set())
         
     
     def test_unchanged(self):
@@ -126,10 +500,10 @@ class CallgraphTest(unittest.TestCase):
         self.assertTrue(cg.unchanged())
         def func_inner(x):
             return 2*x
-        self.assertTrue(cg.unchanged())
+        self.assertFalse(cg.unchanged())
         def func_inner(x):
             return 3*x
-        self.assertFalse(cg.unchanged())
+        self.assertTrue(cg.unchanged())
 
     def test_trivial_function(self):
         ''' Assert that trivial functions don't get overlooked.'''
@@ -139,8 +513,242 @@ class CallgraphTest(unittest.TestCase):
             return 2*trivial(x)
         cg = Callgraph()
         self.assertEqual(10, cg.execute(outer_func, 5))
-        self.assertEqual(set(['outer_func', 'trivial']), cg.call_set())
+        self.assertEqual(set([Callgraph.name(outer_func), Callgraph.name(trivial)]),
+                         cg.call_set())
+
+    def test_unbound_code(self):
+        ''' Lambdas, closures, staticmethods and classmethods are resolved
+        or compared with the code traced under their name.'''
+        global square, Scaled, factory_scale, uses_all
+        square = lambda x: x * x
+        class Scaled(object):
+            @staticmethod
+            def static(x):
+                return x + 1
+            @classmethod
+            def method(cls, x):
+                return x + 2
+        def factory(k):
+            def scale(x):
+                return x * k
+            return scale
+        factory_scale = factory(3)
+        def uses_all(x):
+            return square(x) + Scaled.static(x) + Scaled.method(x) + factory_scale(x)
+        cg = Callgraph()
+        self.assertEqual(17, cg.execute(uses_all, 2))
+        self.assertEqual(5, len(cg.call_set()))
+        self.assertTrue(cg.unchanged())
+
+    def test_unresolvable_code(self):
+        ''' Code that cannot be resolved by name is compared with the code
+        traced last under its name.'''
+        namespace = {}
+        exec(compile('def unresolvable(x):\n    return x', '<test>', 'exec'), namespace)
+        cg = Callgraph()
+        cg.execute(namespace['unresolvable'], 2)
+        self.assertTrue(cg.unchanged())
+        exec(compile('def unresolvable(x):\n    return x + 1', '<test>', 'exec'), namespace)
+        Callgraph().execute(namespace['unresolvable'], 2)
+        self.assertFalse(cg.unchanged())
         
+    @unittest.skipUnless(HAS_MONITORING, 'sys.monitoring requires Python 3.12')
+    def test_monitoring_backend(self):
+        ''' Both tracer backends must find the same functions and hashes.'''
+        def trivial(x):
+            return x
+        def recurse(n):
+            if n == 0:
+                return trivial(0)
+            return recurse(n - 1) + 1
+        def raises(x):
+            raise ValueError(x)
+        def outer_func(x):
+            try:
+                raises(x)
+            except ValueError:
+                pass
+            return recurse(x) + trivial(x)
+        settrace = Callgraph(monitoring=False)
+        monitored = Callgraph(monitoring=True)
+        self.assertEqual(6, settrace.execute(outer_func, 3))
+        self.assertEqual(6, monitored.execute(outer_func, 3))
+        self.assertEqual(settrace, monitored)
+        # Events disabled by earlier runs are reported again, restarting
+        # them for all tools only once no tool id is left undisturbed.
+        restart_events = sys.monitoring.restart_events
+        restarts = []
+        sys.monitoring.restart_events = lambda: restarts.append(restart_events())
+        try:
+            for run in range(10):
+                self.assertEqual(6, monitored.execute(outer_func, 3))
+                self.assertEqual(settrace, monitored)
+        finally:
+            sys.monitoring.restart_events = restart_events
+        self.assertTrue(1 <= len(restarts) <= 2, restarts)
+
+    def test_threaded(self):
+        ''' The threaded tracer must see the same calls, also when the events
+        span several chunks of its buffer.'''
+        def trivial(x):
+            return x
+        def outer_func(n):
+            return sum(trivial(i) for i in range(n))
+        n = 3 * TraceProcessor.chunk_size
+        cg = Callgraph(monitoring=False)
+        threaded = Callgraph(threaded=True)
+        self.assertEqual(cg.execute(outer_func, n), threaded.execute(outer_func, n))
+        self.assertEqual(cg, threaded)
+
+    def test_coroutine(self):
+        ''' Calls made across awaits are traced, calls of other tasks
+        running in between are not.'''
+        global fetch, parse, other_task
+        def parse(x):
+            return x + 1
+        async def fetch(x):
+            await asyncio.sleep(0.01)
+            return parse(x)
+        async def other_task():
+            for i in range(3):
+                func_inner(i)
+                await asyncio.sleep(0.005)
+        async def main():
+            cg = Callgraph()
+            results = await asyncio.gather(cg.execute_async(fetch, 1), other_task())
+            return cg, results[0]
+        cg, value = asyncio.run(main())
+        self.assertEqual(2, value)
+        self.assertEqual(set([Callgraph.name(fetch), Callgraph.name(parse)]), cg.call_set())
+        self.assertTrue(cg.unchanged())
+
+    def test_files(self):
+        ''' Files read are recorded and checked by their state, and their
+        contents only if that changed.'''
+        global read_data
+        directory = tempfile.mkdtemp()
+        data = os.path.join(directory, 'data.csv')
+        output = os.path.join(directory, 'output.csv')
+        with open(data, 'w') as f:
+            f.write('1,2,3')
+        def read_data(path):
+            with open(output, 'w') as f:
+                f.write('written')
+            with open(path) as f:
+                return f.read()
+        cg = Callgraph(files=True)
+        self.assertEqual('1,2,3', cg.execute(read_data, data))
+        self.assertEqual([data], list(cg.files))
+        self.assertEqual(set([Callgraph.name(read_data)]), cg.call_set())
+        self.assertTrue(cg.unchanged())
+        self.assertFalse(cg.refreshed)
+        os.utime(data, ns=(0, 0))
+        self.assertTrue(cg.unchanged())
+        self.assertEqual(file_state(data), cg.files[data][0])
+        self.assertTrue(cg.refreshed)
+        with open(data, 'w') as f:
+            f.write('1,2,4')
+        self.assertFalse(cg.unchanged())
+        os.remove(data)
+        self.assertFalse(cg.unchanged())
+        self.assertIsNone(Callgraph().files)
+        os.remove(output)
+        os.rmdir(directory)
+
+    def test_memory(self):
+        ''' Peak and net allocation of the call and of each function.'''
+        global allocate, temporary
+        n = 1000000
+        def temporary(n):
+            return len(bytearray(2 * n))
+        def allocate(n):
+            keep = bytearray(n)
+            temporary(n)
+            return keep
+        backends = [(False, False), (True, False)] + [(False, True)] * HAS_MONITORING
+        for threaded, monitoring in backends:
+            cg = Callgraph(threaded, monitoring, memory=True)
+            keep = cg.execute(allocate, n)
+            peak, net = cg.memory
+            self.assertTrue(3 * n <= peak < 3.5 * n, (threaded, monitoring, peak))
+            self.assertTrue(n <= net < 1.5 * n, (threaded, monitoring, net))
+            self.assertEqual(set([Callgraph.name(allocate), Callgraph.name(temporary)]), cg.call_set())
+            self.assertFalse(tracemalloc.is_tracing())
+        tracemalloc.start()
+        try:
+            tracer = Tracer(None, False, memory=True)
+            with tracer:
+                allocate(n)
+        finally:
+            tracemalloc.stop()
+        nodes = dict((node.name, node) for node in tracer.nodes())
+        self.assertTrue(2 * n <= nodes[Callgraph.name(temporary)].memory_peak.value < 2.5 * n)
+        self.assertTrue(abs(nodes[Callgraph.name(temporary)].memory_net.value) < n / 2)
+        self.assertTrue(3 * n <= nodes[Callgraph.name(allocate)].memory_peak.value)
+        self.assertIsNone(Callgraph().memory)
+
+    def test_nested_memory(self):
+        ''' A call measuring its memory inside another one does not hide the
+        outer call's allocations, traced or not.'''
+        global nested_outer, nested_inner
+        n = 1000000
+        def nested_inner(n):
+            return len(bytearray(n))
+        def nested_outer(n):
+            keep = bytearray(2 * n)
+            inner = Callgraph(memory=True, static=static)
+            inner.execute(nested_inner, n)
+            self.assertTrue(0.9 * n <= inner.memory[0] < 1.5 * n, inner.memory)
+            return keep
+        for static in (False, True) if analysis.SUPPORTED else (False,):
+            cg = Callgraph(memory=True, static=static)
+            keep = cg.execute(nested_outer, n)
+            peak, net = cg.memory
+            self.assertTrue(3 * n <= peak < 4 * n, (static, peak))
+            self.assertTrue(2 * n <= net < 2.5 * n, (static, net))
+
+    @unittest.skipUnless(analysis.SUPPORTED, 'Python < 3.11')
+    def test_static(self):
+        global func_inner, func_outer, func_callback
+        def func_inner(x):
+            return x
+        def func_outer(x):
+            return 2*func_inner(x)
+        def func_callback(f, x):
+            return f(x)
+        cg = Callgraph(static=True, memory=True)
+        cg.tracer = None # Not traced
+        self.assertEqual(6, cg.execute(func_outer, 3))
+        self.assertIsNone(cg.unresolved)
+        traced = Callgraph()
+        traced.execute(func_outer, 3)
+        self.assertEqual(traced.graph, cg.graph)
+        self.assertIsNotNone(cg.memory)
+        self.assertTrue(cg.unchanged())
+        def func_inner(x):
+            return x + 1
+        self.assertFalse(cg.unchanged())
+        # Calls the analysis cannot follow are traced.
+        cg = Callgraph(static=True)
+        self.assertEqual(4, cg.execute(func_callback, func_inner, 3))
+        self.assertIn('local variable f', cg.unresolved)
+        self.assertEqual(set([Callgraph.name(func_callback), Callgraph.name(func_inner)]), cg.call_set())
+        cg = Callgraph(static='verify')
+        cg.execute(func_callback, func_inner, 3)
+        self.assertEqual([Callgraph.name(func_inner)], cg.missed)
+
+    @unittest.skipUnless(analysis.SUPPORTED, 'Python < 3.11')
+    def test_static_async(self):
+        global func_inner, coroutine_outer
+        def func_inner(x):
+            return x
+        async def coroutine_outer(x):
+            return func_inner(x)
+        cg = Callgraph(static=True)
+        cg.tracer = None
+        self.assertEqual(3, asyncio.run(cg.execute_async(coroutine_outer, 3)))
+        self.assertEqual(set([Callgraph.name(coroutine_outer), Callgraph.name(func_inner)]), cg.call_set())
+
     def test_multiple_calls(self):
         ''' Call funcA once, then call funcB, make sure funcA does not appear in callgraph of funcB.'''
         pass
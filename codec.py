@@ -0,0 +1,106 @@
+'''Compression codecs for cached values. The codec used is recorded with each
+entry by name, so a cache may mix entries written with different codecs.
+lz4 and zstd are available when the lz4 or zstandard package is installed.
+'''
+import lzma
+import unittest
+import zlib
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+class Codec(object):
+    name = 'none'
+    def compress(self, data):
+        return data
+    def decompress(self, data):
+        return data
+
+
+class ZlibCodec(Codec):
+    name = 'zlib'
+    def __init__(self, level=1):
+        self.level = level
+    def compress(self, data):
+        return zlib.compress(data, self.level)
+    def decompress(self, data):
+        return zlib.decompress(data)
+
+
+class LzmaCodec(Codec):
+    name = 'lzma'
+    def __init__(self, preset=1):
+        self.preset = preset
+    def compress(self, data):
+        return lzma.compress(data, preset=self.preset)
+    def decompress(self, data):
+        return lzma.decompress(data)
+
+
+class Lz4Codec(Codec):
+    name = 'lz4'
+    def compress(self, data):
+        return lz4.frame.compress(data)
+    def decompress(self, data):
+        return lz4.frame.decompress(data)
+
+
+class ZstdCodec(Codec):
+    name = 'zstd'
+    def __init__(self, level=3):
+        self.level = level
+    def compress(self, data):
+        return zstandard.ZstdCompressor(level=self.level).compress(data)
+    def decompress(self, data):
+        return zstandard.ZstdDecompressor().decompress(data)
+
+
+codecs = dict()
+
+
+def register(codec):
+    ''' Makes codec available under codec.name, replacing any codec of that
+    name (e.g. to change the compression level). '''
+    codecs[codec.name] = codec
+
+
+def get_codec(name):
+    ''' Codec called name. None means no compression. '''
+    if name is None:
+        return codecs['none']
+    try:
+        return codecs[name]
+    except KeyError:
+        raise ValueError('Codec %s is not available.' % name)
+
+
+register(Codec())
+register(ZlibCodec())
+register(LzmaCodec())
+if lz4 is not None:
+    register(Lz4Codec())
+if zstandard is not None:
+    register(ZstdCodec())
+
+
+class CodecTest(unittest.TestCase):
+    def test_roundtrip(self):
+        data = b'pycache' * 1000
+        for name, codec in codecs.items():
+            self.assertEqual(data, codec.decompress(codec.compress(data)), name)
+        self.assertLess(len(get_codec('zlib').compress(data)), len(data))
+
+    def test_unknown_codec(self):
+        with self.assertRaises(ValueError):
+            get_codec('no-such-codec')
+        self.assertEqual('none', get_codec(None).name)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,334 @@
+'''Eviction policies keeping a cache within a capacity of bytes and/or
+entries. Each policy keeps a heap of entry priorities; an update pushes a new
+heap item and outdated items are skipped when popping, so inserts, accesses
+and evictions cost O(log n).
+'''
+import heapq
+import itertools
+import unittest
+
+
+class Policy(object):
+    ''' Evicts the entry with the lowest priority. Subclasses define the
+    priority of an entry when it is inserted and when it is accessed. '''
+
+    def __init__(self):
+        self.heap = []
+        # Current priority per key. Heap items with another priority are stale.
+        self.priorities = dict()
+        self.ticks = itertools.count()
+
+    def __len__(self):
+        return len(self.priorities)
+
+    def insert(self, key, size, cost, hits=0):
+        ''' hits is the number of times a stored entry was used before. '''
+        self.push(key, self.inserted(key, size, cost, hits))
+
+    def access(self, key):
+        if key in self.priorities:
+            self.push(key, self.accessed(key))
+
+    def remove(self, key):
+        self.priorities.pop(key, None)
+
+    def pop(self):
+        ''' Removes and returns the key to evict next, None if empty. '''
+        while self.heap:
+            priority, key = heapq.heappop(self.heap)
+            if self.priorities.get(key, self) == priority:
+                del self.priorities[key]
+                self.evicted(key, priority)
+                return key
+        return None
+
+    def peek(self):
+        ''' The key pop() would return, without removing it. '''
+        while self.heap:
+            priority, key = self.heap[0]
+            if self.priorities.get(key, self) == priority:
+                return key
+            heapq.heappop(self.heap)
+        return None
+
+    def push(self, key, priority):
+        self.priorities[key] = priority
+        heapq.heappush(self.heap, (priority, key))
+        if len(self.heap) > 2 * len(self.priorities) + 64:
+            # Drop stale items.
+            self.heap = [(p, k) for k, p in self.priorities.items()]
+            heapq.heapify(self.heap)
+
+    def inserted(self, key, size, cost, hits):
+        raise NotImplementedError
+
+    def accessed(self, key):
+        raise NotImplementedError
+
+    def evicted(self, key, priority):
+        pass
+
+
+class LRUPolicy(Policy):
+    ''' Evicts the least recently used entry. '''
+    def inserted(self, key, size, cost, hits):
+        return next(self.ticks)
+
+    def accessed(self, key):
+        return next(self.ticks)
+
+
+class LFUPolicy(Policy):
+    ''' Evicts the least frequently used entry, the least recently used one
+    among equally frequent entries. '''
+    def inserted(self, key, size, cost, hits):
+        return (1 + hits, next(self.ticks))
+
+    def accessed(self, key):
+        return (self.priorities[key][0] + 1, next(self.ticks))
+
+
+class GreedyDualSizePolicy(Policy):
+    ''' GreedyDual-Size: the priority of an entry is L + cost / size, where
+    cost is the time it took to compute and L the priority of the last
+    evicted entry. Entries that are cheap to recompute but large go first,
+    and L ages entries that are not accessed any more. '''
+    def __init__(self):
+        Policy.__init__(self)
+        self.inflation = 0.0
+        self.values = dict()
+
+    def inserted(self, key, size, cost, hits):
+        self.values[key] = float(cost or 0) / max(size, 1)
+        return self.inflation + self.values[key]
+
+    def accessed(self, key):
+        return self.inflation + self.values[key]
+
+    def remove(self, key):
+        Policy.remove(self, key)
+        self.values.pop(key, None)
+
+    def evicted(self, key, priority):
+        self.inflation = priority
+        del self.values[key]
+
+
+policies = {
+    'lru': LRUPolicy,
+    'lfu': LFUPolicy,
+    'gds': GreedyDualSizePolicy,
+}
+
+
+class Usage(object):
+    ''' Bytes and entries used, with optional limits. '''
+    def __init__(self, max_bytes=None, max_entries=None):
+        self.bytes = 0
+        self.entries = 0
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+
+    def exceeded(self):
+        return ((self.max_bytes is not None and self.bytes > self.max_bytes) or
+                (self.max_entries is not None and self.entries > self.max_entries))
+
+    def fits(self, size):
+        ''' Whether another entry fits; size() returns its size in bytes and
+        is only called if bytes are limited. '''
+        return ((self.max_entries is None or self.entries < self.max_entries) and
+                (self.max_bytes is None or self.bytes + size() <= self.max_bytes))
+
+
+class Evictor(object):
+    ''' Tracks the size of every entry, globally and per function, and picks
+    entries to evict once a limit is exceeded. Keys are (funcname, args_key).
+
+    function_limits maps funcname to a dict with 'max_bytes' and/or
+    'max_entries' for that function alone.
+    '''
+
+    def __init__(self, policy='lru', max_bytes=None, max_entries=None,
+                 function_limits=None):
+        self.policy_class = policies[policy]
+        self.policy = self.policy_class()
+        self.function_limits = function_limits or {}
+        self.function_policies = dict()
+        self.sizes = dict()
+        self.total = Usage(max_bytes, max_entries)
+        self.functions = dict()
+
+    @classmethod
+    def from_config(cls, config):
+        ''' Evictor for the 'max_bytes', 'max_entries', 'eviction' and
+        'function_limits' keys of a cache config, None if it sets no limit. '''
+        if not (config.get('max_bytes') is not None or
+                config.get('max_entries') is not None or
+                config.get('function_limits')):
+            return None
+        return cls(config.get('eviction', 'lru'), config.get('max_bytes'),
+                   config.get('max_entries'), config.get('function_limits'))
+
+    def usage(self, funcname=None):
+        ''' Usage of funcname, or of the whole cache. '''
+        if funcname is None:
+            return self.total
+        try:
+            return self.functions[funcname]
+        except KeyError:
+            limits = self.function_limits.get(funcname, {})
+            usage = self.functions[funcname] = Usage(limits.get('max_bytes'),
+                                                     limits.get('max_entries'))
+            return usage
+
+    def insert(self, key, size, cost, hits=0):
+        ''' Accounts for a new or replaced entry, stored ones in the order
+        they were last used and with the number of hits they had. Returns the
+        keys to evict, which may include key itself if it doesn't fit at
+        all. '''
+        self.remove(key)
+        funcname = key[0]
+        self.sizes[key] = size
+        for usage in (self.total, self.usage(funcname)):
+            usage.bytes += size
+            usage.entries += 1
+        self.policy.insert(key, size, cost, hits)
+        if funcname in self.function_limits:
+            if funcname not in self.function_policies:
+                self.function_policies[funcname] = self.policy_class()
+            self.function_policies[funcname].insert(key, size, cost, hits)
+
+        victims = []
+        function_usage = self.usage(funcname)
+        while function_usage.exceeded():
+            victims.append(self.evict(self.function_policies[funcname]))
+        while self.total.exceeded():
+            victims.append(self.evict(self.policy))
+        return victims
+
+    def victim(self, key, size):
+        ''' The key inserting a new entry under key would evict first, None
+        if it fits. size() returns the size of the entry in bytes. '''
+        if key in self.sizes:
+            return None
+        funcname = key[0]
+        function_policy = self.function_policies.get(funcname)
+        if function_policy is not None and not self.usage(funcname).fits(size):
+            return function_policy.peek()
+        if not self.total.fits(size):
+            return self.policy.peek()
+        return None
+
+    def evict(self, policy):
+        key = policy.pop()
+        self.remove(key)
+        return key
+
+    def access(self, key):
+        self.policy.access(key)
+        function_policy = self.function_policies.get(key[0])
+        if function_policy is not None:
+            function_policy.access(key)
+
+    def remove(self, key):
+        size = self.sizes.pop(key, None)
+        if size is None:
+            return
+        for usage in (self.total, self.usage(key[0])):
+            usage.bytes -= size
+            usage.entries -= 1
+        self.policy.remove(key)
+        function_policy = self.function_policies.get(key[0])
+        if function_policy is not None:
+            function_policy.remove(key)
+
+    def clear(self):
+        for key in list(self.sizes):
+            self.remove(key)
+
+
+class EvictorTest(unittest.TestCase):
+    def test_lru(self):
+        evictor = Evictor('lru', max_entries=2)
+        self.assertEqual([], evictor.insert(('f', 'a'), 1, 1))
+        self.assertEqual([], evictor.insert(('f', 'b'), 1, 1))
+        evictor.access(('f', 'a'))
+        self.assertEqual([('f', 'b')], evictor.insert(('f', 'c'), 1, 1))
+        self.assertEqual(2, evictor.usage().entries)
+
+    def test_victim(self):
+        evictor = Evictor('lru', max_bytes=10)
+        evictor.insert(('f', 'a'), 4, 1)
+        evictor.insert(('f', 'b'), 4, 1)
+        self.assertIsNone(evictor.victim(('f', 'c'), lambda: 2))
+        self.assertEqual(('f', 'a'), evictor.victim(('f', 'c'), lambda: 3))
+        self.assertIsNone(evictor.victim(('f', 'a'), lambda: 3))
+        self.assertEqual(8, evictor.usage().bytes)
+
+    def test_lfu(self):
+        evictor = Evictor('lfu', max_entries=2)
+        evictor.insert(('f', 'a'), 1, 1)
+        evictor.insert(('f', 'b'), 1, 1)
+        evictor.access(('f', 'a'))
+        # b is older than c and used as rarely.
+        self.assertEqual([('f', 'b')], evictor.insert(('f', 'c'), 1, 1))
+        evictor.access(('f', 'c'))
+        evictor.access(('f', 'c'))
+        self.assertEqual(('f', 'a'), evictor.evict(evictor.policy))
+
+    def test_lfu_hits(self):
+        ''' Stored entries keep the hits they had. '''
+        evictor = Evictor('lfu', max_entries=2)
+        evictor.insert(('f', 'a'), 1, 1, hits=2)
+        evictor.insert(('f', 'b'), 1, 1)
+        self.assertEqual([('f', 'b')], evictor.insert(('f', 'c'), 1, 1))
+
+    def test_greedy_dual_size(self):
+        ''' Cheap to recompute but bulky entries are evicted first. '''
+        evictor = Evictor('gds', max_bytes=1000)
+        evictor.insert(('f', 'slow'), 100, 10.0)
+        evictor.insert(('f', 'bulky'), 800, 0.1)
+        self.assertEqual([('f', 'bulky')], evictor.insert(('f', 'new'), 200, 1.0))
+        self.assertEqual(300, evictor.usage().bytes)
+
+    def test_function_limits(self):
+        evictor = Evictor('lru', max_bytes=100,
+                          function_limits={'g': {'max_entries': 1}})
+        evictor.insert(('f', 'a'), 10, 1)
+        evictor.insert(('g', 'a'), 10, 1)
+        self.assertEqual([('g', 'a')], evictor.insert(('g', 'b'), 10, 1))
+        self.assertEqual(1, evictor.usage('g').entries)
+        self.assertEqual(2, evictor.usage().entries)
+        # Global eviction keeps per function usage up to date.
+        self.assertEqual([('f', 'a'), ('g', 'b')], evictor.insert(('h', 'a'), 95, 1))
+        self.assertEqual(0, evictor.usage('g').entries)
+
+    def test_oversized_entry(self):
+        evictor = Evictor('lru', max_bytes=10)
+        self.assertEqual([('f', 'a')], evictor.insert(('f', 'a'), 11, 1))
+        self.assertEqual(0, evictor.usage().bytes)
+
+    def test_replace_and_remove(self):
+        evictor = Evictor('gds', max_bytes=100)
+        evictor.insert(('f', 'a'), 10, 1)
+        evictor.insert(('f', 'a'), 20, 1)
+        self.assertEqual(20, evictor.usage('f').bytes)
+        evictor.remove(('f', 'a'))
+        self.assertEqual(0, evictor.usage().entries)
+        self.assertEqual(0, len(evictor.policy))
+
+    def test_stale_heap_items_dropped(self):
+        evictor = Evictor('lru', max_entries=10)
+        evictor.insert(('f', 'a'), 1, 1)
+        for i in range(1000):
+            evictor.access(('f', 'a'))
+        self.assertLess(len(evictor.policy.heap), 100)
+
+    def test_from_config(self):
+        self.assertIsNone(Evictor.from_config({'file': 'x'}))
+        evictor = Evictor.from_config({'max_bytes': 5, 'eviction': 'lfu'})
+        self.assertIsInstance(evictor.policy, LFUPolicy)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,386 @@
+'''Fingerprints of code and of call arguments which, unlike hash(), are the
+same in every interpreter run. Persistent caches rely on them to hit after a
+restart.
+'''
+import array
+import hashlib
+import os
+import subprocess
+import sys
+import types
+import unittest
+import weakref
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+DIGEST_SIZE = 16
+
+# Types whose repr() is a complete and stable description of the value.
+PLAIN_TYPES = (type(None), bool, int, float, complex, str, bytes,
+               type(Ellipsis))
+
+# Fingerprint per code object, see code_fingerprint(). Weak, so the code of
+# reloaded modules and discarded functions is not kept alive.
+code_fingerprints = weakref.WeakKeyDictionary()
+
+
+def encode(value):
+    ''' Stable byte representation of a constant or default value. Objects
+    of other types are represented by their type only, as their repr()
+    usually contains an address.
+    '''
+    kind = type(value)
+    if kind in PLAIN_TYPES:
+        return ('%s:%r' % (kind.__name__, value)).encode('utf-8', 'backslashreplace')
+    if kind is types.CodeType:
+        return b'code:' + code_fingerprint(value).encode()
+    if kind in (tuple, list):
+        return b'%s(%s)' % (kind.__name__.encode(),
+                            b','.join(encode(item) for item in value))
+    if kind in (frozenset, set):
+        # Iteration order of sets depends on the salted hash.
+        return b'%s(%s)' % (kind.__name__.encode(),
+                            b','.join(sorted(encode(item) for item in value)))
+    if kind is dict:
+        return b'dict(%s)' % b','.join(sorted(
+            encode(key) + b'=' + encode(item) for key, item in value.items()))
+    return ('object:%s.%s' % (kind.__module__, kind.__qualname__)).encode()
+
+
+def code_fingerprint(code):
+    ''' Digest of the bytecode, constants (including nested code objects),
+    names and signature of code. Memoized per code object.
+    '''
+    try:
+        return code_fingerprints[code]
+    except KeyError:
+        pass
+    digest = hashlib.blake2b(digest_size=DIGEST_SIZE)
+    digest.update(code.co_code)
+    digest.update(encode((code.co_argcount,
+                          getattr(code, 'co_posonlyargcount', 0),
+                          code.co_kwonlyargcount, code.co_flags,
+                          code.co_names, code.co_varnames)))
+    digest.update(encode(code.co_consts))
+    value = code_fingerprints[code] = digest.hexdigest()
+    return value
+
+
+def function_fingerprint(func):
+    ''' Fingerprint of the code of func together with its default arguments.
+    Returns None for objects without code, e.g. builtins.
+    '''
+    code = getattr(func, '__code__', None)
+    if code is None:
+        return None
+    defaults = getattr(func, '__defaults__', None)
+    kwdefaults = getattr(func, '__kwdefaults__', None)
+    if defaults is None and kwdefaults is None:
+        return code_fingerprint(code)
+    digest = hashlib.blake2b(code_fingerprint(code).encode(),
+                             digest_size=DIGEST_SIZE)
+    digest.update(encode((defaults, kwdefaults)))
+    return digest.hexdigest()
+
+
+class ArgumentFingerprinter(object):
+    '''Fingerprints the arguments of a call, see fingerprint().
+
+    Containers are walked canonically (dicts and sets independent of their
+    order). Objects supporting the buffer protocol, e.g. NumPy arrays, are
+    digested in place together with their type, format, shape and strides.
+    Handlers for other types can be added with register(); anything else is
+    pickled.
+
+    With memoize=True, fingerprints of read-only buffers are remembered per
+    object, so passing the same large array again does not rehash it. Only
+    use this if read-only arrays are never changed through a writable view
+    of the same memory.
+    '''
+
+    def __init__(self, memoize=False):
+        self.memoize = memoize
+        # type -> handler(fingerprinter, value) returning bytes
+        self.handlers = dict()
+        # id(buffer object) -> (weak reference, fingerprint)
+        self.memo = dict()
+
+    def register(self, kind, handler):
+        ''' Use handler(fingerprinter, value) -> bytes for values of type kind
+        and its subclasses.'''
+        self.handlers[kind] = handler
+
+    def fingerprint(self, args, kwargs):
+        text = self.encode_scalars(args, kwargs)
+        if text is not None:
+            return hashlib.blake2b(text, digest_size=DIGEST_SIZE).hexdigest()
+        digest = hashlib.blake2b(self.encode(args), digest_size=DIGEST_SIZE)
+        digest.update(b'dict()' if type(kwargs) is dict and not kwargs
+                      else self.encode(kwargs))
+        return digest.hexdigest()
+
+    def encode_scalars(self, args, kwargs):
+        ''' encode(args) + encode(kwargs) for the common case of calls whose
+        arguments are all of ARGUMENT_TYPES, else None. '''
+        if type(args) is not tuple or type(kwargs) is not dict:
+            return None
+        parts = []
+        for value in args:
+            form = SCALAR_FORMATS.get(type(value))
+            if form is None:
+                return None
+            parts.append(form % (value,))
+        text = 'tuple(%s)dict(' % ','.join(parts)
+        if kwargs:
+            items = []
+            for key, value in kwargs.items():
+                form = SCALAR_FORMATS.get(type(value))
+                if form is None:
+                    return None
+                items.append(('str:%r=' % key, form % (value,)))
+            items.sort()
+            text += ','.join([key + value for key, value in items])
+        return (text + ')').encode('utf-8', 'backslashreplace')
+
+    def encode(self, value):
+        kind = type(value)
+        if kind in ARGUMENT_TYPES:
+            return ('%s:%r' % (kind.__name__, value)).encode('utf-8', 'backslashreplace')
+        if kind is tuple:
+            return b'tuple(' + b','.join([self.encode(item) for item in value]) + b')'
+        if kind is list:
+            return b'list(' + b','.join([self.encode(item) for item in value]) + b')'
+        if kind is dict:
+            items = sorted([(self.encode(key), item) for key, item in value.items()],
+                           key=lambda pair: pair[0])
+            return b'dict(%s)' % b','.join([key + b'=' + self.encode(item)
+                                            for key, item in items])
+        if kind is frozenset or kind is set:
+            return b'%s(%s)' % (kind.__name__.encode(),
+                                b','.join(sorted([self.encode(item) for item in value])))
+        for base in kind.__mro__:
+            handler = self.handlers.get(base)
+            if handler is not None:
+                return handler(self, value)
+        try:
+            view = memoryview(value)
+        except (TypeError, ValueError):
+            pass
+        else:
+            with view:
+                return self.encode_buffer(value, view)
+        return self.encode_object(value)
+
+    def encode_buffer(self, value, view):
+        if self.memoize and view.readonly:
+            entry = self.memo.get(id(value))
+            if entry is not None and entry[0]() is value:
+                return entry[1]
+        kind = type(value)
+        digest = hashlib.blake2b(digest_size=DIGEST_SIZE)
+        digest.update(('%s.%s:%s:%s:%d:%r:%r:' % (
+            kind.__module__, kind.__qualname__, getattr(value, 'dtype', ''),
+            view.format, view.itemsize, view.shape, view.strides)).encode())
+        if view.c_contiguous:
+            digest.update(view)
+        else:
+            digest.update(view.tobytes())
+        encoded = b'buffer:' + digest.digest()
+        if self.memoize and view.readonly:
+            self.remember(value, encoded)
+        return encoded
+
+    def remember(self, value, encoded):
+        key = id(value)
+        memo = self.memo
+        try:
+            ref = weakref.ref(value, lambda ref: memo.pop(key, None))
+        except TypeError:
+            # Without a weak reference the id could be reused.
+            return
+        memo[key] = (ref, encoded)
+
+    def encode_object(self, value):
+        try:
+            data = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        except Exception as e:
+            raise TypeError('Cannot fingerprint argument of type %s: %s'
+                            % (type(value).__name__, e))
+        return b'pickle:' + hashlib.blake2b(data, digest_size=DIGEST_SIZE).digest()
+
+
+# Argument types encoded by their repr(). bytes go through the buffer path.
+ARGUMENT_TYPES = (type(None), bool, int, float, complex, str, type(Ellipsis))
+SCALAR_FORMATS = dict((kind, kind.__name__ + ':%r') for kind in ARGUMENT_TYPES)
+
+default_fingerprinter = ArgumentFingerprinter()
+
+
+def args_fingerprint(args, kwargs):
+    return default_fingerprinter.fingerprint(args, kwargs)
+
+
+class FingerprintTest(unittest.TestCase):
+    def test_constants(self):
+        def f(x):
+            return 2*x
+        def g(x):
+            return 3*x
+        self.assertEqual(f.__code__.co_code, g.__code__.co_code)
+        self.assertNotEqual(code_fingerprint(f.__code__), code_fingerprint(g.__code__))
+
+    def test_names(self):
+        def f(x):
+            return len(x)
+        def g(x):
+            return abs(x)
+        self.assertNotEqual(code_fingerprint(f.__code__), code_fingerprint(g.__code__))
+
+    def test_nested_code(self):
+        def f(x):
+            def inner(y):
+                return y + 1
+            return inner(x)
+        def g(x):
+            def inner(y):
+                return y + 2
+            return inner(x)
+        self.assertNotEqual(code_fingerprint(f.__code__), code_fingerprint(g.__code__))
+
+    def test_defaults(self):
+        def f(x, y=1, *, z='a'):
+            return x + y
+        def g(x, y=2, *, z='a'):
+            return x + y
+        def h(x, y=1, *, z='b'):
+            return x + y
+        self.assertEqual(code_fingerprint(f.__code__), code_fingerprint(g.__code__))
+        fingerprints = set(map(function_fingerprint, [f, g, h]))
+        self.assertEqual(3, len(fingerprints))
+        self.assertIsNone(function_fingerprint(len))
+
+    def test_identical_functions(self):
+        def f(x):
+            return {'a', 'b', 'c'} & x
+        def g(x):
+            return {'a', 'b', 'c'} & x
+        self.assertEqual(function_fingerprint(f), function_fingerprint(g))
+
+    def test_code_not_kept(self):
+        ''' Memoized fingerprints don't keep code objects alive.'''
+        namespace = {}
+        exec(compile('def f(x):\n    return x + 1', '<test>', 'exec'), namespace)
+        code = namespace.pop('f').__code__
+        fingerprint = code_fingerprint(code)
+        self.assertEqual(fingerprint, code_fingerprints[code])
+        code = weakref.ref(code)
+        self.assertIsNone(code())
+
+    def test_stable_across_runs(self):
+        ''' Fingerprints must not depend on the hash seed of the process.'''
+        script = ('import fingerprint\n'
+                  'def f(x, y=frozenset("abcdef")):\n'
+                  '    return x in {"u", "v", "w", "x", "y"} or x in y\n'
+                  'print(fingerprint.function_fingerprint(f))\n')
+        directory = os.path.dirname(os.path.abspath(__file__))
+        outputs = set()
+        for seed in ('1', '2', '3'):
+            env = dict(os.environ, PYTHONHASHSEED=seed)
+            outputs.add(subprocess.check_output([sys.executable, '-c', script],
+                                                cwd=directory, env=env))
+        self.assertEqual(1, len(outputs))
+
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+class ArgumentFingerprintTest(unittest.TestCase):
+    def test_unhashable_arguments(self):
+        self.assertEqual(args_fingerprint(([1, 2], {'a': [3]}), {}),
+                         args_fingerprint(([1, 2], {'a': [3]}), {}))
+        self.assertNotEqual(args_fingerprint(([1, 2],), {}),
+                            args_fingerprint(([1, 3],), {}))
+
+    def test_canonical_containers(self):
+        self.assertEqual(args_fingerprint((), {'a': 1, 'b': 2}),
+                         args_fingerprint((), {'b': 2, 'a': 1}))
+        self.assertEqual(args_fingerprint(({'x', 'y', 'z'},), None),
+                         args_fingerprint(({'z', 'y', 'x'},), None))
+        self.assertNotEqual(args_fingerprint(((1, 2),), None),
+                            args_fingerprint(([1, 2],), None))
+        self.assertNotEqual(args_fingerprint((1,), None),
+                            args_fingerprint((1.0,), None))
+
+    def test_scalars(self):
+        ''' Calls with scalar arguments are encoded as encode() would. '''
+        fingerprinter = ArgumentFingerprinter()
+        for args, kwargs in [((), {}), ((1, 'x', None), {}),
+                             ((2.5, True), {'b': 1j, 'a': '\\\'', 'ä': ...})]:
+            self.assertEqual(fingerprinter.encode(args) + fingerprinter.encode(kwargs),
+                             fingerprinter.encode_scalars(args, kwargs))
+        self.assertIsNone(fingerprinter.encode_scalars(((1,),), {}))
+        self.assertIsNone(fingerprinter.encode_scalars((), {'a': [1]}))
+        self.assertIsNone(fingerprinter.encode_scalars([1], None))
+
+    def test_buffers(self):
+        ints = array.array('i', [1, 2, 3, 4])
+        floats = array.array('f', [0.0] * 4)
+        floats_as_ints = array.array('i', floats.tobytes())
+        self.assertNotEqual(args_fingerprint((floats,), None),
+                            args_fingerprint((floats_as_ints,), None))
+        self.assertEqual(args_fingerprint((ints,), None),
+                         args_fingerprint((array.array('i', [1, 2, 3, 4]),), None))
+        view = memoryview(ints)
+        self.assertNotEqual(args_fingerprint((view,), None),
+                            args_fingerprint((view.cast('B').cast('i', (2, 2)),), None))
+        # Non-contiguous views are supported as well.
+        self.assertNotEqual(args_fingerprint((view[::2],), None),
+                            args_fingerprint((view[1::2],), None))
+
+    def test_memoize_readonly(self):
+        fingerprinter = ArgumentFingerprinter(memoize=True)
+        data = memoryview(b'x' * 1000)
+        first = fingerprinter.fingerprint((data,), None)
+        self.assertEqual(1, len(fingerprinter.memo))
+        self.assertEqual(first, fingerprinter.fingerprint((data,), None))
+        # Writable buffers are always rehashed.
+        fingerprinter.fingerprint((bytearray(10),), None)
+        self.assertEqual(1, len(fingerprinter.memo))
+        del data
+        self.assertEqual(0, len(fingerprinter.memo))
+
+    def test_register(self):
+        class Point(object):
+            def __init__(self, x):
+                self.x = x
+        fingerprinter = ArgumentFingerprinter()
+        fingerprinter.register(Point, lambda fp, value: fp.encode(value.x))
+        self.assertEqual(fingerprinter.fingerprint((Point(1),), None),
+                         fingerprinter.fingerprint((Point(1),), None))
+        self.assertNotEqual(fingerprinter.fingerprint((Point(1),), None),
+                            fingerprinter.fingerprint((Point(2),), None))
+
+    def test_unpicklable(self):
+        with self.assertRaises(TypeError):
+            args_fingerprint((lambda x: x,), None)
+
+    @unittest.skipIf(numpy is None, 'numpy is not installed')
+    def test_numpy(self):
+        a = numpy.arange(12, dtype=numpy.float64).reshape(3, 4)
+        self.assertEqual(args_fingerprint((a,), None), args_fingerprint((a.copy(),), None))
+        self.assertNotEqual(args_fingerprint((a,), None),
+                            args_fingerprint((a.astype(numpy.float32),), None))
+        self.assertNotEqual(args_fingerprint((a,), None),
+                            args_fingerprint((a.reshape(4, 3),), None))
+        self.assertNotEqual(args_fingerprint((a,), None),
+                            args_fingerprint((numpy.asfortranarray(a),), None))
+        self.assertEqual(args_fingerprint((a.T,), None), args_fingerprint((a.T,), None))
+
+
+if __name__ == '__main__':
+    unittest.main()
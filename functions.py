@@ -3,6 +3,8 @@ from beaker.util import parse_cache_config_options
 
 from functools import wraps
 
+from fingerprint import function_fingerprint
+
 
 def CustomCache():
     cache_opts = {
@@ -18,7 +20,7 @@ def CustomCache():
 
 def mycache(func):
     cache = CustomCache()
-    name = hash(func.__code__)
+    name = function_fingerprint(func)
     @wraps(func)
     @cache_region('long_term', name)
     def wrapper(*args, **kwds):
@@ -10,8 +10,12 @@ def func_c(x):
 
 
 if __name__ == '__main__':
+    from fingerprint import function_fingerprint
     print(hash(func_a.__code__.co_code))
     print(hash(func_b.__code__.co_code))
     print(hash(func_c.__code__.co_code))
     print(hash(func_a.__code__))
     print(hash(func_b.__code__))
+    print(function_fingerprint(func_a))
+    print(function_fingerprint(func_b))
+    print(function_fingerprint(func_c))
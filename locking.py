@@ -0,0 +1,155 @@
+'''Exclusive locks on files, shared by processes and threads. A lock is held
+per open file, so two threads of one process opening the same lock file
+exclude each other just like two processes do. fcntl.flock is used where
+available, msvcrt.locking on Windows.
+'''
+import os
+import subprocess
+import sys
+import threading
+import time
+import unittest
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+    import msvcrt
+
+
+class FileLock(object):
+    ''' Lock on path, which is created if needed. Usable as a context
+    manager; not reentrant.
+
+    With remove, path is removed on release(), so lock files do not pile up
+    for locks taken once, e.g. per cache entry. Whoever waited for it then
+    holds a lock on the removed file, notices and locks path anew. Removing
+    needs fcntl; on Windows path is kept.
+    '''
+
+    def __init__(self, path, remove=False):
+        self.path = path
+        self.file = None
+        self.remove = remove and fcntl is not None
+
+    def acquire(self, blocking=True):
+        ''' Returns False if blocking is false and the lock is held elsewhere. '''
+        directory = os.path.dirname(self.path)
+        while True:
+            if directory and not os.path.isdir(directory):
+                os.makedirs(directory, exist_ok=True)
+            f = open(self.path, 'a+b')
+            try:
+                if not self.lock_file(f, blocking):
+                    f.close()
+                    return False
+            except BaseException:
+                f.close()
+                raise
+            if not self.remove or self.current(f):
+                break
+            f.close()
+        self.file = f
+        return True
+
+    def current(self, f):
+        ''' Whether path is still the file f locked. '''
+        try:
+            return os.path.samestat(os.stat(self.path), os.fstat(f.fileno()))
+        except FileNotFoundError:
+            return False
+
+    def release(self):
+        f, self.file = self.file, None
+        if self.remove:
+            # Still held, so nobody can have locked the path meanwhile.
+            os.remove(self.path)
+        if fcntl is not None:
+            fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+        else:
+            f.seek(0)
+            msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+        f.close()
+
+    def locked(self):
+        return self.file is not None
+
+    def lock_file(self, f, blocking):
+        if fcntl is not None:
+            try:
+                fcntl.flock(f.fileno(), fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+            except BlockingIOError:
+                return False
+            return True
+        while True:
+            try:
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_NBLCK, 1)
+                return True
+            except OSError:
+                if not blocking:
+                    return False
+                time.sleep(0.01)
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.release()
+
+
+class FileLockTest(unittest.TestCase):
+    path = 'locking.test.lock'
+
+    def tearDown(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def test_threads_exclude_each_other(self):
+        lock = FileLock(self.path)
+        self.assertTrue(lock.acquire())
+        other = FileLock(self.path)
+        self.assertFalse(other.acquire(blocking=False))
+        acquired = []
+        def wait():
+            with FileLock(self.path):
+                acquired.append(time.time())
+        thread = threading.Thread(target=wait)
+        thread.start()
+        time.sleep(0.1)
+        self.assertEqual([], acquired)
+        lock.release()
+        thread.join()
+        self.assertEqual(1, len(acquired))
+        self.assertTrue(other.acquire(blocking=False))
+        other.release()
+
+    @unittest.skipIf(fcntl is None, 'lock files are kept on Windows')
+    def test_remove(self):
+        lock = FileLock(self.path, remove=True)
+        self.assertTrue(lock.acquire())
+        acquired = []
+        def wait():
+            waiting = FileLock(self.path, remove=True)
+            waiting.acquire()
+            # Holds the lock on the file now at path, not the removed one.
+            acquired.append(FileLock(self.path).acquire(blocking=False))
+            waiting.release()
+        thread = threading.Thread(target=wait)
+        thread.start()
+        time.sleep(0.1)
+        lock.release()
+        thread.join()
+        self.assertEqual([False], acquired)
+        self.assertFalse(os.path.exists(self.path))
+
+    def test_processes_exclude_each_other(self):
+        script = ('import sys; from locking import FileLock; '
+                  'sys.exit(0 if FileLock(%r).acquire(blocking=False) else 3)' % self.path)
+        with FileLock(self.path):
+            self.assertEqual(3, subprocess.call([sys.executable, '-c', script]))
+        self.assertEqual(0, subprocess.call([sys.executable, '-c', script]))
+
+
+if __name__ == '__main__':
+    unittest.main()
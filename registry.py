@@ -0,0 +1,217 @@
+import hashlib
+import importlib
+import sys
+import types
+import unittest
+
+from fingerprint import DIGEST_SIZE, code_fingerprint, function_fingerprint
+
+
+class CodeRegistry(object):
+    '''Process-wide mapping from the function names recorded in a Callgraph
+    to the functions currently bound under those names and their fingerprints.
+
+    Names are resolved once through importlib. After that, checking a name
+    costs a dict lookup and an identity check of the bound function; the
+    fingerprint is only recomputed when a function has been redefined. All
+    resolved names are dropped whenever a tracked module is (re)imported.
+
+    Names of code not bound to an attribute, e.g. lambdas and the functions
+    nested in others (qualified names with <lambda> or <locals>), are
+    resolved to the code of that qualified name in their module's code, as
+    compiled from its file. Where a name cannot be resolved, self.captured
+    holds the fingerprint of the code last traced under it in this process.
+    '''
+
+    def __init__(self):
+        # name -> [namespace, attribute, function, fingerprint], with
+        # attribute None for names resolved in the module's code.
+        self.bindings = dict()
+        # Modules that names have been resolved in.
+        self.modules = set()
+        # Module name -> qualified name -> code objects, see module_code().
+        self.module_codes = dict()
+        # Name -> fingerprint of the code traced under it, see TraceProcessor.
+        self.captured = dict()
+
+    def forget(self):
+        ''' Drops all resolved names. '''
+        self.bindings.clear()
+        self.module_codes.clear()
+
+    def code_hash(self, code):
+        return code_fingerprint(code)
+
+    def current_hash(self, name):
+        ''' Returns the fingerprint of the function currently bound to name, or
+        None if name does not resolve to a function.
+        '''
+        try:
+            binding = self.bindings[name]
+        except KeyError:
+            binding = self.bindings[name] = self.resolve(name)
+        namespace, attribute, func, value = binding
+        if namespace is None:
+            return None
+        if attribute is None:
+            return value
+        if isinstance(namespace, type):
+            current = static_attribute(namespace, attribute)
+        else:
+            current = getattr(namespace, attribute, None)
+        if current is not func:
+            # Redefined since the last check.
+            binding[2] = current
+            binding[3] = value = self.function_hash(current)
+        return value
+
+    def function_hash(self, func):
+        # Decorated functions are bound to their wrapper, see functools.wraps,
+        # and staticmethods and classmethods wrap theirs.
+        while True:
+            inner = getattr(func, '__wrapped__', None)
+            if inner is None:
+                inner = getattr(func, '__func__', None)
+            if inner is None:
+                return function_fingerprint(func)
+            func = inner
+
+    def resolve(self, name):
+        ''' Finds the namespace (module or class) and attribute which name
+        refers to. Names are module-qualified as built by the tracer, except
+        for functions in __main__.
+        '''
+        parts = name.split('.')
+        module, rest = self.find_module(parts)
+        if module is None:
+            return [None, None, None, None]
+        self.modules.add(module.__name__)
+        if any(part.startswith('<') for part in rest):
+            return [module, None, None, self.code_hash_of(module, '.'.join(rest))]
+        namespace = module
+        for attribute in rest[:-1]:
+            namespace = static_attribute(namespace, attribute)
+            if namespace is None:
+                return [None, None, None, None]
+        func = static_attribute(namespace, rest[-1])
+        return [namespace, rest[-1], func, self.function_hash(func)]
+
+    def code_hash_of(self, module, qualname):
+        ''' Fingerprint of the code of qualname in module, combined if there
+        are several, e.g. lambdas. None if there is none. '''
+        codes = self.module_code(module).get(qualname)
+        if not codes:
+            return None
+        if len(codes) == 1:
+            return code_fingerprint(codes[0])
+        digest = hashlib.blake2b(digest_size=DIGEST_SIZE)
+        for fingerprint in sorted(code_fingerprint(code) for code in codes):
+            digest.update(fingerprint.encode())
+        return digest.hexdigest()
+
+    def module_code(self, module):
+        ''' Qualified name -> code objects of module, as compiled from its
+        file by its loader. Empty if it has none. '''
+        try:
+            return self.module_codes[module.__name__]
+        except KeyError:
+            pass
+        codes = self.module_codes[module.__name__] = dict()
+        spec = getattr(module, '__spec__', None)
+        try:
+            code = module.__loader__.get_code(spec.name if spec else module.__name__)
+        except Exception:
+            code = None
+        pending = [code] if code is not None else []
+        while pending:
+            code = pending.pop()
+            codes.setdefault(code.co_qualname, []).append(code)
+            pending.extend(const for const in code.co_consts
+                           if isinstance(const, types.CodeType))
+        return codes
+
+    def find_module(self, parts):
+        ''' Splits parts into the longest module name prefix and the
+        attributes which follow it.
+        '''
+        for i in range(len(parts) - 1, 0, -1):
+            module = sys.modules.get('.'.join(parts[:i]))
+            if module is not None:
+                return module, parts[i:]
+        main = sys.modules.get('__main__')
+        if main is not None and (hasattr(main, parts[0]) or parts[0].startswith('<')):
+            return main, parts
+        for i in range(len(parts) - 1, 0, -1):
+            try:
+                return importlib.import_module('.'.join(parts[:i])), parts[i:]
+            except ImportError:
+                pass
+        return None, parts
+
+
+def static_attribute(namespace, attribute):
+    ''' Attribute of namespace as stored in it. Methods of classes are
+    looked up in the classes' dicts, as getattr() binds classmethods anew
+    each time. None if there is no such attribute. '''
+    if isinstance(namespace, type):
+        for base in namespace.__mro__:
+            if attribute in vars(base):
+                return vars(base)[attribute]
+        return None
+    return getattr(namespace, attribute, None)
+
+
+class ImportWatcher(object):
+    ''' Meta path finder which never finds anything but makes the registry
+    forget its resolved names whenever a module it has resolved names in is
+    imported again or reloaded.
+    '''
+
+    def __init__(self, registry):
+        self.registry = registry
+
+    def find_spec(self, fullname, path=None, target=None):
+        if target is not None or fullname in self.registry.modules:
+            self.registry.forget()
+        return None
+
+
+registry = CodeRegistry()
+sys.meta_path.insert(0, ImportWatcher(registry))
+
+
+def registered_func(x):
+    return x
+
+
+class CodeRegistryTest(unittest.TestCase):
+    def test_other_module(self):
+        import hashcomparison
+        self.assertEqual(function_fingerprint(hashcomparison.func_a),
+                         registry.current_hash('hashcomparison.func_a'))
+
+    def test_unresolvable(self):
+        self.assertIsNone(registry.current_hash('registry.no_such_func'))
+        self.assertIsNone(registry.current_hash('no_such_module.func'))
+
+    def test_redefinition(self):
+        global registered_func
+        name = '%s.registered_func' % __name__
+        if __name__ == '__main__':
+            name = 'registered_func'
+        before = registry.current_hash(name)
+        self.assertEqual(before, registry.current_hash(name))
+        def registered_func(x):
+            return x + 1
+        self.assertNotEqual(before, registry.current_hash(name))
+
+    def test_reload(self):
+        import hashcomparison
+        value = registry.current_hash('hashcomparison.func_b')
+        importlib.reload(hashcomparison)
+        self.assertNotIn('hashcomparison.func_b', registry.bindings)
+        self.assertEqual(value, registry.current_hash('hashcomparison.func_b'))
+
+
+if __name__ == '__main__':
+    unittest.main()
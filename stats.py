@@ -0,0 +1,216 @@
+'''Counters of cache use per function: hits, misses, invalidations, bytes
+read and written, lookup latency and the compute time hits have saved.
+Hooks receive every event as it is counted, e.g. to forward it to a metrics
+system.
+'''
+import unittest
+
+
+# Lookup latencies are counted in buckets of powers of two microseconds:
+# bucket i holds latencies from 2**(i-1) up to 2**i us, bucket 0 those
+# below 1 us.
+LATENCY_BUCKETS = 32
+
+
+class FunctionStats(object):
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self.code_invalidations = 0
+        self.callgraph_invalidations = 0
+        self.rejections = 0
+        self.bytes_read = 0
+        self.bytes_written = 0
+        self.time_saved = 0.0
+        self.latency = [0] * LATENCY_BUCKETS
+
+    def count_latency(self, seconds):
+        bucket = int(seconds * 1e6).bit_length()
+        self.latency[min(bucket, LATENCY_BUCKETS - 1)] += 1
+
+    def latency_percentile(self, percent):
+        ''' Upper bound in seconds of the bucket holding the percentile, None
+        if nothing was looked up. '''
+        total = sum(self.latency)
+        if not total:
+            return None
+        rank = total * percent / 100.0
+        seen = 0
+        for bucket, count in enumerate(self.latency):
+            seen += count
+            if count and seen >= rank:
+                return 2 ** bucket * 1e-6
+        return 2 ** (LATENCY_BUCKETS - 1) * 1e-6
+
+    def add(self, other):
+        for name in ('hits', 'misses', 'code_invalidations', 'callgraph_invalidations',
+                     'rejections', 'bytes_read', 'bytes_written', 'time_saved'):
+            setattr(self, name, getattr(self, name) + getattr(other, name))
+        self.latency = [a + b for a, b in zip(self.latency, other.latency)]
+
+    def as_dict(self):
+        lookups = self.hits + self.misses
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': float(self.hits) / lookups if lookups else None,
+                'code_invalidations': self.code_invalidations,
+                'callgraph_invalidations': self.callgraph_invalidations,
+                'rejections': self.rejections,
+                'bytes_read': self.bytes_read,
+                'bytes_written': self.bytes_written,
+                'time_saved': self.time_saved,
+                'latency_buckets': list(self.latency),
+                'latency_p50': self.latency_percentile(50),
+                'latency_p99': self.latency_percentile(99)}
+
+
+class Stats(object):
+    ''' Statistics of one cache. Hooks added with add_hook() are called as
+    hook(event, funcname, value) for each event counted:
+
+    'hit': value is the lookup latency in seconds
+    'miss': value is the lookup latency in seconds
+    'invalidated': value is 'code' or 'callgraph'
+    'saved': value is the running time of the function a hit did not repeat
+    'rejected': a computed value was not stored, see Cache.admit(); value
+        is None
+    'read', 'written': value is a number of bytes
+    '''
+
+    def __init__(self):
+        self.functions = dict()
+        self.hooks = []
+
+    def function(self, funcname):
+        try:
+            return self.functions[funcname]
+        except KeyError:
+            stats = self.functions[funcname] = FunctionStats()
+            return stats
+
+    def add_hook(self, hook):
+        self.hooks.append(hook)
+
+    def remove_hook(self, hook):
+        self.hooks.remove(hook)
+
+    def emit(self, event, funcname, value):
+        for hook in self.hooks:
+            hook(event, funcname, value)
+
+    def hit(self, funcname, latency, runningtime):
+        try:
+            stats = self.functions[funcname]
+        except KeyError:
+            stats = self.function(funcname)
+        stats.hits += 1
+        # FunctionStats.count_latency(), inlined as hits are counted often.
+        stats.latency[min(int(latency * 1e6).bit_length(), LATENCY_BUCKETS - 1)] += 1
+        if runningtime:
+            stats.time_saved += runningtime
+        if self.hooks:
+            self.emit('hit', funcname, latency)
+            if runningtime:
+                self.emit('saved', funcname, runningtime)
+
+    def miss(self, funcname, latency, reason=None):
+        ''' Counts a miss; reason is 'code' or 'callgraph' if it invalidated
+        entries. '''
+        stats = self.function(funcname)
+        stats.misses += 1
+        stats.count_latency(latency)
+        if self.hooks:
+            self.emit('miss', funcname, latency)
+        if reason is not None:
+            self.invalidated(funcname, reason)
+
+    def invalidated(self, funcname, reason):
+        stats = self.function(funcname)
+        if reason == 'code':
+            stats.code_invalidations += 1
+        elif reason == 'callgraph':
+            stats.callgraph_invalidations += 1
+        if self.hooks:
+            self.emit('invalidated', funcname, reason)
+
+    def rejected(self, funcname):
+        self.function(funcname).rejections += 1
+        if self.hooks:
+            self.emit('rejected', funcname, None)
+
+    def read(self, funcname, size):
+        self.function(funcname).bytes_read += size
+        if self.hooks:
+            self.emit('read', funcname, size)
+
+    def written(self, funcname, size):
+        self.function(funcname).bytes_written += size
+        if self.hooks:
+            self.emit('written', funcname, size)
+
+    def total(self):
+        total = FunctionStats()
+        for stats in self.functions.values():
+            total.add(stats)
+        return total
+
+    def snapshot(self):
+        ''' All counters as plain data, by funcname, with the sum of all
+        functions under None. '''
+        snapshot = dict((funcname, stats.as_dict())
+                        for funcname, stats in self.functions.items())
+        snapshot[None] = self.total().as_dict()
+        return snapshot
+
+    def reset(self):
+        self.functions.clear()
+
+
+class StatsTest(unittest.TestCase):
+    def test_counters(self):
+        stats = Stats()
+        stats.hit('f', 3e-6, 2.0)
+        stats.hit('f', 5e-6, None)
+        stats.miss('f', 1e-3, 'callgraph')
+        stats.miss('g', 1e-3, 'code')
+        stats.miss('g', 1e-3)
+        stats.read('f', 10)
+        stats.written('g', 20)
+        stats.rejected('g')
+        f = stats.snapshot()['f']
+        self.assertEqual((2, 1, 0, 1), (f['hits'], f['misses'], f['code_invalidations'],
+                                        f['callgraph_invalidations']))
+        self.assertEqual(2.0, f['time_saved'])
+        self.assertEqual(10, f['bytes_read'])
+        total = stats.snapshot()[None]
+        self.assertEqual(3, total['misses'])
+        self.assertEqual(20, total['bytes_written'])
+        self.assertEqual(1, total['rejections'])
+        self.assertAlmostEqual(0.4, total['hit_ratio'])
+
+    def test_latency_percentiles(self):
+        stats = Stats()
+        for i in range(99):
+            stats.hit('f', 3e-6, None)
+        stats.miss('f', 0.5)
+        f = stats.function('f')
+        self.assertEqual(4e-6, f.latency_percentile(50))
+        self.assertEqual(4e-6, f.latency_percentile(99))
+        self.assertLessEqual(0.5, f.latency_percentile(100))
+        self.assertIsNone(stats.function('g').latency_percentile(50))
+
+    def test_hooks(self):
+        stats = Stats()
+        events = []
+        hook = lambda *event: events.append(event)
+        stats.add_hook(hook)
+        stats.hit('f', 1e-6, 3.0)
+        stats.miss('f', 1e-6, 'code')
+        stats.remove_hook(hook)
+        stats.read('f', 1)
+        self.assertEqual([('hit', 'f', 1e-6), ('saved', 'f', 3.0),
+                          ('miss', 'f', 1e-6), ('invalidated', 'f', 'code')], events)
+
+
+if __name__ == '__main__':
+    unittest.main()
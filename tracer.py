@@ -4,13 +4,20 @@ import inspect
 import sys
 import os
 import time
-from distutils import sysconfig
+import sysconfig
+import tracemalloc
+import types
+import unittest
+import weakref
 from collections import defaultdict
-from threading import Thread
+from contextvars import ContextVar
+from threading import Thread, get_ident, local
+
+from registry import registry
 try:
-    from Queue import Queue, Empty
+    from Queue import Queue
 except ImportError:
-    from queue import Queue, Empty
+    from queue import Queue
 
 class Config():
     def __init__(self):
@@ -22,11 +29,64 @@ class Config():
 
 
 
-def Tracer(output, threaded):
+# sys.monitoring (PEP 669) is available from Python 3.12 onwards.
+HAS_MONITORING = hasattr(sys, 'monitoring')
+
+# Code objects know their qualified name from Python 3.11 on. Functions are
+# named by it then, which names methods, lambdas and nested functions
+# unambiguously; before, by their name and the class of self.
+QUALNAMES = hasattr(types.CodeType, 'co_qualname')
+
+# Tracers running in each thread, innermost last. A tracer started while
+# another one runs pauses it until it is done, so calls are only seen by the
+# innermost tracer.
+running = local()
+
+# The innermost memory measurement open in the context, see open_memory():
+# [traced memory at its start, highest traced memory since, enclosing one].
+memory_measurement = ContextVar('memory_measurement', default=None)
+
+
+def open_memory():
+    ''' Starts measuring the memory allocated until close_memory(). As
+    tracemalloc's peak is global, the peak so far is kept by the enclosing
+    measurement before it is reset. Returns the token for close_memory(). '''
+    current = sample_memory()[0]
+    return memory_measurement.set([current, current, memory_measurement.get()])
+
+def close_memory(token):
+    ''' Ends the measurement started by open_memory(). Returns its peak and
+    net allocation, in bytes, which count towards the enclosing one. '''
+    current, peak = tracemalloc.get_traced_memory()
+    start, highest, outer = memory_measurement.get()
+    memory_measurement.reset(token)
+    highest = max(highest, peak)
+    if outer is not None and highest > outer[1]:
+        outer[1] = highest
+    return (highest - start, current - start)
+
+def sample_memory():
+    ''' The memory traced by tracemalloc and its peak since the previous
+    sample, in bytes. The peak is kept by the open measurement. '''
+    sample = tracemalloc.get_traced_memory()
+    tracemalloc.reset_peak()
+    measurement = memory_measurement.get()
+    if measurement is not None and sample[1] > measurement[1]:
+        measurement[1] = sample[1]
+    return sample
+
+
+def Tracer(output, threaded, monitoring=False, memory=False):
+    ''' memory accounts for the memory allocated by each function, see
+    TraceProcessor.process(). tracemalloc must be tracing while the tracer
+    runs. '''
     outputs = [output]
     config = Config()
     config.threaded = threaded
-    if threaded:
+    config.memory = memory
+    if monitoring:
+        return MonitoringTracer(outputs, config)
+    elif threaded:
         return AsyncronousTracer(outputs, config)
     else:
         return SyncronousTracer(outputs, config)
@@ -39,13 +99,16 @@ class SyncronousTracer(object):
         self.config = config
 
     def tracer(self, frame, event, arg):
-        self.processor.process(frame, event, arg, self.memory())
+        # Line events are of no interest, see AsyncronousTracer.tracer().
+        if event == 'call' or event == 'return':
+            self.processor.process(frame, event, arg, self.memory())
         return self.tracer
 
     def memory(self):
+        ''' Sample for TraceProcessor.process(): the memory traced by
+        tracemalloc and its peak since the previous sample, in bytes. '''
         if self.config.memory:
-            from .memory_profiler import memory_usage
-            return int(memory_usage(-1, 0)[0] * 1000000)
+            return sample_memory()
     def nodes(self):
         return self.processor.nodes()
 
@@ -55,13 +118,36 @@ class SyncronousTracer(object):
     def stop(self):
         sys.settrace(None)
 
+    def pause(self):
+        sys.settrace(None)
+
+    def resume(self):
+        sys.settrace(self.tracer)
+
     def done(self):
         pass
+    def enter(self):
+        ''' Makes this the running tracer of the thread, pausing the one
+        that was running. '''
+        tracers = running.__dict__.setdefault('tracers', [])
+        if tracers:
+            tracers[-1].pause()
+        tracers.append(self)
+
+    def leave(self):
+        ''' Resumes the tracer that was running before enter(). '''
+        tracers = running.tracers
+        tracers.pop()
+        if tracers:
+            tracers[-1].resume()
+
     def __enter__(self):
+        self.enter()
         self.start()
     def __exit__(self, type, value, traceback):
         self.stop()
         self.done()
+        self.leave()
 
 
 class AsyncronousTracer(SyncronousTracer):
@@ -71,7 +157,9 @@ class AsyncronousTracer(SyncronousTracer):
         SyncronousTracer.start(self)
 
     def tracer(self, frame, event, arg):
-        self.processor.queue(frame, event, arg, self.memory())
+        # Only calls and returns are processed, so line events are not queued.
+        if event == 'call' or event == 'return':
+            self.processor.queue(frame, event, arg, self.memory())
         return self.tracer
 
     def done(self):
@@ -79,26 +167,166 @@ class AsyncronousTracer(SyncronousTracer):
         self.processor.join()
 
 
+class MonitoringTracer(SyncronousTracer):
+    '''Tracer built on sys.monitoring (PEP 669) instead of sys.settrace.
+
+    Only PY_START is subscribed to. The first activation of each code object
+    is handed to the TraceProcessor, after which DISABLE is returned so the
+    interpreter stops reporting that code object. Its PY_RETURN is enabled
+    for that code object alone until the frame returns. Call counts and
+    times therefore reflect the first activation only, while names and
+    hashes are the same as with the settrace based tracers.
+
+    Locations disabled for a tool id stay so until the global
+    sys.monitoring.restart_events(), which also affects other tools. A
+    trace therefore claims a tool id nothing was disabled for if there is
+    one, and restarts events only when there is none.
+    '''
+
+    # Tool ids with locations disabled since the last restart_events().
+    disabled_tools = set()
+
+    def __init__(self, outputs, config):
+        SyncronousTracer.__init__(self, outputs, config)
+        self.tool_id = None
+        # Frames handed to the processor which have not returned yet, in the
+        # order they were called; a dict for constant time membership.
+        self.frames = dict()
+
+    def claim_tool_id(self):
+        ''' Claims a free sys.monitoring tool id, None if there is none. '''
+        monitoring = sys.monitoring
+        candidates = [monitoring.PROFILER_ID] + list(range(6))
+        candidates.sort(key=lambda tool_id: tool_id in self.disabled_tools)
+        for tool_id in candidates:
+            if monitoring.get_tool(tool_id) is None:
+                try:
+                    monitoring.use_tool_id(tool_id, 'pycache')
+                except ValueError: # Claimed by another thread meanwhile
+                    continue
+                return tool_id
+        return None
+
+    def start(self):
+        monitoring = sys.monitoring
+        events = monitoring.events
+        self.thread_id = get_ident()
+        self.tool_id = self.claim_tool_id()
+        if self.tool_id is None:
+            # More calls are traced at once than there are tool ids, e.g. by
+            # threads or tasks: this one falls back to sys.settrace.
+            SyncronousTracer.start(self)
+            return
+        monitoring.register_callback(self.tool_id, events.PY_START,
+                                     self.py_start)
+        monitoring.register_callback(self.tool_id, events.PY_RETURN,
+                                     self.py_return)
+        if self.tool_id in self.disabled_tools:
+            # Events disabled during an earlier trace have to be reported again.
+            monitoring.restart_events()
+            self.disabled_tools.clear()
+        self.disabled_tools.add(self.tool_id)
+        monitoring.set_events(self.tool_id, events.PY_START)
+
+    def stop(self):
+        if self.tool_id is None:
+            SyncronousTracer.stop(self)
+            return
+        monitoring = sys.monitoring
+        events = monitoring.events
+        monitoring.set_events(self.tool_id, 0)
+        # Frames left by exceptions or suspended generators.
+        while self.frames:
+            self.pop_frame()
+        # Also if another trace restarted events meanwhile.
+        self.disabled_tools.add(self.tool_id)
+        monitoring.register_callback(self.tool_id, events.PY_START, None)
+        monitoring.register_callback(self.tool_id, events.PY_RETURN, None)
+        monitoring.free_tool_id(self.tool_id)
+        self.tool_id = None
+
+    def pause(self):
+        if self.tool_id is None:
+            SyncronousTracer.pause(self)
+            return
+        sys.monitoring.set_events(self.tool_id, 0)
+
+    def resume(self):
+        if self.tool_id is None:
+            SyncronousTracer.resume(self)
+            return
+        sys.monitoring.set_events(self.tool_id, sys.monitoring.events.PY_START)
+
+    def py_start(self, code, instruction_offset):
+        if get_ident() != self.thread_id:
+            return None
+        frame = sys._getframe(1)
+        self.frames[frame] = None
+        sys.monitoring.set_local_events(self.tool_id, code, sys.monitoring.events.PY_RETURN)
+        self.processor.process(frame, 'call', None, self.memory())
+        return sys.monitoring.DISABLE
+
+    def py_return(self, code, instruction_offset, retval):
+        frame = sys._getframe(1)
+        if frame not in self.frames:
+            # Recursive activation or another thread.
+            return None
+        # Frames above this one were left by exceptions or generators.
+        while self.pop_frame() is not frame:
+            pass
+        return None
+
+    def pop_frame(self):
+        frame, _ = self.frames.popitem()
+        sys.monitoring.set_local_events(self.tool_id, frame.f_code, 0)
+        self.processor.process(frame, 'return', None, self.memory())
+        return frame
+
+
 class TraceProcessor(Thread):
     '''
     Contains a callback used by sys.settrace, which collects information about
     function call count, time taken, etc.
     '''
 
+    # (full_name, code hash, is stdlib) per code object, shared by all
+    # processors. See describe(). Like enclosing, weak, so the code of
+    # reloaded modules and discarded functions is not kept alive.
+    code_info = weakref.WeakKeyDictionary()
+    # Full name of the outermost function enclosing nested code objects
+    # (comprehensions, lambdas, inner functions), see describe(). Nested
+    # code cannot be looked up by name, and it is left out where the
+    # enclosing function is in the callgraph, whose fingerprint covers it.
+    enclosing = weakref.WeakKeyDictionary()
+
+    # Files of pycache itself, e.g. run by a cached function called during
+    # the trace. Their code is left out of callgraphs like the standard
+    # library, except when run as __main__ and their tests, see is_internal().
+    internal_files = set(
+        os.path.join(os.path.dirname(os.path.abspath(__file__)), name + '.py')
+        for name in ['tracer', 'callgraph', 'registry', 'fingerprint',
+                     'cache', 'codec', 'eviction', 'decorator',
+                     'locking', 'stats', 'admission', 'analysis', 'workers'])
+    # Code objects left out in the same way wherever their module is run from.
+    internal_code = set()
+    # Code of the tests of each of pycache's modules, see is_internal().
+    test_code = weakref.WeakKeyDictionary()
+
+    # Events per chunk and number of chunks in the ring used by queue().
+    chunk_size = 4096
+    chunk_count = 8
+
     def __init__(self, outputs, config):
         Thread.__init__(self)
-        self.trace_queue = Queue()
-        self.keep_going = True
         self.outputs = outputs
         self.config = config
         #self.updatables = [a for a in self.outputs if a.should_update()]
 
         self.init_trace_data()
         self.init_libpath()
+        self.init_chunks()
 
     def init_trace_data(self):
-        self.previous_event_return = False
-
         # A mapping of which function called which other function
         self.call_dict = defaultdict(lambda: defaultdict(int))
 
@@ -114,118 +342,115 @@ class TraceProcessor(Thread):
         self.func_time = defaultdict(float)
         self.func_time_max = 0
 
-        # Accumulative memory addition per function
-        self.func_memory_in = defaultdict(int)
-        self.func_memory_in_max = 0
+        # Largest peak of the memory allocated during a call, per function
+        self.func_memory_peak = defaultdict(int)
+        self.func_memory_peak_max = 0
 
-        # Accumulative memory addition per function once exited
-        self.func_memory_out = defaultdict(int)
-        self.func_memory_out_max = 0
+        # Accumulative memory allocated and not freed by calls, per function
+        self.func_memory_net = defaultdict(int)
+        self.func_memory_net_max = 0
 
         # Keeps track of the start time of each call on the stack
         self.call_stack_timer = []
-        self.call_stack_memory_in = []
-        self.call_stack_memory_out = []
+        # [memory at the call, highest memory since] of each call on the
+        # stack, including those that are not kept
+        self.call_stack_memory = []
+        # Largest peak and sum of the memory allocated and not freed of the
+        # outermost calls, e.g. the steps of a coroutine
+        self.outer_memory_peak = 0
+        self.outer_memory_net = 0
         
         # Hashes for all functions with full_name as key and code-hash as value.
         self.hash_table = dict()
         self.hash_table['__main__'] = None
 
+        # code_info plus the enclosing function per code object seen by this
+        # processor, as looking up weak keys on every call is slow.
+        self.codes = dict()
+
     def init_libpath(self):
-        self.lib_path = sysconfig.get_python_lib()
+        self.lib_path = sysconfig.get_paths()['purelib']
         path = os.path.split(self.lib_path)
         if path[1] == 'site-packages':
             self.lib_path = path[0]
         self.lib_path = self.lib_path.lower()
 
+    def init_chunks(self):
+        '''Preallocates the ring of chunks which queue() fills and run()
+        drains. Each chunk holds parallel lists of frames, events and memory
+        samples, so queueing an event does not allocate anything. Only full
+        chunks are passed between the threads.
+        '''
+        size = self.chunk_size
+        self.chunks = [([None] * size, [None] * size, [None] * size)
+                       for _ in range(self.chunk_count)]
+        self.free_chunks = Queue()
+        for index in range(1, self.chunk_count):
+            self.free_chunks.put(index)
+        self.full_chunks = Queue()
+        self.chunk_index = 0
+        self.chunk_position = 0
+
     def queue(self, frame, event, arg, memory):
-        data = {
-            'frame': frame,
-            'event': event,
-            'arg': arg,
-            'memory': memory,
-        }
-        self.trace_queue.put(data)
+        frames, events, memories = self.chunks[self.chunk_index]
+        position = self.chunk_position
+        frames[position] = frame
+        events[position] = event
+        memories[position] = memory
+        position += 1
+        if position == self.chunk_size:
+            self.full_chunks.put((self.chunk_index, position))
+            # Blocks if the processor thread is a whole ring behind.
+            self.chunk_index = self.free_chunks.get()
+            position = 0
+        self.chunk_position = position
 
     def run(self):
-        while self.keep_going:
-            try:
-                data = self.trace_queue.get(timeout=0.1)
-            except Empty:
-                pass
-            self.process(**data)
+        while True:
+            item = self.full_chunks.get()
+            if item is None:
+                break
+            index, count = item
+            frames, events, memories = self.chunks[index]
+            for position in range(count):
+                self.process(frames[position], events[position], None,
+                             memories[position])
+                # Don't keep frames (and their locals) alive.
+                frames[position] = None
+            self.free_chunks.put(index)
 
     def done(self):
-        while not self.trace_queue.empty():
-            time.sleep(0.1)
-        self.keep_going = False
+        '''Hands over the partially filled chunk and tells run() to stop once
+        everything queued before has been processed.
+        '''
+        self.full_chunks.put((self.chunk_index, self.chunk_position))
+        self.full_chunks.put(None)
 
     def process(self, frame, event, arg, memory=None):
         '''This function processes a trace result. Keeps track of
         relationships between calls.
-        '''
-
-        if memory is not None and self.previous_event_return:
-            # Deal with memory when function has finished so local variables
-            # can be cleaned up
-            self.previous_event_return = False
-
-            if self.call_stack_memory_out:
-                full_name, m = self.call_stack_memory_out.pop(-1)
-            else:
-                full_name, m = (None, None)
-
-            # NOTE: Call stack is no longer the call stack that may be
-            # expected. Potentially need to store a copy of it.
-            if full_name and m:
-                call_memory = memory - m
 
-                self.func_memory_out[full_name] += call_memory
-                self.func_memory_out_max = max(
-                    self.func_memory_out_max, self.func_memory_out[full_name]
-                )
+        memory is None or a sample of (traced memory, peak since the previous
+        sample), see SyncronousTracer.memory(). The peak belongs to the call
+        running until the event, so the peak of a call is the highest of
+        those of its own and its callees' samples.
+        '''
+        call_stack_memory = self.call_stack_memory
+        if memory is not None:
+            current, peak = memory
+            if call_stack_memory and peak > call_stack_memory[-1][1]:
+                call_stack_memory[-1][1] = peak
 
         if event == 'call':
-            keep = True
             code = frame.f_code
-
-            # Stores all the parts of a human readable name of the current call
-            full_name_list = []
-
-            # Work out the module name
-            module = inspect.getmodule(code)
-            if module:
-                module_name = module.__name__
-                module_path = module.__file__
-
-                if not self.config.include_stdlib \
-                        and self.is_module_stdlib(module_path):
-                    keep = False
-
-                if module_name == '__main__':
-                    module_name = ''
-            else:
-                module_name = ''
-
-            if module_name:
-                full_name_list.append(module_name)
-
-            # Work out the class name
             try:
-                class_name = frame.f_locals['self'].__class__.__name__
-                full_name_list.append(class_name)
-            except (KeyError, AttributeError):
-                class_name = ''
-
-            # Work out the current function or method
-            func_name = code.co_name
-            func_hash = hash(code.co_code)
-            if func_name == '?':
-                func_name = '__main__'
-            full_name_list.append(func_name)
+                full_name, func_hash, stdlib, enclosing = self.codes[code]
+            except KeyError:
+                full_name, func_hash, stdlib, enclosing = self.lookup(frame)
 
-            # Create a readable representation of the current call
-            full_name = '.'.join(full_name_list)
+            keep = self.config.include_stdlib or not stdlib
+            if keep and enclosing in self.hash_table:
+                keep = False
 
             if len(self.call_stack) > self.config.max_depth:
                 keep = False
@@ -254,18 +479,14 @@ class TraceProcessor(Thread):
                 self.call_stack_timer.append(time.time())
                 self.hash_table[full_name] = func_hash
 
-                if memory is not None:
-                    self.call_stack_memory_in.append(memory)
-                    self.call_stack_memory_out.append([full_name, memory])
-
             else:
                 self.call_stack.append('')
                 self.call_stack_timer.append(None)
 
-        if event == 'return':
-
-            self.previous_event_return = True
+            if memory is not None:
+                call_stack_memory.append([current, current])
 
+        if event == 'return':
             if self.call_stack:
                 full_name = self.call_stack.pop(-1)
 
@@ -282,20 +503,136 @@ class TraceProcessor(Thread):
                         self.func_time_max, self.func_time[full_name]
                     )
 
-                if memory is not None:
-                    if self.call_stack_memory_in:
-                        start_mem = self.call_stack_memory_in.pop(-1)
+                if memory is not None and call_stack_memory:
+                    start, highest = call_stack_memory.pop()
+                    if call_stack_memory:
+                        if highest > call_stack_memory[-1][1]:
+                            call_stack_memory[-1][1] = highest
                     else:
-                        start_mem = None
+                        self.outer_memory_peak = max(self.outer_memory_peak, highest - start)
+                        self.outer_memory_net += current - start
+                    if full_name:
+                        self.count_memory(full_name, highest - start, current - start)
+
+    def count_memory(self, full_name, peak, net):
+        if peak > self.func_memory_peak[full_name]:
+            self.func_memory_peak[full_name] = peak
+            self.func_memory_peak_max = max(self.func_memory_peak_max, peak)
+        self.func_memory_net[full_name] += net
+        self.func_memory_net_max = max(self.func_memory_net_max,
+                                       self.func_memory_net[full_name])
+
+    def lookup(self, frame):
+        ''' Adds the entry of the code of frame to self.codes. '''
+        code = frame.f_code
+        try:
+            info = self.code_info[code]
+        except KeyError:
+            info = self.describe(frame)
+        info = self.codes[code] = info + (self.enclosing.get(code),)
+        return info
+
+    @classmethod
+    def is_internal(cls, module, code=None):
+        ''' Whether module is one of pycache's own, see internal_files, and
+        code, if given, is not part of its tests. '''
+        path = getattr(module, '__file__', None)
+        if (not path or module.__name__ == '__main__' or
+                os.path.abspath(path) not in cls.internal_files):
+            return False
+        if code is None:
+            return True
+        try:
+            tests = cls.test_code[module]
+        except KeyError:
+            tests = cls.test_code[module] = set()
+            pending = [getattr(value, '__func__', value).__code__
+                       for test in vars(module).values()
+                       if isinstance(test, type) and issubclass(test, unittest.TestCase)
+                       for value in vars(test).values()
+                       if isinstance(getattr(value, '__func__', value), types.FunctionType)]
+            while pending:
+                test = pending.pop()
+                tests.add(test)
+                pending.extend(const for const in test.co_consts
+                               if isinstance(const, types.CodeType))
+        return code not in tests
+
+    def describe(self, frame):
+        '''Works out the full name, code hash and whether the code of frame
+        belongs to the standard library. The result is stored per code object
+        in code_info, so this only runs for the first call of each function.
+        The class name is taken from that first call.
+        '''
+        code = frame.f_code
+
+        # Stores all the parts of a human readable name of the current call
+        full_name_list = []
+        stdlib = False
+
+        if code in self.internal_code:
+            stdlib = True
+
+        # Work out the module name, from the globals the code runs in as a
+        # module's file may also be imported under another name.
+        module = sys.modules.get(frame.f_globals.get('__name__'))
+        if module is None or getattr(module, '__dict__', None) is not frame.f_globals:
+            module = inspect.getmodule(code)
+        if module:
+            module_name = module.__name__
+            module_path = getattr(module, '__file__', None)
 
-                    if start_mem:
-                        call_memory = memory - start_mem
-                        self.func_memory_in[full_name] += call_memory
+            if module_path and self.is_module_stdlib(module_path):
+                stdlib = True
+            if self.is_internal(module, code):
+                stdlib = True
 
-                        self.func_memory_in_max = max(
-                            self.func_memory_in_max,
-                            self.func_memory_in[full_name],
-                        )
+            if module_name == '__main__':
+                module_name = ''
+        else:
+            module_name = ''
+            # Frozen modules of the standard library, e.g. posixpath.
+            if code.co_filename.startswith('<frozen '):
+                stdlib = True
+            # Methods collections.namedtuple() generates, e.g. __new__.
+            if str(frame.f_globals.get('__name__')).startswith('namedtuple_'):
+                stdlib = True
+
+        if module_name:
+            full_name_list.append(module_name)
+
+        if QUALNAMES:
+            func_name = code.co_qualname
+        else:
+            # Work out the class name
+            try:
+                class_name = frame.f_locals['self'].__class__.__name__
+                full_name_list.append(class_name)
+            except (KeyError, AttributeError):
+                class_name = ''
+            func_name = code.co_name
+
+        # Work out the current function or method
+        func_hash = registry.code_hash(code)
+        if func_name == '?':
+            func_name = '__main__'
+        full_name_list.append(func_name)
+
+        # Create a readable representation of the current call
+        full_name = '.'.join(full_name_list)
+        registry.captured[full_name] = func_hash
+
+        info = (full_name, func_hash, stdlib)
+        self.code_info[code] = info
+        if code not in self.enclosing:
+            self.add_enclosing(code, full_name)
+        return info
+
+    def add_enclosing(self, code, full_name):
+        for const in code.co_consts:
+            if isinstance(const, types.CodeType):
+                self.enclosing[const] = full_name
+                self.add_enclosing(const, full_name)
 
     def is_module_stdlib(self, file_name):
         '''
@@ -324,7 +661,7 @@ class TraceProcessor(Thread):
         grp = defaultdict(list)
         for node in self.nodes():
             grp[node.group].append(node)
-        for g in grp.iteritems():
+        for g in grp.items():
             yield g
 
     def stat_group_from_func(self, func, calls):
@@ -333,24 +670,24 @@ class TraceProcessor(Thread):
         #stat_group.group = self.config.trace_grouper(func)
         stat_group.calls = Stat(calls, self.func_count_max)
         stat_group.time = Stat(self.func_time.get(func, 0), self.func_time_max)
-        stat_group.memory_in = Stat(
-            self.func_memory_in.get(func, 0), self.func_memory_in_max
+        stat_group.memory_peak = Stat(
+            self.func_memory_peak.get(func, 0), self.func_memory_peak_max
         )
-        stat_group.memory_out = Stat(
-            self.func_memory_in.get(func, 0), self.func_memory_in_max
+        stat_group.memory_net = Stat(
+            self.func_memory_net.get(func, 0), self.func_memory_net_max
         )
         stat_group.hash = self.hash_table[func]
         return stat_group
 
     def nodes(self):
-        for func, calls in self.func_count.iteritems():
+        for func, calls in self.func_count.items():
             yield self.stat_group_from_func(func, calls)
 
     def edges(self):
-        for src_func, dests in self.call_dict.iteritems():
+        for src_func, dests in self.call_dict.items():
             if not src_func:
                 continue
-            for dst_func, calls in dests.iteritems():
+            for dst_func, calls in dests.items():
                 edge = self.stat_group_from_func(dst_func, calls)
                 edge.src_func = src_func
                 edge.dst_func = dst_func
@@ -381,27 +718,3 @@ class Stat(object):
 class StatGroup(object):
     pass
 
-
-def simple_memoize(callable_object):
-    '''Simple memoization for functions without keyword arguments.
-
-    This is useful for mapping code objects to module in this context.
-    inspect.getmodule() requires a number of system calls, which may slow down
-    the tracing considerably. Caching the mapping from code objects (there is
-    *one* code object for each function, regardless of how many simultaneous
-    activations records there are).
-
-    In this context we can ignore keyword arguments, but a generic memoizer
-    ought to take care of that as well.
-    '''
-
-    cache = dict()
-
-    def wrapper(*rest):
-        if rest not in cache:
-            cache[rest] = callable_object(*rest)
-        return cache[rest]
-
-    return wrapper
-
-inspect.getmodule = simple_memoize(inspect.getmodule)
@@ -0,0 +1,527 @@
+'''Following the threads and child processes a traced call hands work to,
+see Callgraph's workers option.
+
+Threads started while a call with workers runs, e.g. those of a
+ThreadPoolExecutor or multiprocessing.pool.ThreadPool it creates, are traced
+with sys.settrace for the rest of their life. Their calls count towards
+every call with workers running at the time, so a pool kept for later calls
+is followed by those as well; in between, tracing costs a check per call.
+While they work for a call they run in a copy of its context, so the
+callgraphs of the cached calls they make (see decorator.py) and the files
+they read count towards it, too.
+
+Child processes forked while a process has run a call with workers (by
+os.fork(), or multiprocessing and ProcessPoolExecutor with the 'fork' start
+method) report the functions they run, and the callgraphs of their cached
+calls, by appending them to a file of that process, which each call reads
+from where it was when the call started. A counter in memory shared with the
+children tells them when a call starts, so a reused child reports the
+functions it already ran once more. Once no call with workers runs, the file
+is emptied and children stop tracing; a child kept for later calls, e.g. by
+a multiprocessing pool, resumes when it receives work through
+multiprocessing while one runs. Files read by child processes are not
+followed.
+
+Threads started before the first call with workers and processes started
+otherwise (e.g. with the 'spawn' start method) are not followed; wrap the
+functions submitted to them with decorator.traced().
+'''
+import atexit
+import contextvars
+import mmap
+import multiprocessing
+import os
+import pickle
+import struct
+import sys
+import tempfile
+import threading
+import unittest
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing.reduction import ForkingPickler
+
+from tracer import Config, SyncronousTracer, TraceProcessor, running
+
+# Calls with workers running in this process.
+active = []
+lock = threading.Lock()
+# threading.settrace() hook that was installed before the first of them.
+previous_hook = None
+# Tracers of the threads started while one ran, see ThreadTracer.
+thread_tracers = weakref.WeakSet()
+
+# Memory shared with forked children: a counter bumped whenever a call with
+# workers starts, the number of those running, and the path of the file the
+# children report to. None until the first such call.
+HEADER = struct.Struct('=QII')
+REGION_SIZE = 4096
+region = None
+report_path = None
+report_pid = None
+# In a forked child: the region of the process to report to, and the
+# reporter, see forked().
+parent_region = None
+reporter = None
+
+
+class WorkerProcessor(TraceProcessor):
+    ''' TraceProcessor of a thread or process run synchronously, which
+    needs no chunks. '''
+    chunk_size = 1
+    chunk_count = 1
+
+
+class Workers(object):
+    ''' The threads and child processes followed during a call, from start()
+    to stop(). The context of the call is that of the caller of
+    Workers(). '''
+
+    def __init__(self):
+        self.context = contextvars.copy_context()
+        self.pid = os.getpid()
+        self.tracers = []
+        # Callgraphs of calls of decorator.traced() functions in this process.
+        self.callgraphs = []
+        # Function name -> fingerprint, see stop().
+        self.functions = dict()
+        self.offset = 0
+
+    def start(self):
+        global previous_hook
+        with lock:
+            if not active:
+                previous_hook = threading.gettrace()
+                threading.settrace(thread_started)
+            active.append(self)
+            for tracer in list(thread_tracers):
+                tracer.adopt(self)
+            self.offset = open_region()
+
+    def stop(self):
+        ''' Stops following and collects the functions the workers called
+        in self.functions. '''
+        with lock:
+            if self not in active: # Forked and stopped in the child
+                return
+            active.remove(self)
+            if not active:
+                threading.settrace(previous_hook)
+            tracers = self.tracers
+            self.tracers = []
+            self.functions.update(read_reports(self.offset))
+            close_region()
+        for tracer in tracers:
+            self.functions.update(tracer.release(self))
+
+
+class ThreadTracer(SyncronousTracer):
+    ''' Traces a thread started while a call with workers ran, for the rest
+    of the thread's life, on behalf of its owners: the calls with workers
+    running. Without owners, it only checks for new ones. '''
+
+    def __init__(self):
+        self.config = Config()
+        self.processor = WorkerProcessor([None], self.config)
+        self.owners = []
+        # Whether the owners changed, and with them the context the thread
+        # runs in, see switch().
+        self.switched = False
+        self.tokens = []
+        # Guards the processor, read by the owners' threads.
+        self.lock = threading.Lock()
+
+    def adopt(self, workers):
+        ''' Adds workers to the owners. Called with the module lock held. '''
+        if not self.owners:
+            with self.lock:
+                self.processor = WorkerProcessor([None], self.config)
+        self.owners.append(workers)
+        workers.tracers.append(self)
+        self.switched = True
+
+    def release(self, workers):
+        ''' Removes workers from the owners and returns (name, fingerprint)
+        of each function called. '''
+        with lock:
+            self.owners.remove(workers)
+            self.switched = True
+        with self.lock:
+            return [(node.name, node.hash) for node in self.processor.nodes()]
+
+    def switch(self):
+        ''' Runs the thread in (a copy of) the context of the latest owner,
+        or its own context again if there is none. '''
+        self.switched = False
+        for var, token in reversed(self.tokens):
+            try:
+                var.reset(token)
+            except ValueError: # Set in another context, e.g. of Context.run()
+                pass
+        self.tokens = []
+        owners = self.owners
+        if owners:
+            for var, value in owners[-1].context.items():
+                self.tokens.append((var, var.set(value)))
+
+    def tracer(self, frame, event, arg):
+        if self.switched:
+            self.switch()
+        if not self.owners:
+            return None
+        if event == 'call' or event == 'return':
+            with self.lock:
+                self.processor.process(frame, event, arg)
+        return self.tracer
+
+
+def thread_started(frame, event, arg):
+    ''' threading.settrace() hook, run by each thread started while a call
+    with workers runs. '''
+    if isinstance(threading.current_thread(), TraceProcessor):
+        sys.settrace(None)
+        return None
+    tracer = ThreadTracer()
+    with lock:
+        thread_tracers.add(tracer)
+        for workers in active:
+            tracer.adopt(workers)
+    tracer.enter()
+    tracer.start()
+    return tracer.tracer(frame, event, arg)
+
+
+def open_region():
+    ''' Creates the region shared with forked children and the report file
+    on first use, and tells the children a call starts. Returns where the
+    call starts reading the reports. Called with the module lock held. '''
+    global region, report_path, report_pid
+    if region is None:
+        fd, report_path = tempfile.mkstemp(prefix='pycache-workers-', suffix='.txt')
+        os.close(fd)
+        report_pid = os.getpid()
+        path = os.fsencode(report_path)
+        region = mmap.mmap(-1, REGION_SIZE)
+        HEADER.pack_into(region, 0, 0, 0, len(path))
+        region[HEADER.size:HEADER.size + len(path)] = path
+    counter, _, length = HEADER.unpack_from(region, 0)
+    HEADER.pack_into(region, 0, counter + 1, len(active), length)
+    return os.path.getsize(report_path)
+
+
+def close_region():
+    ''' Tells the children a call ended, and empties the report file once
+    no call with workers runs. Called with the module lock held. '''
+    counter, _, length = HEADER.unpack_from(region, 0)
+    HEADER.pack_into(region, 0, counter, len(active), length)
+    if not active:
+        try:
+            os.truncate(report_path, 0)
+        except OSError:
+            pass
+
+
+def read_reports(offset):
+    ''' Name -> fingerprint of the functions reported to this process from
+    offset on. '''
+    functions = dict()
+    if report_path is None or report_pid != os.getpid():
+        return functions
+    with open(report_path, 'rb') as f:
+        f.seek(offset)
+        lines = f.read().decode().splitlines()
+    for line in lines:
+        name, fingerprint = line.split('\t')
+        functions[name] = None if fingerprint == 'None' else fingerprint
+    return functions
+
+
+def write_report(fd, functions):
+    ''' Appends (name, fingerprint) of functions to a report file. '''
+    lines = ''.join('%s\t%s\n' % item for item in functions)
+    try:
+        # A single write, appended as a whole.
+        os.write(fd, lines.encode())
+    except OSError: # The process followed is gone
+        pass
+
+
+def remove_reports():
+    if report_path is not None and report_pid == os.getpid():
+        try:
+            os.remove(report_path)
+        except OSError:
+            pass
+
+
+class Reporter(object):
+    ''' Traces a forked child and appends (name, fingerprint) of each
+    function it calls to the report file of the process it follows, once per
+    call with workers there. Stands in for a tracer in running, so tracers of
+    cached calls in the child pause it, see SyncronousTracer.enter(). '''
+
+    def __init__(self, shared):
+        self.shared = shared
+        counter, _, length = HEADER.unpack_from(shared, 0)
+        self.counter = counter
+        path = bytes(shared[HEADER.size:HEADER.size + length])
+        self.fd = os.open(path, os.O_WRONLY | os.O_APPEND)
+        self.processor = WorkerProcessor([None], Config())
+        # Code objects seen and names reported since the counter changed.
+        self.reported = set()
+        self.names = set()
+        # Whether the thread stopped tracing, see report() and receive().
+        self.stopped = threading.local()
+
+    def report(self, frame, event, arg):
+        if event != 'call':
+            return None
+        counter, calls, _ = HEADER.unpack_from(self.shared, 0)
+        if not calls:
+            # Nothing to report to until a call starts there.
+            sys.settrace(None)
+            self.stopped.value = True
+            return None
+        if counter != self.counter:
+            self.counter = counter
+            self.reported = set()
+            self.names = set()
+        code = frame.f_code
+        if code in self.reported:
+            return None
+        self.reported.add(code)
+        try:
+            name, fingerprint, stdlib = TraceProcessor.code_info[code]
+        except KeyError:
+            name, fingerprint, stdlib = self.processor.describe(frame)
+        # See TraceProcessor.enclosing.
+        if TraceProcessor.enclosing.get(code) in self.names:
+            return None
+        if not stdlib and name != '__main__':
+            self.names.add(name)
+            write_report(self.fd, [(name, fingerprint)])
+        return None
+
+    def include(self, callgraph):
+        ''' Reports the functions of callgraph, that of a cached call made
+        by the child, if a call with workers runs in the process followed. '''
+        if HEADER.unpack_from(self.shared, 0)[1]:
+            write_report(self.fd, callgraph.graph.items())
+
+    def thread_started(self, frame, event, arg):
+        running.tracers = [self]
+        sys.settrace(self.report)
+        return self.report(frame, event, arg)
+
+    def pause(self):
+        sys.settrace(None)
+
+    def resume(self):
+        sys.settrace(self.report)
+
+    def receive(self):
+        ''' Resumes tracing a thread that stopped if a call with workers runs
+        in the process followed, as the thread is about to work for it. '''
+        if getattr(self.stopped, 'value', False) and HEADER.unpack_from(self.shared, 0)[1]:
+            self.stopped.value = False
+            sys.settrace(self.report)
+
+
+def receiving_loads(*args, **kwargs):
+    ''' ForkingPickler.loads() in a forked child, through which tasks of
+    multiprocessing pools and of ProcessPoolExecutor arrive. '''
+    if reporter is not None:
+        reporter.receive()
+    return pickle.loads(*args, **kwargs)
+
+
+class Report(object):
+    ''' Where a function run by a worker that is not followed reports its
+    callgraph to: the calls with workers running in the process that made
+    the Report. Can be pickled for other processes, which report through the
+    report file. '''
+
+    def __init__(self):
+        with lock:
+            self.workers = list(active)
+            self.path = report_path if active else None
+        self.pid = os.getpid()
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state['workers'] = []
+        return state
+
+    def include(self, callgraph):
+        if os.getpid() == self.pid:
+            for workers in self.workers:
+                workers.callgraphs.append(callgraph)
+        elif self.path is not None:
+            try:
+                fd = os.open(self.path, os.O_WRONLY | os.O_APPEND)
+            except OSError: # The process followed is gone
+                return
+            try:
+                write_report(fd, callgraph.graph.items())
+            finally:
+                os.close(fd)
+
+
+class ReportingList(list):
+    ''' Stands in for the list collecting the callgraphs of cached calls
+    (see decorator.collected) in a forked child, and reports them. '''
+    def append(self, callgraph):
+        if reporter is not None:
+            reporter.include(callgraph)
+
+
+def forked():
+    ''' os.register_at_fork() hook, run in the child: reports to the process
+    forking if it ran a call with workers, or else to the one it reports
+    to. '''
+    global lock, region, parent_region, reporter, thread_tracers
+    lock = threading.Lock()
+    del active[:]
+    thread_tracers = weakref.WeakSet()
+    if region is not None:
+        parent_region = region
+    region = None
+    if parent_region is None:
+        return
+    for tracer in getattr(running, 'tracers', []):
+        tracer.pause()
+    try:
+        reporter = Reporter(parent_region)
+    except OSError:
+        reporter = None
+        return
+    running.tracers = [reporter]
+    threading.settrace(reporter.thread_started)
+    sys.settrace(reporter.report)
+    ForkingPickler.loads = staticmethod(receiving_loads)
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=forked)
+atexit.register(remove_reports)
+
+# For when this module is run as __main__, e.g. by its tests.
+TraceProcessor.internal_code.update([thread_started.__code__, Report.include.__code__,
+                                     ReportingList.append.__code__,
+                                     write_report.__code__])
+
+
+marker = contextvars.ContextVar('marker', default=None)
+
+def worker_marker(x):
+    return marker.get()
+
+def fan_out_threads(xs):
+    with ThreadPoolExecutor(2) as executor:
+        return list(executor.map(hashcomparison.func_a, xs, xs))
+
+def fan_out_context(xs):
+    with ThreadPoolExecutor(2) as executor:
+        return list(executor.map(worker_marker, xs))
+
+kept = dict()
+
+def fan_out_kept(xs):
+    if 'threads' not in kept:
+        kept['threads'] = ThreadPoolExecutor(2)
+    return list(kept['threads'].map(hashcomparison.func_b, xs, xs))
+
+def fan_out_processes(xs):
+    with multiprocessing.get_context('fork').Pool(2) as pool:
+        return pool.starmap(hashcomparison.func_a, zip(xs, xs))
+
+def tracing():
+    return sys.gettrace() is not None
+
+def fan_out_kept_processes(xs):
+    if 'processes' not in kept:
+        kept['processes'] = multiprocessing.get_context('fork').Pool(1)
+    return kept['processes'].starmap(hashcomparison.func_b, zip(xs, xs))
+
+
+class WorkersTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        # Imported before the calls, whose callgraphs would hold its import.
+        global hashcomparison
+        import hashcomparison
+
+    def execute(self, function, *args):
+        from callgraph import Callgraph
+        callgraph = Callgraph(workers=True)
+        value = callgraph.execute(function, *args)
+        self.assertTrue(callgraph.unchanged())
+        return value, set(callgraph.graph)
+
+    def test_threads(self):
+        from callgraph import Callgraph
+        value, names = self.execute(fan_out_threads, [1, 2])
+        self.assertEqual([2, 4], value)
+        self.assertIn('hashcomparison.func_a', names)
+        callgraph = Callgraph()
+        callgraph.execute(fan_out_threads, [1, 2])
+        self.assertNotIn('hashcomparison.func_a', callgraph.graph)
+        self.assertIsNone(threading.gettrace())
+
+    def test_kept_threads(self):
+        ''' Threads started by an earlier call are followed by later ones. '''
+        for i in range(2):
+            value, names = self.execute(fan_out_kept, [1, 2])
+            self.assertEqual([2, 4], value)
+            self.assertIn('hashcomparison.func_b', names)
+        value, names = self.execute(fan_out_threads, [1])
+        self.assertNotIn('hashcomparison.func_b', names)
+
+    def test_context(self):
+        token = marker.set('call')
+        try:
+            value, names = self.execute(fan_out_context, [1, 2])
+        finally:
+            marker.reset(token)
+        self.assertEqual(['call', 'call'], value)
+
+    @unittest.skipUnless('fork' in multiprocessing.get_all_start_methods(), 'No fork')
+    def test_processes(self):
+        value, names = self.execute(fan_out_processes, [1, 2, 3])
+        self.assertEqual([2, 4, 6], value)
+        self.assertIn('hashcomparison.func_a', names)
+
+    @unittest.skipUnless('fork' in multiprocessing.get_all_start_methods(), 'No fork')
+    def test_kept_processes(self):
+        ''' A reused child reports the functions it ran again. '''
+        try:
+            for i in range(2):
+                value, names = self.execute(fan_out_kept_processes, [1, 2])
+                self.assertEqual([2, 4], value)
+                self.assertIn('hashcomparison.func_b', names)
+        finally:
+            kept.pop('processes').terminate()
+
+    @unittest.skipUnless('fork' in multiprocessing.get_all_start_methods(), 'No fork')
+    def test_idle_processes(self):
+        ''' Once no call with workers runs, the reports are emptied and
+        children stop tracing until they receive work for another. '''
+        try:
+            self.execute(fan_out_kept_processes, [1])
+            # The module the callgraph uses, also when this one is __main__.
+            from workers import report_path
+            self.assertEqual(0, os.path.getsize(report_path))
+            self.assertFalse(kept['processes'].apply(tracing))
+            value, names = self.execute(fan_out_kept_processes, [1, 2])
+            self.assertEqual([2, 4], value)
+            self.assertIn('hashcomparison.func_b', names)
+        finally:
+            kept.pop('processes').terminate()
+
+    def tearDown(self):
+        executor = kept.pop('threads', None)
+        if executor is not None:
+            executor.shutdown()
+
+
+if __name__ == '__main__':
+    unittest.main()